@@ -0,0 +1,485 @@
+"""
+مجموعة قياس أداء البوت مقابل خادم Bot API محلي مزيّف.
+
+الاستخدام:
+    python bench.py --sizes 100,1000,10000,100000 --output bench.json
+    python bench.py --sizes 1000 --latency-ms 50 --error-rate 0.01 --retry-after-rate 0.005
+    python bench.py --baseline bench.json --tolerance 0.2   # يفشل (exit 1) عند تراجع الأداء
+
+يقيس لكل حجم: تعديلات/ثانية ومدة دورة التحديث، تأخر الأزرار p50/p99 (من لحظة الرسم حتى وصول
+الطلب للخادم)، زمن الحفظ والتحميل وإلحاق السجل، زمن نشر منشور عبر confirm_send، وذاكرة العملية (RSS).
+ويقيس مرة واحدة زمن الاستجابة لضغطات الأزرار عبر خادم webhook بمسار واحد وبعدة مسارات.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def rss_mb():
+    """الذاكرة المقيمة الحالية للعملية (من /proc إن وجد، وإلا الذروة)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# --- خادم Bot API المزيّف ---
+class FakeTelegram:
+    """حالة الخادم المزيّف وإعداداته (زمن الاستجابة، نسبة الأخطاء، حقن RetryAfter)."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, retry_after_rate=0.0, retry_after=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.next_message_id = 1
+        self.edits = []  # (monotonic وقت الوصول, chat_id, message_id)
+        self.counts = {}
+        self.updates = []
+
+    def reset(self):
+        with self.lock:
+            self.edits = []
+            self.counts = {}
+
+    def handle(self, method, params):
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+
+        if method in ("editMessageReplyMarkup", "editMessageText", "sendMessage", "sendPhoto", "sendDocument", "sendVideo"):
+            roll = random.random()
+            if roll < self.retry_after_rate:
+                return {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                        "parameters": {"retry_after": self.retry_after}}
+            if roll < self.retry_after_rate + self.error_rate:
+                return {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+
+        if method == "getMe":
+            return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+        if method == "editMessageReplyMarkup":
+            with self.lock:
+                self.edits.append((time.monotonic(), params.get("chat_id"), params.get("message_id")))
+            return {"ok": True, "result": True}
+        if method.startswith("send"):
+            with self.lock:
+                message_id = self.next_message_id
+                self.next_message_id += 1
+            return {"ok": True, "result": {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": -100, "type": "channel", "username": str(params.get("chat_id", "")).lstrip("@")},
+            }}
+        if method == "getUpdates":
+            with self.lock:
+                updates, self.updates = self.updates, []
+            if not updates:
+                time.sleep(min(float(params.get("timeout") or 0), 0.5))
+            return {"ok": True, "result": updates}
+        return {"ok": True, "result": True}
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            content_type = self.headers.get("Content-Type", "")
+            if "json" in content_type:
+                params = json.loads(body or b"{}")
+            elif "x-www-form-urlencoded" in content_type:
+                params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            else:
+                params = {}
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            payload = fake.handle(method, params)
+            out = json.dumps(payload).encode()
+            self.send_response(200 if payload.get("ok") else payload["error_code"])
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        do_GET = do_POST
+
+    return Handler
+
+
+def start_fake_server(fake):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- السيناريوهات ---
+def populate(main, size, chats):
+    """إنشاء size منشور موزعة على chats قناة، مع مواعيد بين ساعة و 60 يومًا."""
+    now = datetime.datetime.now()
+    main.posts = main.PostStore(
+        main.Post(
+            chat_id=f"@bench{i % chats}",
+            message_id=i + 1,
+            post_text=f"منشور قياس رقم {i}",
+            post_date=now + datetime.timedelta(minutes=60 + (i * 37) % (60 * 24 * 60)),
+        )
+        for i in range(size)
+    )
+    with main.render_cache_lock:
+        main.render_cache.clear()
+
+
+def bench_update_pass(main, fake, bot):
+    """دورة تحديث كاملة لكل المنشورات بذاكرة أزرار فارغة (أسوأ حالة)."""
+    with main.render_cache_lock:
+        main.render_cache.clear()
+    fake.reset()
+    started = time.monotonic()
+    main.update_all_posts(bot)
+    duration = time.monotonic() - started
+    staleness = [arrived - started for arrived, _, _ in fake.edits]
+    return {
+        "edits": len(fake.edits),
+        "duration_s": duration,
+        "edits_per_s": len(fake.edits) / duration if duration else None,
+        "staleness_p50_s": percentile(staleness, 50),
+        "staleness_p99_s": percentile(staleness, 99),
+        "failed_responses": fake.counts.get("editMessageReplyMarkup", 0) - len(fake.edits),
+    }
+
+
+def bench_noop_pass(main, fake, bot):
+    """دورة ثانية مباشرة: كل الأزرار مطابقة، فيجب ألا يصل أي طلب للشبكة."""
+    fake.reset()
+    started = time.monotonic()
+    main.update_all_posts(bot)
+    return {"duration_s": time.monotonic() - started, "requests": fake.counts.get("editMessageReplyMarkup", 0)}
+
+
+def bench_persistence(main, ops):
+    """زمن اللقطة الكاملة، التحميل، تسجيل التعديلات الفردية، وكتابتها المؤجلة دفعة واحدة."""
+    started = time.monotonic()
+    main.save_data()
+    snapshot_s = time.monotonic() - started
+
+    latencies = []
+    for i in range(min(ops, len(main.posts))):
+        post = main.posts[i]
+        post["post_text"] = f"{post['post_text']}!"
+        t0 = time.monotonic()
+        main.persist_post_update(post, "post_text")
+        latencies.append(time.monotonic() - t0)
+    # المعالجات لا تنتظر القرص؛ كلفة الكتابة الفعلية تظهر في دفعة الكتابة المؤجلة
+    started = time.monotonic()
+    main.write_behind.flush()
+    flush_s = time.monotonic() - started
+
+    started = time.monotonic()
+    main.save_data()
+    main.load_data()
+    load_s = time.monotonic() - started
+
+    path = main.SQLITE_FILE if main.STORAGE_BACKEND == "sqlite" else main.DATA_FILE
+    size_bytes = os.path.getsize(path) if os.path.exists(path) else None
+    return {
+        "snapshot_s": snapshot_s,
+        "save_and_load_s": load_s,
+        "op_p50_ms": (percentile(latencies, 50) or 0) * 1000,
+        "op_p99_ms": (percentile(latencies, 99) or 0) * 1000,
+        "flush_s": flush_s,
+        "file_bytes": size_bytes,
+    }
+
+
+def bench_startup(main):
+    """إقلاع بارد من الملف المحفوظ: تحميل البيانات ثم جدولة كل المنشورات لأول تمريرة."""
+    main.save_data()
+    started = time.monotonic()
+    main.load_data()
+    load_s = time.monotonic() - started
+    started = time.monotonic()
+    main.countdown_scheduler.reset(main.posts)
+    schedule_s = time.monotonic() - started
+    main.countdown_scheduler.reset([])
+    return {"load_s": load_s, "schedule_s": schedule_s, "total_s": load_s + schedule_s}
+
+
+def bench_publish(main, bot, count):
+    """نشر count منشور عبر confirm_send بكائنات Update/Context مبسطة."""
+    latencies = []
+    for i in range(count):
+        user_data = {
+            "post_text": f"نشر قياس {i}",
+            "post_date": datetime.datetime.now() + datetime.timedelta(days=3),
+            "post_link": "https://t.me/bench",
+            "creating_post": True,
+        }
+        query = SimpleNamespace(answer=lambda *a, **k: None, edit_message_text=lambda *a, **k: None)
+        update = SimpleNamespace(callback_query=query)
+        context = SimpleNamespace(user_data=user_data, bot=bot)
+        t0 = time.monotonic()
+        main.confirm_send(update, context)
+        latencies.append(time.monotonic() - t0)
+    return {
+        "count": count,
+        "p50_ms": (percentile(latencies, 50) or 0) * 1000,
+        "p99_ms": (percentile(latencies, 99) or 0) * 1000,
+    }
+
+
+def bench_webhook(main, bot, count, senders, lanes):
+    """إرسال count ضغطة زر (callback_query) كـ JSON إلى خادم webhook من senders مرسلين متوازيين.
+
+    يقيس زمن الضغطة من لحظة الإرسال حتى بدء المعالج، والمعالج يرد على Telegram المزيّف (answerCallbackQuery).
+    """
+    import http.client
+    from telegram.ext import CallbackQueryHandler, Dispatcher
+
+    sent_at = {}
+    latencies = []
+    done = threading.Semaphore(0)
+    lock = threading.Lock()
+
+    def on_press(update, context):
+        t = time.monotonic() - sent_at[update.callback_query.data]
+        update.callback_query.answer()
+        with lock:
+            latencies.append(t)
+        done.release()
+
+    dispatcher = Dispatcher(bot, None, workers=1, use_context=True)
+    dispatcher.add_handler(CallbackQueryHandler(on_press))
+    server = main.WebhookServer(bot, dispatcher.process_update, "127.0.0.1", 0, "/hook", "bench-secret", workers=lanes)
+    server.start()
+
+    def sender(n):
+        conn = http.client.HTTPConnection("127.0.0.1", server.port)
+        user = {"id": 1000 + n, "is_bot": False, "first_name": "bench"}
+        for i in range(n, count, senders):
+            data = f"press:{i}"
+            body = json.dumps({
+                "update_id": i + 1,
+                "callback_query": {"id": str(i), "from": user, "chat_instance": "bench", "data": data},
+            })
+            sent_at[data] = time.monotonic()
+            conn.request("POST", "/hook", body, {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": "bench-secret"})
+            conn.getresponse().read()
+        conn.close()
+
+    t0 = time.monotonic()
+    threads = [threading.Thread(target=sender, args=(n,)) for n in range(senders)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for _ in range(count):
+        done.acquire()
+    elapsed = time.monotonic() - t0
+    server.stop()
+    return {
+        "count": count,
+        "lanes": lanes,
+        "updates_per_s": count / elapsed if elapsed else None,
+        "p50_ms": (percentile(latencies, 50) or 0) * 1000,
+        "p99_ms": (percentile(latencies, 99) or 0) * 1000,
+    }
+
+
+def bench_callbacks(main, count):
+    """زمن فك بيانات الأزرار في جدول التوجيه، موزعًا على كل الإجراءات المسجلة (ببيانات أزرار حقيقية)."""
+    samples = [main.callback_for(action, *(kind("1") for kind in main.callback_router.routes[action][1]))
+               for action in main.callback_router.codes]
+    latencies = []
+    for i in range(count):
+        data = samples[i % len(samples)]
+        t0 = time.perf_counter()
+        main.callback_router.decode(data)
+        latencies.append(time.perf_counter() - t0)
+    return {
+        "count": count,
+        "actions": len(samples),
+        "p50_us": (percentile(latencies, 50) or 0) * 1e6,
+        "p99_us": (percentile(latencies, 99) or 0) * 1e6,
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    """مقارنة النتائج بملف سابق. يعيد قائمة التراجعات."""
+    with open(baseline_path) as f:
+        baseline = {r["posts"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["posts"])
+        if not base:
+            continue
+        checks = [
+            ("update_pass.edits_per_s", r["update_pass"]["edits_per_s"], base["update_pass"]["edits_per_s"], True),
+            ("update_pass.staleness_p99_s", r["update_pass"]["staleness_p99_s"], base["update_pass"]["staleness_p99_s"], False),
+            ("persistence.op_p99_ms", r["persistence"]["op_p99_ms"], base["persistence"]["op_p99_ms"], False),
+            ("persistence.snapshot_s", r["persistence"]["snapshot_s"], base["persistence"]["snapshot_s"], False),
+            ("startup.total_s", r["startup"]["total_s"], base.get("startup", {}).get("total_s"), False),
+        ]
+        for name, value, old, higher_is_better in checks:
+            if value is None or not old:
+                continue
+            change = (value - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append({"posts": r["posts"], "metric": name, "baseline": old, "current": value, "change": change})
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="قياس أداء بوت العد التنازلي مقابل Bot API مزيّف")
+    parser.add_argument("--sizes", default="100,1000,10000,100000")
+    parser.add_argument("--chats", type=int, default=50, help="عدد القنوات التي توزع عليها المنشورات")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--rate-global", type=float, default=100000, help="EDIT_RATE_GLOBAL أثناء القياس")
+    parser.add_argument("--rate-per-chat", type=float, default=100000, help="EDIT_RATE_PER_CHAT أثناء القياس")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--persist-ops", type=int, default=1000)
+    parser.add_argument("--publish", type=int, default=50)
+    parser.add_argument("--webhook", type=int, default=500, help="عدد ضغطات الأزرار المرسلة إلى خادم webhook (0 لتعطيله)")
+    parser.add_argument("--webhook-senders", type=int, default=8)
+    parser.add_argument("--webhook-lanes", type=int, default=4)
+    parser.add_argument("--callbacks", type=int, default=100000, help="عدد عمليات فك بيانات الأزرار (0 لتعطيله)")
+    parser.add_argument("--output", help="ملف JSON للنتائج (الافتراضي: stdout)")
+    parser.add_argument("--baseline", help="ملف نتائج سابق للمقارنة")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="countdown-bench-")
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "ADMIN_ID": "0",
+        "CHANNEL_ID": "@bench",
+        "STORAGE_BACKEND": args.storage,
+        "EDIT_RATE_GLOBAL": str(args.rate_global),
+        "EDIT_RATE_PER_CHAT": str(args.rate_per_chat),
+        "EDIT_BURST_PER_CHAT": str(max(1, int(min(args.rate_per_chat, 1000)))),
+        "EDIT_WORKERS": str(args.workers),
+        "BOT_POOL_SIZE": str(args.workers + 4),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+    import logging
+    import main
+    from telegram.ext import ExtBot
+    from telegram.utils.request import Request
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fake = FakeTelegram(args.latency_ms, args.jitter_ms, args.error_rate, args.retry_after_rate, args.retry_after)
+    server = start_fake_server(fake)
+    main.shared_bot = ExtBot(
+        main.BOT_TOKEN,
+        base_url=f"http://127.0.0.1:{server.server_address[1]}/bot",
+        request=Request(con_pool_size=args.workers + 4),
+    )
+    bot = main.get_bot()
+    # المنشورات في القياس لا تحتاج عامل الجدولة في الخلفية
+    main.countdown_scheduler.add = lambda post, due=None: None
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        populate(main, size, args.chats)
+        rss_before = rss_mb()
+        result = {"posts": size}
+        result["update_pass"] = bench_update_pass(main, fake, bot)
+        result["noop_pass"] = bench_noop_pass(main, fake, bot)
+        result["persistence"] = bench_persistence(main, args.persist_ops)
+        result["startup"] = bench_startup(main)
+        result["publish"] = bench_publish(main, bot, args.publish)
+        result["rss_mb"] = rss_mb()
+        result["rss_delta_mb"] = result["rss_mb"] - rss_before
+        result["bot_pool"] = main.bot_pool_stats()
+        results.append(result)
+        print(
+            f"{size:>7} منشور: {result['update_pass']['edits_per_s'] or 0:8.1f} تعديل/ث، "
+            f"p99 تأخر {result['update_pass']['staleness_p99_s'] or 0:.2f}s، "
+            f"لقطة {result['persistence']['snapshot_s']:.3f}s، إقلاع {result['startup']['total_s']:.3f}s، "
+            f"RSS {result['rss_mb']:.0f}MB",
+            file=sys.stderr,
+        )
+
+    webhook = []
+    if args.webhook:
+        # مسار واحد يعادل معالجة dispatcher المتسلسلة في وضع polling
+        for lanes in sorted({1, args.webhook_lanes}):
+            webhook.append(bench_webhook(main, bot, args.webhook, args.webhook_senders, lanes))
+            print(
+                f"webhook ({lanes} مسار): {webhook[-1]['updates_per_s']:8.1f} تحديث/ث، "
+                f"p50 {webhook[-1]['p50_ms']:.1f}ms، p99 {webhook[-1]['p99_ms']:.1f}ms",
+                file=sys.stderr,
+            )
+
+    callbacks = None
+    if args.callbacks:
+        callbacks = bench_callbacks(main, args.callbacks)
+        print(
+            f"توجيه الأزرار ({callbacks['actions']} إجراء): p50 {callbacks['p50_us']:.2f}µs، p99 {callbacks['p99_us']:.2f}µs",
+            file=sys.stderr,
+        )
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+        },
+        "results": results,
+        "webhook": webhook,
+        "callbacks": callbacks,
+    }
+    if args.baseline:
+        report["regressions"] = compare(results, args.baseline, args.tolerance)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    server.shutdown()
+
+    if report.get("regressions"):
+        print(f"❌ {len(report['regressions'])} تراجع في الأداء مقارنة بـ {args.baseline}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,9 +1,27 @@
 import os
-import datetime
 import time
+
+# بداية العملية: مرجع قياس مراحل الإقلاع (قبل استيراد telegram وبقية المكتبات)
+PROCESS_STARTED = time.monotonic()
+
+import re
+import random
+import datetime
+import math
+import heapq
+import bisect
+import hashlib
+import hmac
+import queue
+import socket
 import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import schedule
 import logging
+from logging.handlers import RotatingFileHandler
 from telegram.error import NetworkError, Unauthorized, RetryAfter, BadRequest
 from telegram.ext import (
     Updater, 
@@ -13,12 +31,27 @@ from telegram.ext import (
     CallbackQueryHandler, 
     MessageHandler, 
     Filters,
-    Defaults
+    Defaults,
+    Dispatcher,
+    ExtBot,
+    JobQueue
 )
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Bot
+from telegram.utils.request import Request
 from dotenv import load_dotenv
-from functools import wraps
+from functools import partial, wraps
 import json
+import csv
+import io
+import asyncio
+import signal
+import sqlite3
+import atexit
+from contextlib import contextmanager
+import sys
+import gc
+import tracemalloc
+from urllib.parse import urlparse
 
 # تحميل متغيرات البيئة من ملف .env
 load_dotenv()
@@ -30,8 +63,439 @@ CHANNEL_ID = os.getenv("CHANNEL_ID")
 # اسم ملف لتخزين البيانات
 DATA_FILE = "data.json"
 
+class Post:
+    """منشور واحد بحقول ثابتة (__slots__) بدل dict، مع واجهة dict المعتادة (get و [] و update).
+
+    عند 100 ألف منشور يوفّر هذا معظم ذاكرة القواميس، وتغيير الحقول المفهرسة (المعرف، المفتاح، النص، التاريخ)
+    يحدّث فهارس PostStore تلقائيًا.
+    """
+
+    FIELDS = ("post_id", "chat_id", "message_id", "post_text", "post_link", "post_media", "post_date", "post_resolution",
+              "post_quarantine")
+    INDEXED = ("post_id", "chat_id", "message_id", "post_text", "post_date", "post_quarantine")
+    __slots__ = FIELDS + ("store",)
+
+    def __init__(self, chat_id=None, message_id=None, post_text=None, post_link=None, post_media=None, post_date=None, post_id=None,
+                 post_resolution=None, post_quarantine=None):
+        self.post_id = post_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.post_text = post_text
+        self.post_link = post_link
+        self.post_media = post_media
+        self.post_date = post_date
+        self.post_resolution = post_resolution
+        # سبب العزل إذا توقفت رسالة المنشور عن قبول التعديل (None للمنشور السليم)
+        self.post_quarantine = post_quarantine
+        self.store = None
+
+    @classmethod
+    def from_mapping(cls, data) -> "Post":
+        return data if isinstance(data, cls) else cls(**{k: data.get(k) for k in cls.FIELDS})
+
+    @property
+    def deadline(self) -> float:
+        """موعد الانتهاء كـ timestamp (المنشورات بلا تاريخ تُعامل كمنتهية)."""
+        return self.post_date.timestamp() if self.post_date else float("-inf")
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        if key in self.INDEXED and self.store is not None:
+            self.store.field_changed(self, key, value)
+        else:
+            setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def keys(self):
+        return self.FIELDS
+
+    def values(self):
+        return [getattr(self, k) for k in self.FIELDS]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.FIELDS]
+
+    def update(self, other):
+        for key in self.FIELDS:
+            if key in other and not (key == "post_id" and other[key] is None):
+                self[key] = other[key]
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"Post(#{self.post_id}, {self.chat_id!r}, {self.message_id!r}, post_date={self.post_date!r})"
+
+
+class PostStore:
+    """كل المنشورات مع فهارس: بالمعرف الثابت، بـ (chat_id, message_id)، بالقناة، ومرتبة بموعد الانتهاء.
+
+    البحث والحذف بالمعرف أو بالمفتاح O(1)، واستعلامات العدد النشط والمنتهي وأقرب المواعيد وصفحات
+    القائمة تتم بـ bisect على فهرس المواعيد بدل فحص كل المنشورات. فهرس كلمات النص (للبحث) يُبنى
+    عند أول بحث ثم يُحدَّث مع كل تغيير.
+    """
+
+    def __init__(self, items=()):
+        self.lock = threading.RLock()
+        self.by_id = {}  # post_id -> Post (بترتيب الإدراج)
+        self.by_key = {}  # (chat_id, message_id) -> Post
+        self.by_chat = {}  # chat_id -> {post_id}
+        self.quarantined = set()  # {post_id} للمنشورات المعزولة
+        self.tokens = None  # كلمة -> {post_id} (None حتى أول بحث)
+        self.keys = []  # (deadline, post_id) مرتبة تصاعديًا
+        self.by_deadline = []  # المنشورات بنفس ترتيب keys
+        self.next_id = 1
+        # عدد المنشورات التي أُعطيت معرفًا جديدًا (بيانات قديمة بلا معرفات تحتاج حفظًا بعد التحميل)
+        self.ids_assigned = 0
+        # عدد المنشورات المحفوظة بمعرف محادثة رقمي كنص (بيانات قديمة تُعاد كتابتها بعد التحميل)
+        self.chat_ids_parsed = 0
+        self.extend(items)
+
+    def register(self, post) -> Post:
+        """إدخال المنشور في كل الفهارس ما عدا فهرس المواعيد."""
+        post = Post.from_mapping(post)
+        if post.post_id is None or post.post_id in self.by_id:
+            post.post_id = self.next_id
+            self.ids_assigned += 1
+        if post.post_id >= self.next_id:
+            self.next_id = post.post_id + 1
+        chat_id = parse_chat_id(post.chat_id)
+        if chat_id != post.chat_id:
+            post.chat_id = chat_id
+            self.chat_ids_parsed += 1
+        post.store = self
+        self.by_id[post.post_id] = post
+        self.by_key[(post.chat_id, post.message_id)] = post
+        self.by_chat.setdefault(post.chat_id, set()).add(post.post_id)
+        if post.post_quarantine:
+            self.quarantined.add(post.post_id)
+        self.tokens_add(post)
+        return post
+
+    def append(self, post) -> Post:
+        """إضافة منشور (يُعطى معرفًا ثابتًا إذا لم يكن له) وإرجاع السجل المخزن."""
+        with self.lock:
+            post = self.register(post)
+            self.index_add(post)
+        return post
+
+    def extend(self, items):
+        """إضافة دفعة منشورات: الدفعات الكبيرة (التحميل عند الإقلاع) تُرتَّب مرة واحدة بدل إدراج bisect لكل منشور."""
+        with self.lock:
+            added = [self.register(post) for post in items]
+            if len(added) < 64:
+                for post in added:
+                    self.index_add(post)
+                return
+            pairs = [((post.deadline, post.post_id), post) for post in added]
+            pairs.extend(zip(self.keys, self.by_deadline))
+            pairs.sort(key=lambda pair: pair[0])
+            self.keys = [key for key, _ in pairs]
+            self.by_deadline = [post for _, post in pairs]
+
+    def get(self, post_id) -> Post:
+        return self.by_id.get(post_id)
+
+    def find(self, chat_id, message_id) -> Post:
+        return self.by_key.get((parse_chat_id(chat_id), message_id))
+
+    def chats(self) -> list:
+        """القنوات التي لها منشورات محفوظة."""
+        with self.lock:
+            return sorted((c for c, ids in self.by_chat.items() if ids), key=str)
+
+    def unlink(self, post: Post):
+        del self.by_id[post.post_id]
+        key = (post.chat_id, post.message_id)
+        if self.by_key.get(key) is post:
+            del self.by_key[key]
+        self.chat_discard(post)
+        self.quarantined.discard(post.post_id)
+        self.tokens_remove(post)
+        post.store = None
+
+    def chat_discard(self, post: Post):
+        ids = self.by_chat.get(post.chat_id)
+        if ids is not None:
+            ids.discard(post.post_id)
+            if not ids:
+                del self.by_chat[post.chat_id]
+
+    def remove(self, post):
+        with self.lock:
+            if self.by_id.get(post.get("post_id")) is not post:
+                raise ValueError("post not in store")
+            self.index_remove(post)
+            self.unlink(post)
+
+    def pop(self, idx: int = -1) -> Post:
+        with self.lock:
+            post = self[idx]
+            self.remove(post)
+            return post
+
+    def clear(self):
+        with self.lock:
+            for post in self.by_id.values():
+                post.store = None
+            self.by_id = {}
+            self.by_key = {}
+            self.by_chat = {}
+            self.quarantined = set()
+            self.tokens = None
+            self.keys = []
+            self.by_deadline = []
+
+    def __getitem__(self, idx):
+        """وصول بالموقع (O(n)) للتوافق فقط؛ المعالجات تستخدم get(post_id)."""
+        with self.lock:
+            return list(self.by_id.values())[idx]
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        # نسخة ثابتة: التكرار آمن أثناء الإضافة والحذف من خيوط أخرى
+        with self.lock:
+            return iter(list(self.by_id.values()))
+
+    def __contains__(self, post):
+        return self.by_id.get(post.get("post_id")) is post
+
+    def field_changed(self, post: Post, key: str, value):
+        """تعديل حقل مفهرس مع تحديث الفهارس المتأثرة."""
+        with self.lock:
+            if key == "post_date":
+                self.index_remove(post)
+                post.post_date = value
+                self.index_add(post)
+            elif key == "post_text":
+                self.tokens_remove(post)
+                post.post_text = value
+                self.tokens_add(post)
+            elif key == "post_quarantine":
+                post.post_quarantine = value
+                if value:
+                    self.quarantined.add(post.post_id)
+                else:
+                    self.quarantined.discard(post.post_id)
+            elif key == "post_id":
+                if value == post.post_id:
+                    return
+                if value in self.by_id:
+                    raise ValueError(f"duplicate post_id {value}")
+                self.index_remove(post)
+                self.unlink(post)
+                post.post_id = value
+                self.append(post)
+            else:
+                old_key = (post.chat_id, post.message_id)
+                if self.by_key.get(old_key) is post:
+                    del self.by_key[old_key]
+                self.chat_discard(post)
+                setattr(post, key, value)
+                self.by_key[(post.chat_id, post.message_id)] = post
+                self.by_chat.setdefault(post.chat_id, set()).add(post.post_id)
+
+    # --- فهرس كلمات البحث ---
+    def tokens_add(self, post: Post):
+        if self.tokens is not None:
+            for token in search_tokens(post.post_text):
+                self.tokens.setdefault(token, set()).add(post.post_id)
+
+    def tokens_remove(self, post: Post):
+        if self.tokens is not None:
+            for token in search_tokens(post.post_text):
+                ids = self.tokens.get(token)
+                if ids is not None:
+                    ids.discard(post.post_id)
+                    if not ids:
+                        del self.tokens[token]
+
+    def matching(self, chat_id=None, words=()):
+        """معرفات المنشورات المطابقة للقناة وكل كلمات البحث، أو None إذا لم يوجد فلتر."""
+        with self.lock:
+            sets = []
+            if chat_id is not None:
+                sets.append(self.by_chat.get(chat_id, set()))
+            if words:
+                if self.tokens is None:
+                    self.tokens = {}
+                    for post in self.by_id.values():
+                        self.tokens_add(post)
+                sets.extend(self.tokens.get(word, set()) for word in words)
+            if not sets:
+                return None
+            sets.sort(key=len)
+            result = set(sets[0])
+            for ids in sets[1:]:
+                result &= ids
+            return result
+
+    # --- فهرس المواعيد ---
+    def index_add(self, post: Post):
+        key = (post.deadline, post.post_id)
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.by_deadline.insert(i, post)
+
+    def index_remove(self, post: Post):
+        i = bisect.bisect_left(self.keys, (post.deadline, post.post_id))
+        if i < len(self.by_deadline) and self.by_deadline[i] is post:
+            del self.keys[i]
+            del self.by_deadline[i]
+
+    def position(self, ts: float) -> int:
+        """موقع أول منشور موعده بعد ts في فهرس المواعيد."""
+        return bisect.bisect_right(self.keys, (ts, math.inf))
+
+    def cutoff(self, now: datetime.datetime) -> int:
+        """عدد المنشورات المنتهية (موعدها <= now) = بداية المنشورات النشطة في الفهرس."""
+        return self.position(now.timestamp())
+
+    def active_count(self, now: datetime.datetime) -> int:
+        with self.lock:
+            return len(self.keys) - self.cutoff(now)
+
+    def active(self, now: datetime.datetime) -> list:
+        """المنشورات النشطة مرتبة من الأقرب انتهاءً."""
+        with self.lock:
+            return self.by_deadline[self.cutoff(now):]
+
+    def expired(self, now: datetime.datetime) -> list:
+        with self.lock:
+            return self.by_deadline[:self.cutoff(now)]
+
+    def next_expiring(self, now: datetime.datetime, limit: int) -> list:
+        with self.lock:
+            start = self.cutoff(now)
+            return self.by_deadline[start:start + limit]
+
+    def remove_expired(self, now: datetime.datetime) -> list:
+        """حذف كل المنشورات المنتهية دفعة واحدة (قطع بداية فهرس المواعيد)."""
+        with self.lock:
+            end = self.cutoff(now)
+            expired = self.by_deadline[:end]
+            if not expired:
+                return []
+            del self.keys[:end]
+            del self.by_deadline[:end]
+            for post in expired:
+                self.unlink(post)
+            return expired
+
+    def page(self, now: datetime.datetime, view: str = "all", chat_id=None, words=(), after=None, limit: int = 10):
+        """صفحة مرتبة بالموعد تبدأ بعد المؤشر after=(deadline, post_id).
+
+        view: all | active | expired | soon | quarantined. يعيد (المنشورات، مؤشر الصفحة التالية أو None).
+        بدون قناة أو بحث تكلف الصفحة O(log n + limit) مهما كان عدد المنشورات.
+        """
+        with self.lock:
+            lo, hi = 0, len(self.keys)
+            if view in ("active", "soon"):
+                lo = self.cutoff(now)
+            elif view == "expired":
+                hi = self.cutoff(now)
+            if view == "soon":
+                hi = self.position(now.timestamp() + EXPIRING_SOON.total_seconds())
+            if after is not None:
+                lo = max(lo, bisect.bisect_right(self.keys, tuple(after)))
+            if lo >= hi:
+                return [], None
+
+            candidates = self.matching(chat_id, words)
+            if view == "quarantined":
+                candidates = set(self.quarantined) if candidates is None else candidates & self.quarantined
+            if candidates is None:
+                items = self.by_deadline[lo:min(hi, lo + limit + 1)]
+            elif len(candidates) <= SEARCH_SORT_LIMIT:
+                # نتائج قليلة: ترتيبها مباشرة أرخص من المرور على الفهرس
+                ordered = sorted((self.by_id[i].deadline, i) for i in candidates)
+                start = bisect.bisect_left(ordered, self.keys[lo])
+                end = bisect.bisect_right(ordered, self.keys[hi - 1])
+                items = [self.by_id[i] for _, i in ordered[start:min(end, start + limit + 1)]]
+            else:
+                items = []
+                for i in range(lo, hi):
+                    if self.by_deadline[i].post_id in candidates:
+                        items.append(self.by_deadline[i])
+                        if len(items) > limit:
+                            break
+
+            if len(items) <= limit:
+                return items, None
+            last = items[limit - 1]
+            return items[:limit], (last.deadline, last.post_id)
+
+    def label_groups(self, now: datetime.datetime):
+        """(منشورات، نص الزر) لكل مجموعة منشورات نشطة يعرض زرها النص نفسه بالدقة العامة.
+
+        النص يُحسب مرة واحدة لكل مجموعة، وحدود المجموعات تُوجد بـ bisect على الفهرس.
+        المنشورات ذات الدقة الخاصة تُعاد كل منها في مجموعة وحدها.
+        """
+        policy = countdown_resolution()
+        with self.lock:
+            start = self.cutoff(now)
+            keys = self.keys[start:]
+            by_deadline = self.by_deadline[start:]
+        now_ts = now.timestamp()
+        i, n = 0, len(by_deadline)
+        while i < n:
+            post_date = by_deadline[i].post_date
+            remaining = (post_date - now).total_seconds()
+            # حد تغيّر النص التالي: كل المنشورات قبله تحمل النص نفسه
+            bucket_end = policy.bucket_end(remaining)
+            boundary_ts = now_ts + bucket_end
+            end = i + 1
+            if end < n and keys[end][0] < boundary_ts:
+                end = bisect.bisect_left(keys, (boundary_ts,), end + 1)
+                # تصحيح تقريب الأعداد العشرية عند الحد تمامًا
+                boundary = now + datetime.timedelta(seconds=bucket_end)
+                while end > i + 1 and by_deadline[end - 1].post_date >= boundary:
+                    end -= 1
+            group = by_deadline[i:end]
+            label = policy.label(remaining)
+            if any(p.post_resolution for p in group):
+                shared = [p for p in group if not p.post_resolution]
+                if shared:
+                    yield shared, label
+                for p in group:
+                    if p.post_resolution:
+                        yield [p], countdown_label(p.post_date, now, p.post_resolution)
+            else:
+                yield group, label
+            i = end
+
+
+def search_tokens(text) -> set:
+    """كلمات النص بحروف صغيرة (تعمل مع العربية أيضًا)."""
+    return set(re.findall(r"\w+", (text or "").lower()))
+
+
+# نافذة فلتر "تنتهي قريبًا" في قائمة المنشورات
+EXPIRING_SOON = datetime.timedelta(hours=24)
+# عند بحث يطابق أقل من هذا العدد تُرتب النتائج مباشرة بدل المرور على فهرس المواعيد
+SEARCH_SORT_LIMIT = 4096
+
 # قائمة المنشورات المرسلة
-posts = []
+posts = PostStore()
 
 # متغيرات لتخزين بيانات المؤقت
 target_date = None
@@ -40,14 +504,53 @@ timer_chat_id = None
 timer_active = False
 custom_end_message = "✅ تم الوصول إلى اليوم المحدد"
 button_link = ""  # سيتم اشتقاقه من CHANNEL_ID إذا لم يحدد الأدمن رابطًا صريحًا
+channels = []  # القنوات المضافة من لوحة الأدمن: [{"chat_id", "title", "link"}]
+
+# آخر نص ورابط تم دفعهما بنجاح لكل رسالة: (chat_id, message_id) -> (label, url)
+# يُستخدم لتجاهل التعديلات التي لا تغيّر شيئًا، ويُحفظ مع البيانات لتجنب موجة تعديلات بعد إعادة التشغيل
+render_cache = {}
+render_cache_lock = threading.Lock()
+
+
+def render_unchanged(chat_id, message_id, label: str, url: str) -> bool:
+    """هل الزر المعروض حاليًا على الرسالة مطابق لما نريد إرساله؟"""
+    with render_cache_lock:
+        return render_cache.get((chat_id, message_id)) == (label, url)
+
+
+def remember_render(chat_id, message_id, label: str, url: str):
+    """تسجيل آخر زر تم دفعه بنجاح إلى الرسالة."""
+    with render_cache_lock:
+        if render_cache.get((chat_id, message_id)) == (label, url):
+            return
+        render_cache[(chat_id, message_id)] = (label, url)
+    write_behind.mark(("render", chat_id, message_id), "render", (chat_id, message_id, label, url))
+
+
+def forget_render(chat_id, message_id):
+    """إزالة الرسالة من الذاكرة (عند حذفها أو تعديلها بطريقة تمسح الزر)."""
+    with render_cache_lock:
+        if render_cache.pop((chat_id, message_id), None) is None:
+            return
+    write_behind.mark(("render", chat_id, message_id), "render_forget", (chat_id, message_id))
 
 
-def effective_button_url(explicit: str = None) -> str:
+def is_not_modified(error) -> bool:
+    """Telegram يرفض التعديل إذا كان الزر مطابقًا لما هو معروض، وهذه حالة نجاح بالنسبة لنا."""
+    return 'message is not modified' in str(error).lower()
+
+
+def effective_button_url(explicit: str = None, chat_id=None) -> str:
     """Return the URL to use for inline buttons.
-    Priority: explicit (post-specific) -> saved button_link -> derived from CHANNEL_ID -> empty string
+    Priority: explicit (post-specific) -> the post's own channel (when not CHANNEL_ID) -> saved button_link
+    -> derived from CHANNEL_ID -> empty string
     """
     if explicit:
         return explicit
+    if chat_id is not None and chat_id != CHANNEL_ID:
+        link = channel_link(chat_id)
+        if link:
+            return link
     if button_link:
         return button_link
     if CHANNEL_ID:
@@ -60,148 +563,1460 @@ def effective_button_url(explicit: str = None) -> str:
             return cid
     return ""
 
+
+# --- سجل القنوات ---
+# القناة الافتراضية CHANNEL_ID أولاً، ثم القنوات في CHANNEL_IDS (مفصولة بفواصل)، ثم القنوات التي يضيفها الأدمن
+# (تُحفظ مع الإعدادات). المسودة الواحدة تُنشر في أي عدد منها، وزر كل منشور يشير إلى رابط قناته.
+CHANNEL_IDS = os.getenv("CHANNEL_IDS", "")
+
+
+def parse_chat_id(value):
+    """معرف محادثة رقمي كعدد صحيح، واسم المستخدم (@name) كما هو.
+
+    كل معرف محادثة يدخل من الإعدادات أو الملفات أو الأدمن يمر بها، حتى لا تصبح "-100123" و -100123
+    قناتين مختلفتين (مفتاحان في الفهارس ودلوان مستقلان في حد التعديل).
+    """
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip()
+    return int(value) if value.lstrip("-").isdigit() else value
+
+
+CHANNEL_ID = parse_chat_id(CHANNEL_ID)
+
+
+def channel_registry() -> list:
+    """كل القنوات المتاحة للنشر بلا تكرار: [{"chat_id", "title", "link"}]."""
+    entries = []
+    seen = set()
+    configured = [{"chat_id": CHANNEL_ID}] + [{"chat_id": parse_chat_id(c)} for c in CHANNEL_IDS.split(",") if c.strip()]
+    for entry in configured + channels:
+        if entry.get("chat_id") and entry["chat_id"] not in seen:
+            seen.add(entry["chat_id"])
+            entries.append(entry)
+    return entries
+
+
+def parse_channels(entries) -> list:
+    """قنوات محفوظة بمعرفات موحدة (ملفات قديمة قد تحفظ المعرف الرقمي كنص)."""
+    return [{**entry, "chat_id": parse_chat_id(entry.get("chat_id"))} for entry in entries]
+
+
+def channel_title(chat_id) -> str:
+    for entry in channels:
+        if entry["chat_id"] == chat_id and entry.get("title"):
+            return entry["title"]
+    return str(chat_id)
+
+
+def channel_link(chat_id) -> str:
+    """رابط زر القناة: المحفوظ لها في السجل، أو المشتق من @name."""
+    for entry in channels:
+        if entry["chat_id"] == chat_id and entry.get("link"):
+            return entry["link"]
+    if isinstance(chat_id, str) and chat_id.startswith('@'):
+        return f"https://t.me/{chat_id.lstrip('@')}"
+    return ""
+
+# --- Bot مشترك بتجمع اتصالات دائم ---
+# كل المعالجات والمهام المجدولة تستخدم نفس الـ Bot، فتُعاد الاتصالات المفتوحة بدلاً من مصافحة TLS جديدة
+# حجم التجمع يجب أن يغطي كل الخيوط التي تطلب Bot API في الوقت نفسه، وإلا يغلق urllib3 الاتصالات الزائدة
+# ("pool is full") فتضيع فائدة keep-alive. افتراضيًا (0) يُحسب من أعداد العمال المضبوطة: عمال dispatcher (4)
+# + خيوط Updater (الاستقبال، JobQueue، الرئيسي، الجدولة) + عمال التحديث والانتهاء وإعادة المحاولة + عمال
+# الاستيراد الجماعي (بعدد عمال التحديث) + مسارات webhook في وضع webhook
+BOT_POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", "0"))
+
+shared_bot = None
+shared_bot_lock = threading.Lock()
+
+
+def bot_pool_size() -> int:
+    if BOT_POOL_SIZE > 0:
+        return BOT_POOL_SIZE
+    webhook_lanes = WEBHOOK_WORKERS if UPDATE_MODE == "webhook" else 0
+    return 4 + 4 + 2 * EDIT_WORKERS + EXPIRY_WORKERS + RETRY_WORKERS + webhook_lanes
+
+
+def get_bot() -> Bot:
+    """إرجاع الـ Bot المشترك (يُنشأ مرة واحدة)."""
+    global shared_bot
+    with shared_bot_lock:
+        if shared_bot is None:
+            shared_bot = ExtBot(
+                BOT_TOKEN,
+                request=TracedRequest(con_pool_size=bot_pool_size()),
+                defaults=Defaults(timeout=30),
+            )
+        return shared_bot
+
+
+def bot_pool_stats() -> dict:
+    """إحصائيات إعادة استخدام الاتصالات في تجمع الـ Bot المشترك."""
+    stats = {"pool_size": bot_pool_size(), "requests": 0, "connections": 0, "reused": 0, "reuse_ratio": 0.0}
+    if shared_bot is None:
+        return stats
+    try:
+        pool_manager = shared_bot.request._con_pool
+        for key in list(pool_manager.pools.keys()):
+            pool = pool_manager.pools.get(key)
+            if pool is not None:
+                stats["requests"] += pool.num_requests
+                stats["connections"] += pool.num_connections
+    except AttributeError:
+        # تفاصيل داخلية في urllib3 المضمّن قد تتغير بين الإصدارات
+        return stats
+    stats["reused"] = max(0, stats["requests"] - stats["connections"])
+    if stats["requests"]:
+        stats["reuse_ratio"] = stats["reused"] / stats["requests"]
+    return stats
+
+
+def log_bot_pool_stats():
+    stats = bot_pool_stats()
+    logging.info(
+        f"bot pool: {stats['requests']} طلب عبر {stats['connections']} اتصال "
+        f"(إعادة استخدام {stats['reuse_ratio']:.0%}، حجم التجمع {stats['pool_size']})"
+    )
+
+
+# --- مقاييس بصيغة Prometheus ---
+# نقطة HTTP محلية اختيارية (METRICS_PORT) تعرض /metrics لقياس حدود المعدل واكتشاف القنوات المتعثرة.
+# التسجيل في الذاكرة رخيص ويعمل دائمًا، والخادم لا يبدأ إلا إذا حُدد المنفذ.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STALENESS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Metrics:
+    """عدادات ومقاييس لحظية ومدرجات تكرارية (histogram) بتسميات اختيارية."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}  # name -> (type, help, buckets)
+        self.values = {}  # name -> {labels: value أو [counts, sum, count]}
+        self.collectors = []
+
+    def describe(self, name: str, kind: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.meta[name] = (kind, help_text, buckets)
+        self.values.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.meta[name][2]
+        with self.lock:
+            series = self.values[name]
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [[0] * len(buckets), 0.0, 0]
+            idx = bisect.bisect_left(buckets, value)
+            if idx < len(buckets):
+                entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def format_labels(key, extra=()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        """النص بصيغة Prometheus exposition 0.0.4."""
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception:
+                logging.exception("metrics collector failed")
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in self.meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in self.values[name].items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{self.format_labels(key)} {value}")
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{self.format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self.format_labels(key, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self.format_labels(key)} {total}")
+                    lines.append(f"{name}_count{self.format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("countdown_edit_seconds", "histogram", "Latency of edit_message_reply_markup calls by outcome.")
+metrics.describe("countdown_edit_errors_total", "counter", "Failed button edits by chat and error type.")
+metrics.describe("countdown_pass_seconds", "histogram", "Duration of a countdown update pass.")
+metrics.describe("countdown_pass_backlog", "gauge", "Edits queued in the most recent update pass.")
+metrics.describe("countdown_staleness_seconds", "histogram", "Delay between rendering a countdown label and Telegram accepting it.", STALENESS_BUCKETS)
+metrics.describe("countdown_scheduled_posts", "gauge", "Posts currently tracked by the countdown scheduler.")
+metrics.describe("countdown_posts", "gauge", "Posts held in memory.")
+metrics.describe("save_data_seconds", "histogram", "Duration of save_data checkpoints.")
+metrics.describe("storage_file_bytes", "gauge", "Size of the persistence files on disk.")
+metrics.describe("schedule_job_lag_seconds", "histogram", "How late schedule jobs start relative to their planned run time.")
+metrics.describe("bot_pool_requests_total", "counter", "HTTP requests sent through the shared Bot connection pool.")
+metrics.describe("bot_pool_connections_total", "counter", "Connections opened by the shared Bot connection pool.")
+metrics.describe("persist_flush_seconds", "histogram", "Duration of a write-behind flush batch.")
+metrics.describe("persist_writes_total", "counter", "Entity writes performed by write-behind flushes.")
+metrics.describe("persist_coalesced_total", "counter", "Changes merged into an already pending write.")
+metrics.describe("persist_pending", "gauge", "Changes waiting for the next write-behind flush.")
+metrics.describe("expiry_fire_lag_seconds", "histogram", "Delay between a deadline and its expiry timer firing.")
+metrics.describe("retry_fire_lag_seconds", "histogram", "Delay between a scheduled edit retry and its worker picking it up.")
+metrics.describe("edit_breaker_trips_total", "counter", "Circuit breaker openings by scope.")
+metrics.describe("edit_breaker_skipped_total", "counter", "Button edits skipped because their chat breaker is open or a retry is pending.")
+metrics.describe("edit_breakers_open", "gauge", "Chat circuit breakers currently open.")
+metrics.describe("edit_retries_total", "counter", "Queued edit retries executed by the retry workers, by outcome.")
+metrics.describe("edit_retry_pending", "gauge", "Messages waiting in the durable edit retry queue.")
+metrics.describe("edit_dead_letters_total", "counter", "Edits moved to the dead-letter file after exhausting their retries.")
+metrics.describe("edit_dead_letters", "gauge", "Entries currently in the dead-letter file.")
+metrics.describe("posts_quarantined", "gauge", "Posts whose message stopped accepting edits and await an admin.")
+metrics.describe("expiry_edit_lag_seconds", "histogram", "Delay between a post deadline and Telegram accepting the end message.")
+metrics.describe("webhook_requests_total", "counter", "Webhook requests by HTTP response status.")
+metrics.describe("webhook_queue_seconds", "histogram", "Time an accepted webhook update waits for its worker lane.")
+metrics.describe("startup_phase_seconds", "gauge", "Duration of each startup phase.")
+metrics.describe("startup_mark_seconds", "gauge", "Seconds from process start to each startup milestone.")
+
+
+def edit_outcome(error) -> str:
+    """تصنيف نتيجة تعديل زر لتسمية المقاييس (BadRequest قبل NetworkError لأنه فرع منه)."""
+    if error is None:
+        return "ok"
+    if isinstance(error, RetryAfter):
+        return "retry_after"
+    if isinstance(error, BadRequest):
+        return "not_modified" if is_not_modified(error) else "bad_request"
+    if isinstance(error, Unauthorized):
+        return "unauthorized"
+    if isinstance(error, NetworkError):
+        return "network_error"
+    return "error"
+
+
+def record_edit(chat_id, started: float, error=None):
+    outcome = edit_outcome(error)
+    metrics.observe("countdown_edit_seconds", time.monotonic() - started, outcome=outcome)
+    if outcome == "ok":
+        report_first_update()
+    elif outcome != "not_modified":
+        metrics.inc("countdown_edit_errors_total", chat=chat_id, outcome=outcome)
+
+
+def run_pending_jobs():
+    """schedule.run_pending مع تسجيل تأخر كل مهمة مستحقة عن موعدها وspan لتنفيذها."""
+    now = datetime.datetime.now()
+    for job in sorted(job for job in schedule.jobs if job.should_run):
+        name = callable_name(job.job_func)
+        lag = (now - job.next_run).total_seconds()
+        metrics.observe("schedule_job_lag_seconds", lag, job=name)
+        with tracer.span("job", name, lag):
+            result = job.run()
+        if result is schedule.CancelJob or isinstance(result, schedule.CancelJob):
+            schedule.cancel_job(job)
+
+
+# آخر قيم تجمع الاتصالات المضافة للعدادات: القيم في urllib3 تراكمية، وتنقص إذا أُسقط تجمع مضيف
+bot_pool_counted = {"requests": 0, "connections": 0}
+bot_pool_counted_lock = threading.Lock()
+
+
+def collect_runtime_metrics():
+    metrics.set("countdown_posts", len(posts))
+    metrics.set("countdown_scheduled_posts", len(countdown_scheduler.entries))
+    metrics.set("posts_quarantined", len(posts.quarantined))
+    metrics.set("edit_breakers_open", edit_health.chats.open_count(), scope="chat")
+    metrics.set("edit_retry_pending", len(retry_queue.entries))
+    metrics.set("edit_dead_letters", retry_queue.dead_count)
+    metrics.set("persist_pending", write_behind.pending_count())
+    for path in (DATA_FILE, JOURNAL_FILE, SQLITE_FILE, SQLITE_FILE + "-wal"):
+        if os.path.exists(path):
+            metrics.set("storage_file_bytes", os.path.getsize(path), file=path)
+    pool = bot_pool_stats()
+    with bot_pool_counted_lock:
+        for name in ("requests", "connections"):
+            metrics.inc(f"bot_pool_{name}_total", max(0, pool[name] - bot_pool_counted[name]))
+            bot_pool_counted[name] = pool[name]
+
+
+metrics.collectors.append(collect_runtime_metrics)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port: int = None):
+    """تشغيل خادم /metrics في خيط خلفي إذا كان METRICS_PORT محددًا."""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"✅ المقاييس متاحة على http://{METRICS_HOST}:{port}/metrics")
+    return server
+
+
+# --- توقيت الإقلاع ---
+# كل مرحلة من بدء التشغيل تُقاس (startup_phase_seconds)، والمعالم مثل بدء استقبال التحديثات وأول تعديل
+# ناجح لزر تُقاس منذ بدء العملية (startup_mark_seconds). الملخص يُطبع مرة واحدة عند أول تعديل.
+class StartupTimeline:
+    """أزمنة مراحل بدء التشغيل بترتيبها، وزمن كل معلم منذ بدء العملية."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.lock = threading.Lock()
+        self.phases = []  # (name, seconds)
+        self.marks = {}  # name -> ثوانٍ منذ بدء العملية
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def record(self, name: str, seconds: float):
+        with self.lock:
+            self.phases.append((name, seconds))
+        metrics.set("startup_phase_seconds", round(seconds, 4), phase=name)
+
+    def mark(self, name: str) -> bool:
+        """تسجيل معلم مرة واحدة فقط؛ يعيد True عند أول تسجيل."""
+        if name in self.marks:
+            return False
+        with self.lock:
+            if name in self.marks:
+                return False
+            self.marks[name] = elapsed = time.monotonic() - self.started
+        metrics.set("startup_mark_seconds", round(elapsed, 4), mark=name)
+        return True
+
+    def summary(self) -> str:
+        with self.lock:
+            parts = [f"{name} {seconds:.3f}s" for name, seconds in self.phases]
+            parts += [f"{name} عند {at:.3f}s" for name, at in self.marks.items()]
+        return "، ".join(parts)
+
+
+startup = StartupTimeline(PROCESS_STARTED)
+
+
+@contextmanager
+def gc_paused():
+    """إيقاف جمع القمامة مؤقتًا أثناء إنشاء كائنات كثيرة باقية (لن تحرر الجولات منها شيئًا)."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# --- تتبع زمن التحديثات والمهام ---
+# TRACE_FILE يفعّل تسجيل span لكل تحديث وارد ولكل مهمة مجدولة (مهام schedule، تمريرات جدول الأزرار، مؤقتات الانتهاء
+# وإعادة المحاولة) كسطر JSON في ملف يُدوَّر عند TRACE_MAX_BYTES. كل span يفصل زمن الانتظار قبل البدء (الطابور
+# للتحديثات، والتأخر عن الموعد للمهام) عن زمن المعالج وزمن Bot API وزمن الحفظ. زمن Bot API لتمريرة الأزرار
+# مجموع طلبات العمال المتوازية، فقد يتجاوز زمن التمريرة نفسها. بدون TRACE_FILE لا يُغلَّف شيء.
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv("TRACE_BACKUPS", "3"))
+# أقصى عدد تحديثات مستلمة تنتظر المعالجة نحتفظ بوقت استلامها (تحديث لا يُعالج أبدًا لا يبقى للأبد)
+TRACE_PENDING_MAX = int(os.getenv("TRACE_PENDING_MAX", "10000"))
+
+
+class Span:
+    """تحديث أو مهمة واحدة قيد التنفيذ: الأزمنة بالثواني."""
+
+    __slots__ = ("kind", "name", "handler", "started", "wall", "queue", "api", "api_calls", "persist", "error")
+
+    def __init__(self, kind: str, name: str, queue: float):
+        self.kind = kind
+        self.name = name
+        self.handler = None
+        self.started = time.monotonic()
+        self.wall = datetime.datetime.now()
+        self.queue = queue
+        self.api = 0.0
+        self.api_calls = 0
+        self.persist = 0.0
+        self.error = None
+
+
+class Tracer:
+    """span واحد على الأكثر لكل خيط؛ ما يبدأ داخل span قائم يُحتسب ضمنه."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.enabled = bool(path)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.received = {}  # update_id -> وقت الاستلام (monotonic)
+        self.logger = logging.getLogger("trace")
+        if self.enabled:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def current(self) -> Span:
+        return getattr(self.local, "span", None)
+
+    @contextmanager
+    def span(self, kind: str, name: str, queue: float = 0.0):
+        if not self.enabled or self.current() is not None:
+            yield
+            return
+        span = self.local.span = Span(kind, name, queue)
+        try:
+            yield
+        except Exception as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            self.local.span = None
+            self.write(span, time.monotonic() - span.started)
+
+    @contextmanager
+    def attached(self, span: Span):
+        """تنفيذ عمل في خيط آخر لحساب span قائم (عمال تمريرة الأزرار)."""
+        previous = self.current()
+        self.local.span = span
+        try:
+            yield
+        finally:
+            self.local.span = previous
+
+    def bind(self, func):
+        """func مربوطة بـ span الخيط الحالي، لتُنفذ في خيط آخر (أو func كما هي إن لم يوجد)."""
+        span = self.current()
+        if span is None:
+            return func
+
+        @wraps(func)
+        def bound(*args, **kwargs):
+            with self.attached(span):
+                return func(*args, **kwargs)
+        return bound
+
+    def add(self, field: str, seconds: float):
+        span = self.current()
+        if span is not None:
+            with self.lock:
+                setattr(span, field, getattr(span, field) + seconds)
+                if field == "api":
+                    span.api_calls += 1
+
+    @contextmanager
+    def timed(self, field: str):
+        if self.current() is None:
+            yield
+            return
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(field, time.monotonic() - started)
+
+    def name(self, handler: str):
+        """اسم المعالج الفعلي للـ span الحالي (أول معالج يُسجَّل، فلا يغطي الغلاف ما بداخله)."""
+        span = self.current()
+        if span is not None and span.handler is None:
+            span.handler = handler
+
+    def fail(self, reason: str):
+        span = self.current()
+        if span is not None:
+            span.error = reason
+
+    def update_received(self, update, received: float = None):
+        if self.enabled and isinstance(update, Update):
+            with self.lock:
+                self.received[update.update_id] = time.monotonic() if received is None else received
+                # الأقدم أولاً (ترتيب الإدراج)
+                while len(self.received) > TRACE_PENDING_MAX:
+                    del self.received[next(iter(self.received))]
+
+    def write(self, span: Span, total: float):
+        record = {
+            "ts": span.wall.isoformat(timespec="milliseconds"),
+            "kind": span.kind,
+            "name": span.name,
+            "handler": span.handler,
+            "queue_ms": round(span.queue * 1000, 2),
+            "total_ms": round(total * 1000, 2),
+            "handler_ms": round(max(0.0, total - span.api - span.persist) * 1000, 2),
+            "api_ms": round(span.api * 1000, 2),
+            "api_calls": span.api_calls,
+            "persist_ms": round(span.persist * 1000, 2),
+        }
+        if span.error:
+            record["error"] = span.error
+        self.logger.info(json.dumps(record, ensure_ascii=False))
+
+
+tracer = Tracer(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUPS)
+
+
+class TracedRequest(Request):
+    """Request يضيف زمن كل طلب Bot API إلى span الخيط الحالي."""
+
+    def post(self, *args, **kwargs):
+        if not tracer.enabled:
+            return super().post(*args, **kwargs)
+        with tracer.timed("api"):
+            return super().post(*args, **kwargs)
+
+
+class TracedUpdateQueue(queue.Queue):
+    """طابور تحديثات dispatcher يسجل وقت استلام كل تحديث (لحساب انتظاره قبل المعالجة)."""
+
+    def put(self, item, block=True, timeout=None):
+        tracer.update_received(item)
+        super().put(item, block, timeout)
+
+
+def update_span_name(update) -> str:
+    if not isinstance(update, Update):
+        return type(update).__name__
+    if update.callback_query:
+        return "callback_query"
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith("/"):
+        return message.text.split()[0].split("@")[0]
+    return "message" if message is not None else "update"
+
+
+def trace_update(process_update, update):
+    """غلاف dispatcher.process_update: span لكل تحديث من استلامه حتى انتهاء معالجاته."""
+    received = tracer.received.pop(getattr(update, "update_id", None), None)
+    queued = time.monotonic() - received if received is not None else 0.0
+    with tracer.span("update", update_span_name(update), queued):
+        return process_update(update)
+
+
+class TracedDispatcher(Dispatcher):
+    """Dispatcher يلف process_update بـ span (يُمرَّر إلى Updater عند تفعيل التتبع)."""
+
+    def process_update(self, update) -> None:
+        trace_update(super().process_update, update)
+
+
+def callable_name(func) -> str:
+    func = getattr(func, "func", func)  # partial
+    return getattr(func, "__name__", repr(func))
+
+
+def traced_callback(func):
+    @wraps(func)
+    def wrapped(update, context, *args, **kwargs):
+        tracer.name(callable_name(func))
+        return func(update, context, *args, **kwargs)
+    return wrapped
+
+
+def trace_handlers(handlers):
+    """تسمية span التحديث باسم المعالج الذي تولاه (بما فيها معالجات حالات المحادثة)."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            trace_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                trace_handlers(state_handlers)
+            trace_handlers(handler.fallbacks)
+        elif not isinstance(handler, CallbackRouteHandler):  # جدول التوجيه يسمي الإجراء بنفسه
+            handler.callback = traced_callback(handler.callback)
+
+
+def create_updater(bot) -> Updater:
+    """Updater عادي، أو مع TracedDispatcher وطابور يسجل وقت الاستلام عند تفعيل التتبع."""
+    if not tracer.enabled:
+        return Updater(bot=bot, use_context=True)
+    job_queue = JobQueue()
+    dispatcher = TracedDispatcher(bot, TracedUpdateQueue(), job_queue=job_queue, exception_event=threading.Event(),
+                                  use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def trace_dispatcher(updater: Updater):
+    """تسمية spans التحديثات بمعالجاتها (بعد تسجيل كل المعالجات وقبل بدء الاستقبال)."""
+    if not tracer.enabled:
+        return
+    for group in updater.dispatcher.handlers.values():
+        trace_handlers(group)
+    print(f"✅ تتبع زمن التحديثات والمهام مفعّل: {TRACE_FILE}")
+
+
 # --- دوال حفظ واسترجاع البيانات ---
-def save_data():
-    """حفظ الحالة الحالية في ملف JSON."""
+# طبقة التخزين قابلة للتبديل عبر STORAGE_BACKEND:
+#   json   : data.json لقطة كاملة تُكتب ذريًا، وكل تغيير بعدها يُضاف كسطر JSON في السجل (journal).
+#            التحميل = قراءة اللقطة ثم إعادة تطبيق السجل، والضغط = كتابة لقطة جديدة ثم تفريغ السجل.
+#   sqlite : قاعدة SQLite بوضع WAL مع فهارس على تاريخ الانتهاء وهوية الرسالة.
+# في الحالتين يبقى ملف JSON صيغة الاستيراد والتصدير.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "data.journal")
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "1000"))
+SQLITE_FILE = os.getenv("SQLITE_FILE", "data.db")
+
+
+def serialize_post(p) -> dict:
+    return {
+        "post_id": p.get("post_id"),
+        "chat_id": p.get("chat_id"),
+        "message_id": p.get("message_id"),
+        "post_text": p.get("post_text"),
+        "post_link": p.get("post_link"),
+        "post_media": p.get("post_media"),
+        "post_date": p.get("post_date").isoformat() if p.get("post_date") else None,
+        "post_resolution": p.get("post_resolution"),
+        "post_quarantine": p.get("post_quarantine"),
+    }
+
+
+def deserialize_post(p) -> Post:
+    if isinstance(p, Post):
+        return p
+    pd = p.get("post_date")
+    return Post(
+        post_id=p.get("post_id"),
+        chat_id=p.get("chat_id"),
+        message_id=p.get("message_id"),
+        post_text=p.get("post_text"),
+        post_link=p.get("post_link"),
+        post_media=p.get("post_media"),
+        post_date=datetime.datetime.fromisoformat(pd) if pd else None,
+        post_resolution=p.get("post_resolution"),
+        post_quarantine=p.get("post_quarantine"),
+    )
+
+
+def find_post(chat_id, message_id):
+    return posts.find(chat_id, message_id)
+
+
+def timer_state() -> dict:
+    return {
+        "target_date": target_date.isoformat() if target_date else None,
+        "timer_message_id": timer_message_id,
+        "timer_chat_id": timer_chat_id,
+        "timer_active": timer_active
+    }
+
+
+def settings_state() -> dict:
+    return {
+        "custom_end_message": custom_end_message,
+        "button_link": button_link,
+        "channels": channels,
+    }
+
+
+def build_snapshot() -> dict:
+    """بناء لقطة كاملة للحالة بصيغة data.json."""
     # الهيكل الجديد للملف (بدون timer و settings كأقسام منفصلة)
     data = {
-        "posts": [
-            {
-                "chat_id": p.get("chat_id"),
-                "message_id": p.get("message_id"),
-                "post_text": p.get("post_text"),
-                "post_link": p.get("post_link"),
-                "post_media": p.get("post_media"),
-                "post_date": p.get("post_date").isoformat() if p.get("post_date") else None,
-            }
-            for p in posts
-        ],
+        "posts": [serialize_post(p) for p in posts],
         "metadata": {
             "total_posts": len(posts),
             "active_posts": get_active_posts_count(),
             "created_at": datetime.datetime.now().isoformat(),
+            "next_post_id": posts.next_id,
             "version": "2.1"
         }
     }
 
     # إضافة بيانات المؤقت والإعدادات فقط إذا كانت متوفرة وليست افتراضية
     if target_date or timer_message_id or timer_chat_id or timer_active:
-        data["timer"] = {
-            "target_date": target_date.isoformat() if target_date else None,
-            "timer_message_id": timer_message_id,
-            "timer_chat_id": timer_chat_id,
-            "timer_active": timer_active
-        }
+        data["timer"] = timer_state()
 
-    if custom_end_message != "✅ تم الوصول إلى اليوم المحدد" or button_link:
-        data["settings"] = {
-            "custom_end_message": custom_end_message,
-            "button_link": button_link
-        }
+    if custom_end_message != "✅ تم الوصول إلى اليوم المحدد" or button_link or channels:
+        data["settings"] = settings_state()
 
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+    with render_cache_lock:
+        if render_cache:
+            data["render_cache"] = [
+                {"chat_id": chat_id, "message_id": message_id, "label": label, "url": url}
+                for (chat_id, message_id), (label, url) in render_cache.items()
+            ]
+    return data
 
-def load_data():
-    """تحميل الحالة من ملف JSON عند بدء التشغيل."""
-    global target_date, timer_message_id, timer_chat_id, timer_active, custom_end_message, button_link
+
+def apply_snapshot(data: dict):
+    """تحميل الحالة من لقطة بصيغة data.json (الهيكل الجديد أو القديم)."""
+    global target_date, timer_message_id, timer_chat_id, timer_active, custom_end_message, button_link, channels
     global posts
-    try:
-        with open(DATA_FILE, "r") as f:
-            data = json.load(f)
-
-            # محاولة تحميل البيانات من الهيكل الجديد (بدون timer و settings)
-            # أو من الهيكل القديم (مع timer و settings)
-
-            # تحميل بيانات المؤقت (إذا كانت متوفرة)
-            timer_data = data.get("timer")
-            if timer_data:
-                date_str = timer_data.get("target_date")
-                if date_str:
-                    target_date = datetime.datetime.fromisoformat(date_str)
-
-                timer_message_id = timer_data.get("timer_message_id")
-                timer_chat_id = timer_data.get("timer_chat_id")
-                timer_active = timer_data.get("timer_active", False)
-            else:
-                # إعادة تعيين القيم الافتراضية إذا لم تكن متوفرة
-                target_date = None
-                timer_message_id = None
-                timer_chat_id = None
-                timer_active = False
-
-            # تحميل الإعدادات (إذا كانت متوفرة)
-            settings_data = data.get("settings")
-            if settings_data:
-                custom_end_message = settings_data.get("custom_end_message", "✅ تم الوصول إلى اليوم المحدد")
-                button_link = settings_data.get("button_link", "")
+
+    # تحميل بيانات المؤقت (إذا كانت متوفرة)
+    timer_data = data.get("timer")
+    if timer_data:
+        date_str = timer_data.get("target_date")
+        if date_str:
+            target_date = datetime.datetime.fromisoformat(date_str)
+
+        timer_message_id = timer_data.get("timer_message_id")
+        timer_chat_id = parse_chat_id(timer_data.get("timer_chat_id"))
+        timer_active = timer_data.get("timer_active", False)
+    else:
+        # إعادة تعيين القيم الافتراضية إذا لم تكن متوفرة
+        target_date = None
+        timer_message_id = None
+        timer_chat_id = None
+        timer_active = False
+
+    # تحميل الإعدادات (إذا كانت متوفرة)
+    settings_data = data.get("settings")
+    if settings_data:
+        custom_end_message = settings_data.get("custom_end_message", "✅ تم الوصول إلى اليوم المحدد")
+        button_link = settings_data.get("button_link", "")
+        channels = parse_channels(settings_data.get("channels", []))
+    else:
+        # استخدام القيم الافتراضية إذا لم تكن متوفرة
+        custom_end_message = "✅ تم الوصول إلى اليوم المحدد"
+        button_link = ""
+        channels = []
+
+    # تحميل المنشورات
+    posts = PostStore(deserialize_post(p) for p in data.get("posts", []))
+    # لا يُعاد استخدام معرف منشور محذوف (قد تشير إليه أزرار قديمة في المحادثة)
+    posts.next_id = max(posts.next_id, data.get("metadata", {}).get("next_post_id") or 1)
+
+    # تحميل ذاكرة آخر الأزرار المرسلة
+    with render_cache_lock:
+        render_cache.clear()
+        for entry in data.get("render_cache", []):
+            render_cache[(parse_chat_id(entry.get("chat_id")), entry.get("message_id"))] = (entry.get("label"), entry.get("url"))
+
+    # محاولة اشتقاق رابط القناة من CHANNEL_ID إذا لم يكن button_link محددًا
+    if not button_link and CHANNEL_ID:
+        if isinstance(CHANNEL_ID, str) and CHANNEL_ID.startswith('@'):
+            button_link = f"https://t.me/{CHANNEL_ID.lstrip('@')}"
+        elif isinstance(CHANNEL_ID, str) and CHANNEL_ID.startswith('http'):
+            button_link = CHANNEL_ID
+
+
+def write_json_atomic(path: str, data: dict):
+    """كتابة ملف JSON عبر ملف مؤقت ثم rename حتى لا يتلف الملف عند التعطل."""
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+class JsonStorage:
+    """لقطة data.json + سجل إلحاقي data.journal."""
+
+    def __init__(self, data_file: str, journal_file: str, compact_every: int):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.compact_every = compact_every
+        self.lock = threading.RLock()
+        self.handle = None
+        self.entries = 0
+        self.batching = False
+        self.startup_thread = None
+
+    def load(self):
+        try:
+            with open(self.data_file, "r") as f:
+                apply_snapshot(json.load(f))
+                print("✅ تم تحميل البيانات بنجاح.")
+        except FileNotFoundError:
+            print("⚠️ ملف البيانات غير موجود، سيتم استخدام الإعدادات الافتراضية.")
+        except (json.JSONDecodeError, TypeError):
+            print("❌ خطأ في قراءة ملف البيانات، سيتم استخدام الإعدادات الافتراضية.")
+
+        # إعادة تطبيق التغييرات المسجلة بعد آخر لقطة، ثم ضغطها في لقطة جديدة
+        replayed = self.replay()
+        if replayed:
+            print(f"✅ تمت إعادة تطبيق {replayed} عملية من سجل البيانات.")
+        # البيانات القديمة بلا معرفات ثابتة تُحفظ بالمعرفات الجديدة. كتابة اللقطة تستغرق ثوانيَ مع ملف كبير،
+        # فتجري في الخلفية حتى لا تؤخر الإقلاع؛ السجل يبقى صالحًا حتى تكتمل. الخيط daemon حتى لا يؤخر
+        # الخروج، والحفظ النهائي (checkpoint من أي خيط آخر) ينتظره أولاً
+        if replayed or posts.ids_assigned or posts.chat_ids_parsed:
+            self.startup_thread = threading.Thread(target=self.startup_checkpoint, name="checkpoint", daemon=True)
+            self.startup_thread.start()
+
+    def startup_checkpoint(self):
+        with startup.phase("checkpoint"):
+            self.checkpoint()
+
+    def append(self, record: dict):
+        """إضافة عملية واحدة إلى السجل، مع ضغط السجل عند تجاوز الحد."""
+        with self.lock:
+            if self.handle is None:
+                self.handle = open(self.journal_file, "a", encoding="utf-8")
+            self.handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if not self.batching:
+                self.handle.flush()
+            self.entries += 1
+            # أثناء لقطة الإقلاع لا نضغط (هي ستفرغ السجل، وانتظارها هنا ونحن نمسك القفل يسبب توقفًا متبادلًا)
+            if self.entries >= self.compact_every and not (self.startup_thread and self.startup_thread.is_alive()):
+                self.checkpoint()
+
+    @contextmanager
+    def batch(self):
+        """عدة عمليات بـ flush واحد لملف السجل."""
+        with self.lock:
+            self.batching = True
+            try:
+                yield
+            finally:
+                self.batching = False
+                if self.handle is not None:
+                    self.handle.flush()
+
+    def post_added(self, post):
+        self.append({"op": "post_add", "post": serialize_post(post)})
+
+    def post_updated(self, post, *fields):
+        data = serialize_post(post)
+        self.append({
+            "op": "post_update",
+            "key": [post.get("chat_id"), post.get("message_id")],
+            "fields": {f: data[f] for f in fields},
+        })
+
+    def post_deleted(self, post):
+        self.append({"op": "post_delete", "key": [post.get("chat_id"), post.get("message_id")]})
+
+    def state_changed(self):
+        self.append({"op": "state", "timer": timer_state(), "settings": settings_state()})
+
+    def render_changed(self, chat_id, message_id, label, url):
+        self.append({"op": "render", "key": [chat_id, message_id], "label": label, "url": url})
+
+    def render_forgotten(self, chat_id, message_id):
+        self.append({"op": "render_forget", "key": [chat_id, message_id]})
+
+    def apply(self, record: dict):
+        """إعادة تطبيق عملية من السجل. كل العمليات متكررة الأثر (idempotent) لأن اللقطة قد تسبق السجل."""
+        global target_date, timer_message_id, timer_chat_id, timer_active, custom_end_message, button_link, channels
+        op = record.get("op")
+        key = tuple(record.get("key") or ())
+        if op == "post_add":
+            post = deserialize_post(record["post"])
+            existing = find_post(post["chat_id"], post["message_id"])
+            if existing is not None:
+                existing.update(post)
             else:
-                # استخدام القيم الافتراضية إذا لم تكن متوفرة
-                custom_end_message = "✅ تم الوصول إلى اليوم المحدد"
-                button_link = ""
-
-            # تحميل المنشورات
-            posts = []
-            for p in data.get("posts", []):
-                pd = p.get("post_date")
-                post_date = datetime.datetime.fromisoformat(pd) if pd else None
-                posts.append({
-                    "chat_id": p.get("chat_id"),
-                    "message_id": p.get("message_id"),
-                    "post_text": p.get("post_text"),
-                    "post_link": p.get("post_link"),
-                    "post_media": p.get("post_media"),
-                    "post_date": post_date,
-                })
-
-            # محاولة اشتقاق رابط القناة من CHANNEL_ID إذا لم يكن button_link محددًا
-            if not button_link and CHANNEL_ID:
-                if isinstance(CHANNEL_ID, str) and CHANNEL_ID.startswith('@'):
-                    button_link = f"https://t.me/{CHANNEL_ID.lstrip('@')}"
-                elif isinstance(CHANNEL_ID, str) and CHANNEL_ID.startswith('http'):
-                    button_link = CHANNEL_ID
-
-            print("✅ تم تحميل البيانات بنجاح.")
-    except FileNotFoundError:
-        print("⚠️ ملف البيانات غير موجود، سيتم استخدام الإعدادات الافتراضية.")
-    except (json.JSONDecodeError, TypeError):
-        print("❌ خطأ في قراءة ملف البيانات، سيتم استخدام الإعدادات الافتراضية.")
+                posts.append(post)
+        elif op == "post_update":
+            existing = find_post(*key)
+            if existing is not None:
+                existing.update(deserialize_post({**serialize_post(existing), **record.get("fields", {})}))
+        elif op == "post_delete":
+            existing = find_post(*key)
+            if existing is not None:
+                posts.remove(existing)
+        elif op == "state":
+            timer_data = record.get("timer", {})
+            date_str = timer_data.get("target_date")
+            target_date = datetime.datetime.fromisoformat(date_str) if date_str else None
+            timer_message_id = timer_data.get("timer_message_id")
+            timer_chat_id = parse_chat_id(timer_data.get("timer_chat_id"))
+            timer_active = timer_data.get("timer_active", False)
+            settings_data = record.get("settings", {})
+            custom_end_message = settings_data.get("custom_end_message", "✅ تم الوصول إلى اليوم المحدد")
+            button_link = settings_data.get("button_link", "")
+            channels = parse_channels(settings_data.get("channels", []))
+        elif op == "render":
+            render_cache[(parse_chat_id(key[0]), key[1])] = (record.get("label"), record.get("url"))
+        elif op == "render_forget":
+            render_cache.pop((parse_chat_id(key[0]), key[1]), None)
+
+    def replay(self) -> int:
+        """إعادة تطبيق السجل بعد تحميل اللقطة. السطر الأخير المقطوع (تعطل أثناء الكتابة) يُتجاهل."""
+        applied = 0
+        try:
+            with open(self.journal_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning("تجاهل سطر تالف في سجل البيانات")
+                        continue
+                    self.apply(record)
+                    applied += 1
+        except FileNotFoundError:
+            pass
+        return applied
+
+    def checkpoint(self):
+        """كتابة لقطة كاملة ذريًا ثم تفريغ السجل."""
+        startup_thread = self.startup_thread
+        if startup_thread is not None and startup_thread is not threading.current_thread():
+            startup_thread.join()
+        with self.lock:
+            write_json_atomic(self.data_file, build_snapshot())
+            # اللقطة تحتوي كل ما في السجل الآن
+            if self.handle is not None:
+                self.handle.close()
+            self.handle = open(self.journal_file, "w", encoding="utf-8")
+            self.entries = 0
+
+    def replace_all(self):
+        self.checkpoint()
+
+    def active_count(self, now: datetime.datetime) -> int:
+        return posts.active_count(now)
+
+    def next_expiring(self, now: datetime.datetime, limit: int) -> list:
+        return posts.next_expiring(now, limit)
+
+
+class SqliteStorage:
+    """تخزين المنشورات في SQLite (وضع WAL) مع فهارس لاستعلامات الانتهاء."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS posts (
+            chat_id NOT NULL,
+            message_id INTEGER NOT NULL,
+            post_text TEXT,
+            post_link TEXT,
+            post_media TEXT,
+            post_date TEXT,
+            post_id INTEGER,
+            post_resolution TEXT,
+            post_quarantine TEXT,
+            PRIMARY KEY (chat_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS posts_by_date ON posts (post_date);
+        CREATE TABLE IF NOT EXISTS render_cache (
+            chat_id NOT NULL,
+            message_id INTEGER NOT NULL,
+            label TEXT,
+            url TEXT,
+            PRIMARY KEY (chat_id, message_id)
+        );
+        CREATE TABLE IF NOT EXISTS state (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chat_leases (
+            chat_id PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            chat_id NOT NULL,
+            message_id INTEGER NOT NULL,
+            changed REAL NOT NULL
+        );
+    """
+    # سجل التغييرات يُملأ بمشغلات (triggers) فيشمل كل من يكتب في القاعدة، والعمال يقرؤون منه ما تغيّر فقط
+    CHANGE_TRIGGERS = """
+        CREATE TRIGGER IF NOT EXISTS {table}_inserted AFTER INSERT ON {table} BEGIN
+            INSERT INTO changes (kind, chat_id, message_id, changed) VALUES ('{kind}', NEW.chat_id, NEW.message_id, {now});
+        END;
+        CREATE TRIGGER IF NOT EXISTS {table}_updated AFTER UPDATE ON {table} BEGIN
+            INSERT INTO changes (kind, chat_id, message_id, changed) VALUES ('{kind}', NEW.chat_id, NEW.message_id, {now});
+            INSERT INTO changes (kind, chat_id, message_id, changed) SELECT '{kind}', OLD.chat_id, OLD.message_id, {now}
+                WHERE OLD.chat_id IS NOT NEW.chat_id OR OLD.message_id IS NOT NEW.message_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS {table}_deleted AFTER DELETE ON {table} BEGIN
+            INSERT INTO changes (kind, chat_id, message_id, changed) VALUES ('{kind}', OLD.chat_id, OLD.message_id, {now});
+        END;
+    """
+    POST_COLUMNS = ("post_id", "chat_id", "message_id", "post_text", "post_link", "post_media", "post_date", "post_resolution",
+                    "post_quarantine")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # عدة عمليات (عمال العد التنازلي) قد تكتب في نفس الملف
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(self.SCHEMA)
+        # قواعد أُنشئت قبل إضافة المعرفات الثابتة ودقة العد والعزل لكل منشور
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(posts)")]
+        for column, kind in (("post_id", "INTEGER"), ("post_resolution", "TEXT"), ("post_quarantine", "TEXT")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE posts ADD COLUMN {column} {kind}")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS posts_by_id ON posts (post_id)")
+        for table, kind in (("posts", "post"), ("render_cache", "render")):
+            self.conn.executescript(
+                self.CHANGE_TRIGGERS.format(table=table, kind=kind, now="(julianday('now') - 2440587.5) * 86400.0"))
+
+    def row_to_post(self, row) -> Post:
+        data = dict(zip(self.POST_COLUMNS, row))
+        data["post_media"] = json.loads(data["post_media"]) if data["post_media"] else None
+        return deserialize_post(data)
+
+    def post_values(self, post) -> tuple:
+        data = serialize_post(post)
+        data["post_media"] = json.dumps(data["post_media"]) if data["post_media"] else None
+        return tuple(data[c] for c in self.POST_COLUMNS)
+
+    def load(self):
+        with self.lock:
+            empty = self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM posts) AND NOT EXISTS (SELECT 1 FROM state)").fetchone()[0]
+        if empty and os.path.exists(DATA_FILE):
+            print(f"جاري استيراد البيانات من {DATA_FILE} إلى {self.path}...")
+            import_json(DATA_FILE)
+            return
+
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {', '.join(self.POST_COLUMNS)} FROM posts ORDER BY rowid").fetchall()
+            renders = self.conn.execute("SELECT chat_id, message_id, label, url FROM render_cache").fetchall()
+            state = dict(self.conn.execute("SELECT name, value FROM state").fetchall())
+        data = {
+            "posts": [self.row_to_post(r) for r in rows],
+            "render_cache": [dict(zip(("chat_id", "message_id", "label", "url"), r)) for r in renders],
+        }
+        for name in ("timer", "settings"):
+            if state.get(name):
+                data[name] = json.loads(state[name])
+        if state.get("next_post_id"):
+            data["metadata"] = {"next_post_id": json.loads(state["next_post_id"])}
+        apply_snapshot(data)
+        if posts.chat_ids_parsed:
+            # معرفات محادثات رقمية محفوظة كنص: إعادة كتابة القاعدة بالمفاتيح الموحدة (تشمل المعرفات الثابتة)
+            self.replace_all()
+        elif posts.ids_assigned:
+            # منشورات من قاعدة أقدم بلا معرفات ثابتة
+            with self.lock:
+                self.conn.executemany(
+                    "UPDATE posts SET post_id = ? WHERE chat_id = ? AND message_id = ?",
+                    [(p.post_id, p.chat_id, p.message_id) for p in posts],
+                )
+        print(f"✅ تم تحميل {len(rows)} منشور من {self.path}.")
+
+    def execute(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    @contextmanager
+    def batch(self):
+        """عدة عمليات في معاملة واحدة."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def post_added(self, post):
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO posts ({', '.join(self.POST_COLUMNS)}) VALUES ({', '.join('?' * len(self.POST_COLUMNS))})",
+                self.post_values(post),
+            )
+            next_id = max(posts.next_id, (post.get("post_id") or 0) + 1)
+            self.conn.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('next_post_id', ?)", (json.dumps(next_id),))
+
+    def post_updated(self, post, *fields):
+        values = dict(zip(self.POST_COLUMNS, self.post_values(post)))
+        assignments = ", ".join(f"{f} = ?" for f in fields)
+        self.execute(
+            f"UPDATE posts SET {assignments} WHERE chat_id = ? AND message_id = ?",
+            tuple(values[f] for f in fields) + (post.get("chat_id"), post.get("message_id")),
+        )
+
+    def post_deleted(self, post):
+        self.execute("DELETE FROM posts WHERE chat_id = ? AND message_id = ?", (post.get("chat_id"), post.get("message_id")))
+
+    def state_changed(self):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)",
+                [
+                    ("timer", json.dumps(timer_state())),
+                    ("settings", json.dumps(settings_state(), ensure_ascii=False)),
+                    ("next_post_id", json.dumps(posts.next_id)),
+                ],
+            )
+
+    def render_changed(self, chat_id, message_id, label, url):
+        self.execute("INSERT OR REPLACE INTO render_cache (chat_id, message_id, label, url) VALUES (?, ?, ?, ?)", (chat_id, message_id, label, url))
+
+    def render_forgotten(self, chat_id, message_id):
+        self.execute("DELETE FROM render_cache WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+
+    def checkpoint(self):
+        """دمج ملف WAL في قاعدة البيانات الرئيسية."""
+        self.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def replace_all(self):
+        """استبدال محتوى القاعدة بالحالة الحالية في الذاكرة (يُستخدم عند الاستيراد)."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM posts")
+                self.conn.execute("DELETE FROM render_cache")
+                self.conn.executemany(
+                    f"INSERT OR REPLACE INTO posts ({', '.join(self.POST_COLUMNS)}) VALUES ({', '.join('?' * len(self.POST_COLUMNS))})",
+                    [self.post_values(p) for p in posts],
+                )
+                with render_cache_lock:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO render_cache (chat_id, message_id, label, url) VALUES (?, ?, ?, ?)",
+                        [(c, m, label, url) for (c, m), (label, url) in render_cache.items()],
+                    )
+                self.state_changed()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # استعلامات مدى على فهرس posts_by_date. التواريخ نصوص ISO فترتيبها النصي هو ترتيبها الزمني.
+    # القاعدة قد تتأخر عن الذاكرة بمقدار نافذة الكتابة المؤجلة، فتُكتب التغييرات المعلقة أولاً
+    def active_count(self, now: datetime.datetime) -> int:
+        write_behind.flush()
+        return self.execute("SELECT COUNT(*) FROM posts WHERE post_date > ?", (now.isoformat(),)).fetchone()[0]
+
+    def next_expiring(self, now: datetime.datetime, limit: int) -> list:
+        write_behind.flush()
+        rows = self.execute(
+            f"SELECT {', '.join(self.POST_COLUMNS)} FROM posts WHERE post_date > ? ORDER BY post_date LIMIT ?",
+            (now.isoformat(), limit),
+        ).fetchall()
+        return [self.row_to_post(r) for r in rows]
+
+    # --- استعلامات عمال العد التنازلي الموزعين ---
+    def read_state(self) -> dict:
+        state = dict(self.execute("SELECT name, value FROM state").fetchall())
+        return {name: json.loads(value) for name, value in state.items() if value}
+
+    def chat_ids(self) -> list:
+        return [row[0] for row in self.execute("SELECT DISTINCT chat_id FROM posts").fetchall()]
+
+    def posts_for_chats(self, chat_ids) -> list:
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return []
+        marks = ", ".join("?" for _ in chat_ids)
+        rows = self.execute(f"SELECT {', '.join(self.POST_COLUMNS)} FROM posts WHERE chat_id IN ({marks})", chat_ids).fetchall()
+        return [self.row_to_post(r) for r in rows]
+
+    def renders_for_chats(self, chat_ids) -> dict:
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return {}
+        marks = ", ".join("?" for _ in chat_ids)
+        rows = self.execute(f"SELECT chat_id, message_id, label, url FROM render_cache WHERE chat_id IN ({marks})", chat_ids).fetchall()
+        return {(c, m): (label, url) for c, m, label, url in rows}
+
+    def posts_by_keys(self, keys) -> dict:
+        sql = f"SELECT {', '.join(self.POST_COLUMNS)} FROM posts WHERE chat_id = ? AND message_id = ?"
+        with self.lock:
+            rows = [self.conn.execute(sql, key).fetchone() for key in keys]
+        return {(p.chat_id, p.message_id): p for p in (self.row_to_post(r) for r in rows if r)}
+
+    def renders_by_keys(self, keys) -> dict:
+        sql = "SELECT chat_id, message_id, label, url FROM render_cache WHERE chat_id = ? AND message_id = ?"
+        with self.lock:
+            rows = [self.conn.execute(sql, key).fetchone() for key in keys]
+        return {(c, m): (label, url) for c, m, label, url in filter(None, rows)}
+
+    def change_seq(self) -> int:
+        """رقم آخر تغيير مسجل (لا يتناقص حتى بعد حذف السجل القديم)."""
+        row = self.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def changes_since(self, seq: int):
+        """(آخر رقم، مفاتيح المنشورات المتغيرة، مفاتيح الأزرار المتغيرة) بعد seq، أو None إذا حُذف من السجل ما لم يُقرأ."""
+        with self.lock:
+            pruned = self.conn.execute("SELECT value FROM state WHERE name = 'changes_pruned'").fetchone()
+            if pruned is not None and json.loads(pruned[0]) > seq:
+                return None
+            rows = self.conn.execute("SELECT seq, kind, chat_id, message_id FROM changes WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        changed = {"post": set(), "render": set()}
+        for seq, kind, chat_id, message_id in rows:
+            changed[kind].add((chat_id, message_id))
+        return seq, changed["post"], changed["render"]
+
+    def prune_changes(self, now: float = None):
+        """حذف التغييرات الأقدم من SHARD_CHANGES_TTL؛ العامل المتأخر عنها يعيد التحميل كاملاً."""
+        before = (time.time() if now is None else now) - SHARD_CHANGES_TTL
+        with self.lock:
+            last = self.conn.execute("SELECT MAX(seq) FROM changes WHERE changed < ?", (before,)).fetchone()[0]
+            if last is None:
+                return
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM changes WHERE seq <= ?", (last,))
+                self.conn.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('changes_pruned', ?)", (json.dumps(last),))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def heartbeat(self, worker_id: str, now: float, ttl: float) -> list:
+        """تسجيل نبضة العامل وإرجاع معرفات العمال الأحياء."""
+        self.execute("INSERT OR REPLACE INTO workers (worker_id, heartbeat) VALUES (?, ?)", (worker_id, now))
+        self.execute("DELETE FROM workers WHERE heartbeat < ?", (now - ttl,))
+        return sorted(row[0] for row in self.execute("SELECT worker_id FROM workers").fetchall())
+
+    def acquire_lease(self, chat_id, owner: str, now: float, ttl: float) -> bool:
+        """أخذ أو تجديد ملكية محادثة. ينجح فقط إذا كانت لنا أو انتهت مدة مالكها السابق."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO chat_leases (chat_id, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE chat_leases.owner = excluded.owner OR chat_leases.expires < ?",
+                (chat_id, owner, now + ttl, now),
+            )
+            row = self.conn.execute("SELECT owner FROM chat_leases WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def release_leases(self, owner: str, keep=()):
+        keep = list(keep)
+        marks = ", ".join("?" for _ in keep)
+        if keep:
+            self.execute(f"DELETE FROM chat_leases WHERE owner = ? AND chat_id NOT IN ({marks})", [owner] + keep)
+        else:
+            self.execute("DELETE FROM chat_leases WHERE owner = ?", (owner,))
+
+    def remove_worker(self, worker_id: str):
+        self.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+        self.release_leases(worker_id)
+
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    return JsonStorage(DATA_FILE, JOURNAL_FILE, JOURNAL_COMPACT_EVERY)
+
+
+storage = create_storage()
+
+
+# --- الكتابة المؤجلة (write-behind) ---
+# المعالجات لا تكتب على القرص مباشرة: كل تغيير يُعلَّم كمعلّق ويُكتب من خيط خلفي بعد PERSIST_FLUSH_WINDOW
+# ثانية من أول تغيير، فتُدمج التغييرات المتتالية على الكيان نفسه (عدة تعديلات على منشور، عدة تغييرات
+# للحالة) في كتابة واحدة، وتُكتب الدفعة كلها في معاملة SQLite واحدة أو flush واحد لملف السجل.
+# save_data والإيقاف يفرغان المعلق أولاً. PERSIST_FLUSH_WINDOW=0 يعيد الكتابة المتزامنة.
+PERSIST_FLUSH_WINDOW = float(os.getenv("PERSIST_FLUSH_WINDOW", "1.0"))
+
+
+class WriteBehind:
+    """آخر تغيير معلق لكل كيان (منشور، زر معروض، الحالة) مع خيط يكتبها دفعة واحدة."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.cond = threading.Condition()
+        self.pending = {}  # key -> (op, payload)
+        self.deadline = None
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    @staticmethod
+    def merge(previous, current):
+        """دمج تغييرين على الكيان نفسه في تغيير واحد مكافئ."""
+        (old_op, old_payload), (op, payload) = previous, current
+        if op == "post_update" and old_op == "post_add":
+            return previous  # الإضافة تكتب المنشور كاملاً بقيمه الحالية
+        if op == "post_update" and old_op == "post_update":
+            return op, (payload[0], old_payload[1] | payload[1])
+        if op == "post_delete" and old_op in ("post_add", "post_add_delete"):
+            # تُكتب الإضافة ثم الحذف حتى يبقى المعرف محجوزًا بعد إعادة التحميل
+            return "post_add_delete", payload
+        return current
+
+    def mark(self, key, op, payload=None):
+        if self.window <= 0:
+            with tracer.timed("persist"):
+                self.write([(key, (op, payload))])
+            return
+        with self.cond:
+            previous = self.pending.pop(key, None)
+            if previous is not None:
+                op, payload = self.merge(previous, (op, payload))
+                metrics.inc("persist_coalesced_total")
+            self.pending[key] = (op, payload)
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.window
+                self.cond.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+                self.thread.start()
+
+    def pending_keys(self) -> set:
+        with self.cond:
+            return set(self.pending)
+
+    def write(self, items):
+        started = time.monotonic()
+        with storage.batch():
+            for _, (op, payload) in items:
+                if op == "post_add":
+                    storage.post_added(payload)
+                elif op == "post_update":
+                    storage.post_updated(payload[0], *sorted(payload[1]))
+                elif op == "post_delete":
+                    storage.post_deleted(payload)
+                elif op == "post_add_delete":
+                    storage.post_added(payload)
+                    storage.post_deleted(payload)
+                elif op == "render":
+                    storage.render_changed(*payload)
+                elif op == "render_forget":
+                    storage.render_forgotten(*payload)
+                elif op == "state":
+                    storage.state_changed()
+        metrics.observe("persist_flush_seconds", time.monotonic() - started)
+        metrics.inc("persist_writes_total", len(items))
+
+    def flush(self):
+        """كتابة كل التغييرات المعلقة الآن (من أي خيط)."""
+        with self.flush_lock:
+            with self.cond:
+                items = list(self.pending.items())
+                self.pending = {}
+                self.deadline = None
+            if not items:
+                return
+            try:
+                self.write(items)
+            except Exception:
+                # إعادة ما لم يُكتب؛ التغييرات الأحدث على الكيان نفسه تبقى هي الأحدث
+                with self.cond:
+                    for key, change in items:
+                        newer = self.pending.pop(key, None)
+                        self.pending[key] = self.merge(change, newer) if newer else change
+                    if self.deadline is None:
+                        self.deadline = time.monotonic() + max(self.window, 1.0)
+                raise
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.deadline is None or self.deadline > time.monotonic():
+                    self.cond.wait(None if self.deadline is None else self.deadline - time.monotonic())
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("write-behind: فشل الكتابة، ستُعاد المحاولة")
+
+    def pending_count(self) -> int:
+        with self.cond:
+            return len(self.pending)
+
+
+write_behind = WriteBehind(PERSIST_FLUSH_WINDOW)
+# خروج عادي للمفسر (أوامر سطر الأوامر) لا يفقد التغييرات المعلقة
+atexit.register(write_behind.flush)
+
+
+def persist_post_add(post):
+    write_behind.mark(("post", post.get("chat_id"), post.get("message_id")), "post_add", post)
+
+
+def persist_post_update(post, *fields):
+    write_behind.mark(("post", post.get("chat_id"), post.get("message_id")), "post_update", (post, set(fields)))
+
+
+def persist_post_delete(post):
+    write_behind.mark(("post", post.get("chat_id"), post.get("message_id")), "post_delete", post)
+
+
+def persist_state():
+    """حفظ حالة المؤقت والإعدادات الحالية (وتسليح مؤقت انتهاء المؤقت العام حسبها)."""
+    sync_timer_expiry()
+    write_behind.mark(("state",), "state")
+
+
+def save_data():
+    """ضغط الحالة الحالية في وحدة التخزين (لقطة JSON ذرية أو checkpoint لـ SQLite) بعد كتابة المعلق."""
+    started = time.monotonic()
+    with tracer.timed("persist"):
+        write_behind.flush()
+        storage.checkpoint()
+    metrics.observe("save_data_seconds", time.monotonic() - started)
+
+
+def load_data():
+    """تحميل الحالة من وحدة التخزين عند بدء التشغيل."""
+    write_behind.flush()
+    # مئات آلاف الكائنات الجديدة تطلق جولات جمع القمامة مرارًا أثناء التحميل دون أن تحرر شيئًا،
+    # فيُوقف الجمع ثم تُجمَّد الحالة المحملة حتى لا تفحصها الجولات اللاحقة
+    with gc_paused():
+        storage.load()
+    gc.freeze()
+
+
+def import_json(path: str):
+    """استيراد لقطة بصيغة data.json إلى وحدة التخزين الحالية (تستبدل المحتوى)."""
+    with open(path, "r") as f:
+        apply_snapshot(json.load(f))
+    write_behind.flush()
+    storage.replace_all()
+    print(f"✅ تم استيراد {len(posts)} منشور من {path}.")
+
+
+def export_json(path: str):
+    """تصدير الحالة الحالية بصيغة data.json."""
+    write_json_atomic(path, build_snapshot())
+    print(f"✅ تم تصدير {len(posts)} منشور إلى {path}.")
 
 # --- مغلّف التحقق من الأدمن ---
 def admin_only(func):
     @wraps(func)
     def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
+        tracer.name(func.__name__)
         user_id = update.effective_user.id
         if user_id != ADMIN_ID:
+            tracer.fail("forbidden")
             update.message.reply_text("❌ ليس لديك صلاحية استخدام هذا الأمر.")
             return
         return func(update, context, *args, **kwargs)
     return wrapped
 
 # --- دالة التحديث ---
-def update_timer(bot=None):
+def prepare_timer_edit():
     """
-    تقوم هذه الدالة بتحديث رسالة المؤقت بشكل دوري.
+    يحسب زر رسالة المؤقت العام ويطبّق تغييرات الحالة عند الانتهاء.
+    يعيد (chat_id, message_id, text, url) إذا كان الزر يحتاج تعديلًا، وإلا None.
     """
     global timer_active, target_date
     if not timer_active or not target_date or not timer_message_id:
-        return
-
-    # Resolve a usable Bot instance. Accept Updater, Bot, or None (fallback to creating Bot)
-    actual_bot = None
-    try:
-        # If passed an Updater
-        if hasattr(bot, 'bot') and isinstance(getattr(bot, 'bot'), Bot):
-            actual_bot = bot.bot
-        # If passed a Bot directly
-        elif isinstance(bot, Bot):
-            actual_bot = bot
-        else:
-            # fallback: create a Bot from token
-            actual_bot = Bot(BOT_TOKEN)
-    except Exception:
-        # as a last resort create Bot
-        actual_bot = Bot(BOT_TOKEN)
+        return None
 
     now = datetime.datetime.now()
 
@@ -209,87 +2024,66 @@ def update_timer(bot=None):
         # انتهى المؤقت
         timer_active = False
         countdown_text = custom_end_message
-        schedule.clear()  # إيقاف كل المهام المجدولة
         # استدعاء دالة انتهاء المؤقت للتأكد من حفظ الحالة
         timer_expired_callback()
     else:
-        # حساب الوقت المتبقي
-        delta = target_date - now
-        days = delta.days
-        hours, rem = divmod(delta.seconds, 3600)
-        minutes, _ = divmod(rem, 60)
-        countdown_text = f"⏳ {days} يوم : {hours} ساعة : {minutes} دقيقة"
+        # حساب الوقت المتبقي (بالدقة العامة؛ التعديل يُتجاهل إذا لم يتغيّر النص)
+        countdown_text = countdown_label(target_date, now)
+        minutes = (target_date - now).seconds // 60 % 60
 
         # التحقق من صحة الجدولة كل 10 دقائق
         if minutes % 10 == 0:  # كل 10 دقائق
             check_and_maintain_schedule()
 
-    # إنشاء الزر
-    keyboard = [[InlineKeyboardButton(countdown_text, url=effective_button_url())]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # تجاهل التعديل إذا كان الزر الحالي مطابقًا
+    url = effective_button_url()
+    if render_unchanged(timer_chat_id, timer_message_id, countdown_text, url):
+        return None
+    return timer_chat_id, timer_message_id, countdown_text, url
 
-    # محاولة التحديث مع إعادة المحاولة عند أخطاء الشبكة
-    attempts = 3
-    for attempt in range(1, attempts + 1):
-        try:
-            # Use proper Bot method to edit reply_markup
-            actual_bot.edit_message_reply_markup(chat_id=timer_chat_id, message_id=timer_message_id, reply_markup=reply_markup)
-            return
-        except Unauthorized as e:
-            logging.error(f"Permission error when updating global timer message: {e}. Is the bot an admin in the channel?")
-            return
-        except RetryAfter as e:
-            wait = getattr(e, 'retry_after', 5)
-            logging.warning(f"Rate limited. Sleeping for {wait} seconds")
-            time.sleep(wait)
-        except NetworkError as e:
-            logging.warning(f"Network error while updating message (attempt {attempt}/{attempts}): {e}")
-            if attempt < attempts:
-                time.sleep(2 ** attempt)
-                continue
-            else:
-                logging.error(f"Failed to update message after {attempts} attempts: {e}")
-        except Exception as e:
-            # طباعة الخطأ لأغراض التشخيص مع التتبع الكامل
-            logging.exception(f"Error updating message on attempt {attempt}: {e}")
-            # محاولات احتياطية: حاول إنشاء Bot جديد واستخدامه
-            try:
-                fallback_bot = Bot(BOT_TOKEN)
-                fallback_bot.edit_message_reply_markup(chat_id=timer_chat_id, message_id=timer_message_id, reply_markup=reply_markup)
-                return
-            except Exception:
-                # إذا فشلت المحاولة الاحتياطية، تابع لعدد المحاولات
-                if attempt < attempts:
-                    time.sleep(2 ** attempt)
-                    continue
-                logging.error("All attempts to update message failed.")
-                return
+
+def update_timer(bot=None):
+    """
+    تقوم هذه الدالة بتحديث رسالة المؤقت عند تغيّر نص زرها.
+    """
+    job = prepare_timer_edit()
+    if job is None or not edit_health.allow(job[0], job[1]):
+        return  # لا تعديل مطلوب، أو أن عمال إعادة المحاولة يتولون الرسالة
+    if async_runtime is not None:
+        # في وضع asyncio يتم التعديل وإعادة المحاولة على حلقة الأحداث دون حجز خيط الحالة
+        async_runtime.submit_edit(job, label="global timer message", attempts=1)
+        return
+    timer_chat_id, timer_message_id, countdown_text, url = job
+
+    actual_bot = resolve_bot(bot)
+
+    # محاولة واحدة على خيط الجدولة؛ الفشل العابر ينتقل لطابور إعادة المحاولة بدل النوم وحجز باقي المهام
+    edit_engine.edit(actual_bot, timer_chat_id, timer_message_id, countdown_text, url, "global timer message", attempts=1)
 
 # --- دوال إدارة المنشورات ---
 def cleanup_expired_posts():
     """تنظيف المنشورات المنتهية من قاعدة البيانات."""
-    global posts
     if not posts:
         return 0
 
     now = datetime.datetime.now()
     original_count = len(posts)
-    posts = [p for p in posts if p.get('post_date') and now < p.get('post_date')]
+    expired = posts.remove_expired(now)
+    for p in expired:
+        forget_render(p.get('chat_id'), p.get('message_id'))
+        countdown_scheduler.remove(p)
+        persist_post_delete(p)
 
     cleaned_count = original_count - len(posts)
     if cleaned_count > 0:
-        save_data()
         print(f"✅ تم تنظيف {cleaned_count} منشور منتهي")
         return cleaned_count
     return 0
 
 def get_active_posts_count():
     """إرجاع عدد المنشورات النشطة فقط."""
-    if not posts:
-        return 0
+    return storage.active_count(datetime.datetime.now())
 
-    now = datetime.datetime.now()
-    return len([p for p in posts if p.get('post_date') and now < p.get('post_date')])
 def reschedule_saved_timers():
     """إعادة جدولة المؤقتات المحفوظة عند إعادة تشغيل البوت."""
     global timer_active, target_date
@@ -302,7 +2096,7 @@ def reschedule_saved_timers():
     if now >= target_date:
         print("المؤقت انتهى بالفعل، لن يتم إعادة جدولته.")
         timer_active = False
-        save_data()
+        persist_state()
         return
 
     # حساب الوقت المتبقي بالثواني
@@ -312,18 +2106,14 @@ def reschedule_saved_timers():
     if seconds_until_target > 0:
         print(f"سيتم إعادة جدولة المؤقت للانتهاء في {seconds_until_target} ثانية من الآن.")
 
-        # مسح المهام المجدولة السابقة لتجنب التكرار
-        schedule.clear()
-
-        # إعادة جدولة المهمة للتنفيذ في الوقت المحدد
-        schedule.every(seconds_until_target).seconds.do(timer_expired_callback)
-        schedule.every(60).seconds.do(update_timer)  # تحديث كل دقيقة
+        # مؤقتان لمرة واحدة: التغيّر التالي لنص الزر، وموعد الانتهاء بالضبط
+        sync_timer_expiry()
 
         print("✅ تم إعادة جدولة المؤقت بنجاح.")
     else:
         print("الوقت المستهدف في الماضي، لن يتم إعادة جدولة المؤقت.")
         timer_active = False
-        save_data()
+        persist_state()
 
 def timer_expired_callback():
     """دالة تُستدعى عند انتهاء المؤقت."""
@@ -331,7 +2121,7 @@ def timer_expired_callback():
     timer_active = False
     print("انتهى المؤقت!")
     # سيتم تحديث الرسالة تلقائيًا بواسطة دالة update_timer في المرة التالية
-    save_data()
+    persist_state()
 
 def check_and_maintain_schedule():
     """التحقق من صحة الجدولة وإعادة تشغيلها إذا لزم الأمر."""
@@ -345,161 +2135,1451 @@ def check_and_maintain_schedule():
         # المؤقت انتهى، لا نحتاج لفعل شيء
         return
 
-    # التحقق من وجود مهام مجدولة
-    jobs = schedule.get_jobs()
-    if not jobs or len(jobs) == 0:
-        print("لا توجد مهام مجدولة، سيتم إعادة الجدولة...")
+    refresh_due = next_label_change(target_date, now) < target_date
+    if TIMER_EXPIRY not in expiry_dispatcher.armed or (refresh_due and TIMER_REFRESH not in expiry_dispatcher.armed):
+        print("مؤقت الانتهاء أو تحديث الزر غير مسلح، سيتم إعادة الجدولة...")
         reschedule_saved_timers()
-    else:
-        # التحقق من وجود مهمة تحديث المؤقت
-        has_update_job = any('update_timer' in str(job) for job in jobs)
-        if not has_update_job:
-            print("مهمة تحديث المؤقت مفقودة، سيتم إعادة جدولتها...")
-            schedule.every(60).seconds.do(update_timer)
 
 # --- دوال الجدولة ---
-def run_schedule(bot: Updater):
-    """
-    تشغيل المهام المجدولة في حلقة لا نهائية.
-    """
-    # إعادة جدولة المؤقتات المحفوظة عند البدء
+def register_schedule_jobs():
+    """إعادة جدولة المؤقتات المحفوظة وتسجيل المهام الدورية في schedule."""
+    # إعادة جدولة المؤقتات المحفوظة عند البدء: انتهاء المؤقت العام وتغيّرات نص زره (في expiry_dispatcher)
     print("جاري إعادة جدولة المؤقتات المحفوظة...")
     reschedule_saved_timers()
 
-    # جدولة تحديث المؤقت العام (إذا مستخدم) وتحديث كل المنشورات المجمعة
-    schedule.every(1).minutes.do(update_timer, bot=bot)
-    schedule.every(1).minutes.do(update_all_posts, bot=bot)
-
     # جدولة التحقق من صحة الجدولة كل 5 دقائق
     schedule.every(5).minutes.do(check_and_maintain_schedule)
 
     # جدولة تنظيف المنشورات المنتهية كل يوم في منتصف الليل
     schedule.every().day.at("00:00").do(cleanup_expired_posts)
 
+    # تسجيل إحصائيات إعادة استخدام اتصالات الـ Bot المشترك
+    schedule.every(10).minutes.do(log_bot_pool_stats)
+
+    # حذف سجل التغييرات القديم الذي يقرؤه عمال العد التنازلي
+    if isinstance(storage, SqliteStorage):
+        schedule.every(5).minutes.do(storage.prune_changes)
+
+
+def run_schedule(bot: Updater):
+    """
+    تشغيل المهام المجدولة في حلقة لا نهائية.
+    """
+    register_schedule_jobs()
+
+    # أزرار المنشورات تُحدّث عبر جدول المواعيد عند كل تغيّر فعلي بدلاً من فحص الكل كل دقيقة
+    # (في وضع sharded تتولاها عمليات العمال)
+    if COUNTDOWN_MODE != "sharded":
+        countdown_scheduler.start(bot, posts)
+
     while True:
-        schedule.run_pending()
+        run_pending_jobs()
         time.sleep(1)
 
 
+# --- دقة العد التنازلي ---
+# COUNTDOWN_RESOLUTION=adaptive: الزر يعرض الأيام فقط والموعد بعيد، ثم الأيام والساعات، ثم الدقائق في
+# الساعة الأخيرة (واختياريًا الثواني في الدقيقة الأخيرة). الجدولة تتبع تغيّرات النص الفعلية فقط، فمنشور
+# بعد 60 يومًا يُعدَّل مرة في اليوم بدل 1440 مرة. COUNTDOWN_RESOLUTION=minutes يبقي الصيغة القديمة.
+# يمكن تحديد دقة مختلفة لكل منشور من قائمة تعديله (post_resolution).
+COUNTDOWN_RESOLUTION = os.getenv("COUNTDOWN_RESOLUTION", "adaptive").lower()
+COUNTDOWN_DAYS_FROM = float(os.getenv("COUNTDOWN_DAYS_FROM", "48"))  # ساعات
+COUNTDOWN_HOURS_FROM = float(os.getenv("COUNTDOWN_HOURS_FROM", "60"))  # دقائق
+COUNTDOWN_SECONDS_STEP = int(os.getenv("COUNTDOWN_SECONDS_STEP", "0"))  # 0 = بلا ثوانٍ
+
+
+class CountdownResolution:
+    """سياسة دقة الزر: مستويات (أقل وقت متبقٍ بالثواني، وحدة العرض بالثواني) من الأبعد إلى الأقرب.
+
+    النص يعرض الوقت المتبقي مقربًا للأسفل إلى وحدة المستوى الحالي، فيتغيّر فقط عند عبور مضاعف
+    للوحدة أو حد مستوى.
+    """
+
+    UNITS = ((86400, "يوم"), (3600, "ساعة"), (60, "دقيقة"), (1, "ثانية"))
+
+    def __init__(self, name: str, title: str, levels, full: bool = False):
+        self.name = name
+        self.title = title
+        self.levels = levels  # آخر مستوى حده 0
+        self.full = full  # عرض الأيام والساعات والدقائق دائمًا (الصيغة القديمة)
+
+    def level(self, remaining: float) -> int:
+        for i, (threshold, _) in enumerate(self.levels):
+            if remaining >= threshold:
+                return i
+        return len(self.levels) - 1
+
+    def label(self, remaining: float) -> str:
+        unit = self.levels[self.level(remaining)][1]
+        shown = int(remaining // unit) * unit
+        if self.full:
+            return f"⏳ {shown // 86400} يوم : {shown % 86400 // 3600} ساعة : {shown % 3600 // 60} دقيقة"
+        smallest = max(size for size, _ in self.UNITS if size <= unit)
+        parts = []
+        for size, name in self.UNITS:
+            if size < smallest:
+                break
+            value, shown = divmod(shown, size)
+            if value or parts:
+                parts.append(f"{value} {name}")
+        return "⏳ " + (" : ".join(parts) or f"0 {dict(self.UNITS)[smallest]}")
+
+    def next_change(self, remaining: float) -> float:
+        """الوقت المتبقي (بالثواني) عند التغيّر التالي للنص: مضاعف الوحدة التالي أو حد المستوى."""
+        threshold, unit = self.levels[self.level(remaining)]
+        # بداية مجموعة النص الحالي؛ عند مضاعف الوحدة أو حد المستوى تمامًا تكون هي الآن
+        at = max(remaining // unit * unit, threshold)
+        return max(at, 0)
+
+    def bucket_end(self, remaining: float) -> float:
+        """الحد الأعلى (غير المشمول) للوقت المتبقي الذي يعطي النص نفسه."""
+        i = self.level(remaining)
+        end = (remaining // self.levels[i][1] + 1) * self.levels[i][1]
+        return min(end, self.levels[i - 1][0]) if i > 0 else end
+
+
+def adaptive_levels():
+    levels = [(COUNTDOWN_DAYS_FROM * 3600, 86400), (COUNTDOWN_HOURS_FROM * 60, 3600)]
+    if COUNTDOWN_SECONDS_STEP > 0:
+        levels += [(60, 60), (0, COUNTDOWN_SECONDS_STEP)]
+    else:
+        levels.append((0, 60))
+    return levels
+
+
+COUNTDOWN_RESOLUTIONS = {
+    "adaptive": CountdownResolution("adaptive", "تكيّفية", adaptive_levels()),
+    "minutes": CountdownResolution("minutes", "كل دقيقة", [(0, 60)], full=True),
+}
+
+
+def countdown_resolution(name: str = None) -> CountdownResolution:
+    """سياسة المنشور إن وُجدت، وإلا السياسة العامة."""
+    return COUNTDOWN_RESOLUTIONS.get(name or COUNTDOWN_RESOLUTION) or COUNTDOWN_RESOLUTIONS["minutes"]
+
+
+def countdown_label(post_date: datetime.datetime, now: datetime.datetime, resolution: str = None) -> str:
+    """نص زر العد التنازلي لمنشور لم ينتهِ بعد."""
+    return countdown_resolution(resolution).label((post_date - now).total_seconds())
+
+
+def next_label_change(post_date: datetime.datetime, now: datetime.datetime, resolution: str = None):
+    """موعد التغيّر المرئي التالي للزر حسب دقته، أو لحظة الانتهاء. None إذا انتهى المنشور."""
+    remaining = (post_date - now).total_seconds()
+    if remaining <= 0:
+        return None
+    return post_date - datetime.timedelta(seconds=countdown_resolution(resolution).next_change(remaining))
+
+
+# --- محرك التحديث المتزامن ---
+# حدود Telegram التقريبية: ~30 طلبًا في الثانية للبوت كله، وطلب واحد تقريبًا في الثانية لكل محادثة
+EDIT_WORKERS = int(os.getenv("EDIT_WORKERS", "8"))
+EDIT_RATE_GLOBAL = float(os.getenv("EDIT_RATE_GLOBAL", "30"))
+EDIT_RATE_PER_CHAT = float(os.getenv("EDIT_RATE_PER_CHAT", "1"))
+EDIT_BURST_PER_CHAT = int(os.getenv("EDIT_BURST_PER_CHAT", "3"))
+# حد تعديل خاص لبعض القنوات (تعديل/ثانية): CHANNEL_EDIT_RATES="@big=0.5,-1001234=2"
+CHANNEL_EDIT_RATES = os.getenv("CHANNEL_EDIT_RATES", "")
+
+
+def parse_channel_rates(value: str) -> dict:
+    rates = {}
+    for item in value.split(","):
+        chat_id, sep, rate = item.rpartition("=")
+        if sep and chat_id.strip():
+            rates[parse_chat_id(chat_id)] = float(rate)
+    return rates
+
+
+class TokenBucket:
+    """دلو رموز بسيط آمن للخيوط مع دعم الإيقاف المؤقت (RetryAfter)."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """يحجز رمزًا ويعيد عدد الثواني الواجب انتظارها قبل استخدامه."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def delay(self) -> float:
+        """الثواني حتى يتوفر رمز، دون حجزه."""
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            wait = (1 - tokens) / self.rate if tokens < 1 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def resize(self, rate: float, capacity: float):
+        """تغيير المعدل والسعة معًا (الرموز المتراكمة لا تتجاوز السعة الجديدة)."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(capacity, self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.capacity = capacity
+
+
+class RateLimiter:
+    """حد عام مشترك + حد مستقل لكل محادثة (chat_rates لقنوات بحد خاص)."""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, chat_rates: dict = None):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_rates = chat_rates or {}
+        self.chats = {}
+        self.lock = threading.Lock()
+        # طلبات الأولوية (تعديلات الانتهاء) التي تنتظر الحد العام؛ الطلبات العادية لا تأخذ من الحد العام حتى تنتهي.
+        # الأولوية على الحد العام فقط: انتظار رمز المحادثة لا يوقف بقية المحادثات.
+        self.urgent = 0
+        self.idle = threading.Condition(self.lock)
+        self.async_waiters = []  # (loop, future) لطلبات asyncio العادية المنتظرة
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        with self.lock:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                bucket = self.chats[chat_id] = TokenBucket(self.chat_rates.get(chat_id, self.chat_rate), self.chat_burst)
+            return bucket
+
+    def chat_delay(self, chat_id) -> float:
+        return self.chat_bucket(chat_id).delay()
+
+    def release_urgent(self):
+        with self.lock:
+            self.urgent -= 1
+            if self.urgent:
+                return
+            self.idle.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    def acquire(self, chat_id, priority: bool = False):
+        # نأخذ رمز المحادثة أولاً حتى لا نحجز من الحد العام أثناء انتظار محادثة موقوفة
+        wait = self.chat_bucket(chat_id).reserve()
+        if wait > 0:
+            time.sleep(wait)
+        with self.lock:
+            if priority:
+                self.urgent += 1
+            else:
+                while self.urgent:
+                    self.idle.wait()
+        try:
+            wait = self.global_bucket.reserve()
+            if wait > 0:
+                time.sleep(wait)
+        finally:
+            if priority:
+                self.release_urgent()
+
+    async def acquire_async(self, chat_id, priority: bool = False):
+        """نفس acquire لكن بانتظار غير حاجب داخل حلقة asyncio."""
+        wait = self.chat_bucket(chat_id).reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if priority:
+                    self.urgent += 1
+                    break
+                if not self.urgent:
+                    break
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            await future
+        try:
+            wait = self.global_bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        finally:
+            if priority:
+                self.release_urgent()
+
+    def pause(self, chat_id, seconds: float):
+        """إيقاف محادثة واحدة فقط بعد RetryAfter دون التأثير على بقية القنوات."""
+        self.chat_bucket(chat_id).pause(seconds)
+
+
+# --- قواطع الدائرة وعزل الرسائل المعطلة ---
+# رسالة محذوفة أو محادثة فقد البوت صلاحيته فيها لا تُعاد محاولتها في كل دورة: خطأ المحادثة (Unauthorized،
+# لا صلاحيات) يفتح قاطع المحادثة كلها لمدة تبدأ بـ BREAKER_BACKOFF وتتضاعف مع كل إخفاق تالٍ حتى
+# BREAKER_MAX_BACKOFF، وعند انتهائها تُعاد منشوراتها للجدول فتكون محاولتها التالية هي الاختبار. الرسالة التي
+# لم تعد موجودة تُعزل في post_quarantine وتخرج من دورات التحديث حتى يعيد الأدمن تفعيلها من قائمة المنشورات.
+# الأخطاء العابرة لرسالة واحدة يتولاها طابور إعادة المحاولة (انظر "إعادة المحاولة المؤجلة").
+BREAKER_BACKOFF = float(os.getenv("BREAKER_BACKOFF", "60"))
+BREAKER_MAX_BACKOFF = float(os.getenv("BREAKER_MAX_BACKOFF", "3600"))
+
+# نصوص أخطاء Telegram التي تعني أن إعادة المحاولة لن تفيد
+DEAD_MESSAGE_ERRORS = ("message to edit not found", "message_id_invalid", "message can't be edited", "message not found")
+DEAD_CHAT_ERRORS = ("chat not found", "not enough rights", "have no rights", "chat_write_forbidden", "bot was kicked",
+                    "need administrator rights")
+
+
+def edit_failure_scope(error) -> str:
+    """'message' إذا حُذفت الرسالة، 'chat' إذا فقد البوت صلاحيته في المحادثة، وإلا 'transient'."""
+    if isinstance(error, Unauthorized):
+        return "chat"
+    if isinstance(error, BadRequest):
+        text = str(error).lower()
+        if any(marker in text for marker in DEAD_MESSAGE_ERRORS):
+            return "message"
+        if any(marker in text for marker in DEAD_CHAT_ERRORS):
+            return "chat"
+    return "transient"
+
+
+class CircuitBreaker:
+    """قاطع لكل مفتاح: يُفتح بعد threshold إخفاقات متتالية لمدة تتضاعف مع كل إخفاق تالٍ، ويُغلق عند أول نجاح."""
+
+    def __init__(self, threshold: int, backoff: float, max_backoff: float):
+        self.threshold = max(1, threshold)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.state = {}  # key -> [إخفاقات متتالية، نهاية الفتح (monotonic)]
+
+    def allow(self, key, now: float = None) -> bool:
+        entry = self.state.get(key)
+        return entry is None or entry[1] <= (time.monotonic() if now is None else now)
+
+    def failure(self, key) -> float:
+        """تسجيل إخفاق. يعيد مدة الفتح بالثواني (0 إذا بقي القاطع مغلقًا)."""
+        with self.lock:
+            entry = self.state.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            if entry[0] < self.threshold:
+                return 0.0
+            delay = min(self.max_backoff, self.backoff * 2 ** min(entry[0] - self.threshold, 30))
+            entry[1] = time.monotonic() + delay
+            return delay
+
+    def success(self, key) -> bool:
+        """إغلاق القاطع. يعيد True إذا كان مفتوحًا (تعافٍ بعد انقطاع)."""
+        if key not in self.state:
+            return False
+        with self.lock:
+            entry = self.state.pop(key, None)
+        return entry is not None and entry[0] >= self.threshold
+
+    def remaining(self, key) -> float:
+        """الثواني الباقية حتى انتهاء الفتح (0 إذا كان مغلقًا)."""
+        entry = self.state.get(key)
+        return max(0.0, entry[1] - time.monotonic()) if entry else 0.0
+
+    def open_count(self) -> int:
+        now = time.monotonic()
+        with self.lock:
+            return sum(1 for _, until in self.state.values() if until > now)
+
+
+class EditHealth:
+    """قاطع لكل محادثة، مع عزل الرسائل التي لم تعد تقبل التعديل.
+
+    الرسالة التي لها محاولة معلقة في طابور إعادة المحاولة تُترك لعماله، فلا تلمسها الدورات حتى تنجح أو تسقط.
+    """
+
+    def __init__(self):
+        # خطأ صلاحيات واحد يكفي لإيقاف المحادثة
+        self.chats = CircuitBreaker(1, BREAKER_BACKOFF, BREAKER_MAX_BACKOFF)
+
+    def allow(self, chat_id, msg_id) -> bool:
+        """هل يُسمح بمحاولة تعديل هذه الرسالة الآن؟ (فحص قاموسين بلا قفل)"""
+        if self.chats.allow(chat_id) and not retry_queue.pending(chat_id, msg_id):
+            return True
+        metrics.inc("edit_breaker_skipped_total")
+        return False
+
+    def succeeded(self, chat_id, msg_id):
+        if self.chats.success(chat_id):
+            logging.info(f"عادت تعديلات المحادثة {chat_id} بعد إيقاف مؤقت")
+            self.retry_later(("breaker", chat_id), 0, partial(resync_chat_posts, chat_id))
+        retry_queue.done(chat_id, msg_id)
+
+    def failed(self, chat_id, msg_id, error):
+        """خطأ دائم: عزل الرسالة المحذوفة أو إيقاف المحادثة التي فقدنا صلاحيتنا فيها."""
+        scope = edit_failure_scope(error)
+        if scope == "message":
+            retry_queue.done(chat_id, msg_id)
+            quarantine_post(lookup_post(chat_id, msg_id), str(error))
+        elif scope == "chat":
+            delay = self.chats.failure(chat_id)
+            metrics.inc("edit_breaker_trips_total", scope="chat")
+            logging.warning(f"إيقاف تعديلات المحادثة {chat_id} لمدة {delay:.0f}s: {error}")
+            self.retry_later(("breaker", chat_id), delay, partial(resync_chat_posts, chat_id))
+
+    @staticmethod
+    def retry_later(key, delay: float, callback):
+        """إعادة المنشورات للجدول عند انتهاء مدة الفتح (بمؤقت الانتهاء نفسه)."""
+        expiry_dispatcher.arm(key, datetime.datetime.now() + datetime.timedelta(seconds=delay), callback)
+
+    def reset(self, chat_id, msg_id):
+        self.chats.success(chat_id)
+        retry_queue.done(chat_id, msg_id)
+
+
+def edit_failed(chat_id, msg_id, text: str, url: str, label: str, error):
+    """بعد آخر محاولة فاشلة: الأخطاء الدائمة للقواطع والعزل، والعابرة لطابور إعادة المحاولة."""
+    if edit_failure_scope(error) == "transient":
+        retry_queue.push(chat_id, msg_id, text, url, label, error)
+    else:
+        edit_health.failed(chat_id, msg_id, error)
+
+
+def settle_edit_attempt(limiter, chat_id, msg_id, text: str, url: str, label: str, started: float, error,
+                        attempt: int, attempts: int):
+    """تسجيل نتيجة محاولة تعديل واحدة (مشترك بين EditEngine و AsyncEditEngine).
+
+    يعيد True عند النجاح، False عند التوقف، أو عدد الثواني قبل المحاولة التالية.
+    """
+    record_edit(chat_id, started, error)
+    if error is None or (isinstance(error, BadRequest) and is_not_modified(error)):
+        remember_render(chat_id, msg_id, text, url)
+        edit_health.succeeded(chat_id, msg_id)
+        return True
+    if isinstance(error, RetryAfter):
+        wait = getattr(error, 'retry_after', 5)
+        logging.warning(f"Rate limited updating {label} in chat {chat_id}. Pausing this chat for {wait}s")
+        limiter.pause(chat_id, wait)
+        if attempt == attempts:
+            edit_failed(chat_id, msg_id, text, url, label, error)
+            return False
+        return 0.0
+    if isinstance(error, BadRequest) and edit_failure_scope(error) != "transient":
+        # الرسالة محذوفة أو فقدنا الصلاحية: إعادة المحاولة لن تفيد
+        logging.warning(f"Giving up on {label} in chat {chat_id}: {error}")
+        edit_failed(chat_id, msg_id, text, url, label, error)
+        return False
+    if isinstance(error, (BadRequest, NetworkError)):
+        kind = "Bad request" if isinstance(error, BadRequest) else "Network error"
+        logging.warning(f"{kind} updating {label} (attempt {attempt}/{attempts}): {error}")
+        if attempt < attempts:
+            return 1.0
+        logging.error(f"Failed updating {label} after {attempts} attempts: {error}")
+        edit_failed(chat_id, msg_id, text, url, label, error)
+        return False
+    if isinstance(error, Unauthorized):
+        logging.error(f"Permission error updating {label} (message {msg_id}) in chat {chat_id}: {error}. Make sure the bot is admin and can edit messages in that chat.")
+        edit_failed(chat_id, msg_id, text, url, label, error)
+        return False
+    logging.error(f"Unexpected error updating {label}: {error}", exc_info=error)
+    return False
+
+
+def lookup_post(chat_id, message_id):
+    """المنشور بمفتاحه، أو نسخة الجدول في عملية عامل موزع (لا تحمل posts)."""
+    post = find_post(chat_id, message_id)
+    if post is None:
+        entry = countdown_scheduler.entries.get((chat_id, message_id))
+        post = entry[1] if entry else None
+    return post
+
+
+def resync_chat_posts(chat_id):
+    """إعادة منشورات محادثة للجدول بعد انتهاء إيقافها (الأزرار المطابقة لا تُرسل مجددًا)."""
+    for post_id in posts.matching(chat_id) or ():
+        post = posts.get(post_id)
+        if post is not None:
+            countdown_scheduler.add(post)
+
+
+def quarantine_post(post, reason: str):
+    """عزل منشور لم تعد رسالته تقبل التعديل: يخرج من دورات التحديث حتى يعيد الأدمن تفعيله."""
+    if post is None or post.get('post_quarantine'):
+        return
+    post['post_quarantine'] = reason[:200]
+    countdown_scheduler.remove(post)
+    retry_queue.done(post.get('chat_id'), post.get('message_id'))
+    persist_post_update(post, 'post_quarantine')
+    logging.warning(f"عزل المنشور #{post.get('post_id')} (الرسالة {post.get('message_id')} في {post.get('chat_id')}): {reason}")
+
+
+def reactivate_post(post):
+    """إعادة منشور معزول إلى دورات التحديث (يُرسل زره من جديد في الدورة التالية)."""
+    post['post_quarantine'] = None
+    edit_health.reset(post.get('chat_id'), post.get('message_id'))
+    forget_render(post.get('chat_id'), post.get('message_id'))
+    persist_post_update(post, 'post_quarantine')
+    countdown_scheduler.add(post)
+
+
+edit_health = EditHealth()
+
+
+class PassStats:
+    """إحصائيات دورة تحديث واحدة."""
+
+    def __init__(self, rendered_at: float):
+        self.rendered_at = rendered_at
+        self.started = time.monotonic()
+        self.finished = None
+        self.edits = 0
+        self.failed = 0
+        self.max_lag = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, ok: bool):
+        with self.lock:
+            if ok:
+                lag = time.monotonic() - self.rendered_at
+                self.edits += 1
+                self.max_lag = max(self.max_lag, lag)
+            else:
+                self.failed += 1
+        if ok:
+            metrics.observe("countdown_staleness_seconds", lag)
+
+    def finish(self, backlog: int):
+        self.finished = time.monotonic()
+        metrics.observe("countdown_pass_seconds", self.duration)
+        metrics.set("countdown_pass_backlog", backlog)
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.edits / self.duration if self.duration > 0 else 0.0
+
+
+class EditEngine:
+    """مجموعة عمال محدودة تحدّث أزرار المنشورات بالتوازي مع احترام حدود Telegram.
+
+    كل محادثة تُعالج في مسار (lane) متسلسل، والمسارات تعمل بالتوازي داخل المجموعة.
+    """
+
+    def __init__(self, limiter: RateLimiter, workers: int):
+        self.limiter = limiter
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="edit")
+
+    def edit(self, bot, chat_id, msg_id, text: str, url: str, label: str, attempts: int = 2, priority: bool = False) -> bool:
+        """تعديل زر رسالة واحدة مع إعادة المحاولة. يعيد True عند النجاح."""
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(text, url=url)]])
+        for attempt in range(1, attempts + 1):
+            self.limiter.acquire(chat_id, priority)
+            started = time.monotonic()
+            try:
+                bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg_id, reply_markup=reply_markup)
+                error = None
+            except Exception as e:
+                error = e
+            result = settle_edit_attempt(self.limiter, chat_id, msg_id, text, url, label, started, error, attempt, attempts)
+            if isinstance(result, bool):
+                return result
+            time.sleep(result)
+        return False
+
+    def run_job(self, bot, job, stats: PassStats):
+        chat_id, msg_id, text, url, label = job
+        if not edit_health.allow(chat_id, msg_id):
+            return  # فُتح القاطع أثناء الدورة (مثلاً فقدنا صلاحية المحادثة)
+        # محاولة واحدة: الفشل العابر ينتقل لطابور إعادة المحاولة بدل النوم في مسار المحادثة
+        try:
+            ok = self.edit(bot, chat_id, msg_id, text, url, label, attempts=1)
+        except Exception:
+            logging.exception(f"Error while processing {label}")
+            ok = False
+        stats.record(ok)
+        if ok and label.startswith("expired"):
+            logging.info(f"تم تحديث المنشور المنتهي ({label}) برسالة النهاية")
+
+    def run_lane(self, bot, chat_id, lane: deque, stats: PassStats, lane_done):
+        """ينفذ تعديلات المسار ما دام لقناته رصيد فوري، ثم يعيد الباقي إلى آخر طابور العمال.
+
+        هكذا لا يحتجز مسار قناة مزدحمة عاملاً طوال الدورة وهو ينتظر حدها، وتتقدم بقية القنوات بالتناوب.
+        """
+        while lane:
+            self.run_job(bot, lane.popleft(), stats)
+            if self.limiter.chat_delay(chat_id) > 0:
+                break
+        if lane:
+            self.executor.submit(tracer.bind(self.run_lane), bot, chat_id, lane, stats, lane_done)
+        else:
+            lane_done()
+
+    def run_pass(self, bot, jobs, rendered_at: float = None) -> PassStats:
+        """يوزع المهام (chat_id, message_id, text, url, label) على مسارات المحادثات وينتظر انتهاءها."""
+        stats = PassStats(rendered_at if rendered_at is not None else time.monotonic())
+        lanes = {}
+        for job in jobs:
+            lanes.setdefault(job[0], deque()).append(job)
+        remaining = [len(lanes)]
+        finished = threading.Condition()
+
+        def lane_done():
+            with finished:
+                remaining[0] -= 1
+                finished.notify()
+
+        run_lane = tracer.bind(self.run_lane)
+        for chat_id, lane in lanes.items():
+            self.executor.submit(run_lane, bot, chat_id, lane, stats, lane_done)
+        with finished:
+            finished.wait_for(lambda: remaining[0] == 0)
+        stats.finish(len(jobs))
+        return stats
+
+
+def resolve_bot(bot=None) -> Bot:
+    """Accept an Updater, a Bot, or None (fallback to the shared pooled Bot)."""
+    # نفحص Bot أولاً: الخاصية Bot.bot تستدعي get_me عبر الشبكة
+    if isinstance(bot, Bot):
+        return bot
+    if isinstance(getattr(bot, 'bot', None), Bot):
+        return bot.bot
+    return get_bot()
+
+
+edit_engine = EditEngine(
+    RateLimiter(EDIT_RATE_GLOBAL, EDIT_RATE_PER_CHAT, EDIT_BURST_PER_CHAT, parse_channel_rates(CHANNEL_EDIT_RATES)),
+    EDIT_WORKERS,
+)
+
+
 def update_all_posts(bot=None):
     """Iterate over saved posts and update each inline button to show its remaining time."""
     if not posts:
         return
 
-    # Resolve Bot instance
-    actual_bot = None
-    try:
-        if hasattr(bot, 'bot') and isinstance(getattr(bot, 'bot'), Bot):
-            actual_bot = bot.bot
-        elif isinstance(bot, Bot):
-            actual_bot = bot
-        else:
-            actual_bot = Bot(BOT_TOKEN)
-    except Exception:
-        actual_bot = Bot(BOT_TOKEN)
+    actual_bot = resolve_bot(bot)
 
     now = datetime.datetime.now()
+    rendered_at = time.monotonic()
     active_posts = 0
+    skipped = 0
+    jobs = []
 
     logging.info(f"update_all_posts: فحص {len(posts)} منشور محفوظ")
 
-    for idx, p in enumerate(list(posts)):
-        try:
-            logging.debug(f"فحص المنشور رقم {idx}: message_id={p.get('message_id')} date={p.get('post_date')}")
-            post_date = p.get('post_date')
-            chat_id = p.get('chat_id')
-            msg_id = p.get('message_id')
-            post_link = p.get('post_link')
+    def queue(p, countdown_text, label):
+        nonlocal skipped
+        chat_id = p.get('chat_id')
+        msg_id = p.get('message_id')
+        if not chat_id or not msg_id:
+            # لا توجد بيانات كافية للتحديث
+            return
+        if p.get('post_quarantine') or not edit_health.allow(chat_id, msg_id):
+            # رسالة معزولة أو قاطعها مفتوح: لا تستهلك من حصة الطلبات
+            return
+        url = effective_button_url(p.get('post_link'), chat_id)
+        if render_unchanged(chat_id, msg_id, countdown_text, url):
+            # الزر المعروض مطابق بالفعل، لا حاجة لطلب شبكة
+            skipped += 1
+            return
+        jobs.append((chat_id, msg_id, countdown_text, url, label))
+
+    # المنشورات المنتهية تظهر رسالة النهاية (المنشورات بلا تاريخ تُتجاهل)
+    for p in posts.expired(now):
+        if p.get('post_date'):
+            queue(p, custom_end_message, f"expired post {p.get('message_id')}")
+
+    # النشطة مرتبة حسب الموعد، ونص الزر يُحسب مرة لكل مجموعة تنتهي في الدقيقة نفسها
+    for group, countdown_text in posts.label_groups(now):
+        active_posts += len(group)
+        for p in group:
+            queue(p, countdown_text, f"post {p.get('message_id')}")
+
+    stats = edit_engine.run_pass(actual_bot, jobs, rendered_at=rendered_at)
+    logging.info(
+        f"update_all_posts: {stats.edits}/{len(jobs)} تعديل خلال {stats.duration:.2f}s "
+        f"({stats.throughput:.1f} تعديل/ث، أقصى تأخير {stats.max_lag:.2f}s، فشل {stats.failed}، بدون تغيير {skipped})"
+    )
 
-            if not post_date or not chat_id or not msg_id:
-                # لا توجد بيانات كافية للتحديث
-                logging.debug(f"تجاهل المنشور رقم {idx}: بيانات ناقصة")
-                continue
+    if active_posts > 0:
+        logging.info(f"تم تحديث {active_posts} منشور نشط بنجاح")
+    else:
+        logging.info("لا توجد منشورات نشطة حاليًا")
 
-            if now >= post_date:
-                # المنشور انتهى، نحدثه ليظهر رسالة النهاية
-                logging.debug(f"تحديث المنشور المنتهي رقم {idx}: انتهى في {post_date}")
 
-                # استخدم رسالة النهاية المخصصة أو الافتراضية
-                end_message = custom_end_message if custom_end_message != "✅ تم الوصول إلى اليوم المحدد" else "✅ تم الوصول إلى اليوم المحدد"
-                countdown_text = end_message
+# --- جدول مواعيد تحديث المنشورات ---
+# أقصى عدد من المنشورات المستحقة تُرسم في تمريرة واحدة؛ عند الإقلاع تكون كلها مستحقة فورًا،
+# فتخرج تعديلات الأقرب انتهاءً قبل رسم البقية
+COUNTDOWN_BATCH = int(os.getenv("COUNTDOWN_BATCH", "2000"))
 
-                keyboard = [[InlineKeyboardButton(countdown_text, url=effective_button_url(post_link))]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
 
-                # محاولة التحديث مع إعادة المحاولة عند أخطاء الشبكة
-                attempts = 2
-                for attempt in range(1, attempts + 1):
-                    try:
-                        actual_bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg_id, reply_markup=reply_markup)
-                        logging.info(f"تم تحديث المنشور المنتهي رقم {idx} برسالة النهاية")
-                        break
-                    except RetryAfter as e:
-                        wait = getattr(e, 'retry_after', 5)
-                        logging.warning(f"Rate limited updating expired post {idx}. Sleeping {wait}s")
-                        time.sleep(wait)
-                    except NetworkError as e:
-                        logging.warning(f"Network error updating expired post {idx} (attempt {attempt}/{attempts}): {e}")
-                        if attempt < attempts:
-                            time.sleep(1)
-                            continue
-                        else:
-                            logging.error(f"Failed updating expired post {idx} after {attempts} attempts: {e}")
-                    except Unauthorized as e:
-                        logging.error(f"Permission error updating expired post {idx} (message {msg_id}) in chat {chat_id}: {e}. Make sure the bot is admin and can edit messages in that chat.")
-                        break
-                    except Exception as e:
-                        logging.exception(f"Unexpected error updating expired post {idx}: {e}")
-                        break
+class CountdownScheduler:
+    """كومة (heap) مرتبة حسب موعد التغيّر المرئي التالي لكل منشور.
+
+    العامل ينام حتى أقرب موعد فقط، ثم يحدّث المنشورات المستحقة ويعيد جدولتها،
+    فتكون الكلفة O(log n) لكل تغيّر فعلي بدلاً من O(n) كل دقيقة.
+    """
 
+    # الحد الأقصى للنوم دفعة واحدة، لتدارك تغيّر ساعة النظام
+    MAX_SLEEP = 60
+
+    def __init__(self, engine: EditEngine):
+        self.engine = engine
+        self.heap = []  # (due, seq, key)
+        self.entries = {}  # key -> (seq, post)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.thread = None
+        self.bot = None
+        # يُستدعى عند إضافة موعد جديد (يستخدمه وضع asyncio لإيقاظ الحلقة)
+        self.wakeup = None
+        # guard(chat_id) -> bool: هل يُسمح لهذه العملية بتعديل رسائل المحادثة؟
+        self.guard = None
+
+    @staticmethod
+    def key(post):
+        return (post.get('chat_id'), post.get('message_id'))
+
+    def add(self, post, due: datetime.datetime = None):
+        """إضافة منشور أو إعادة جدولته (يُلغي أي موعد سابق له)."""
+        if not post.get('chat_id') or not post.get('message_id') or not post.get('post_date'):
+            return
+        if post.get('post_quarantine'):
+            self.remove(post)
+            return
+        # في وضع sharded تحدّث عمليات العمال فقط (لها guard) الأزرار؛ العملية الرئيسية لا تسحب من الكومة
+        if COUNTDOWN_MODE == "sharded" and self.guard is None:
+            return
+        key = self.key(post)
+        with self.cond:
+            self.seq += 1
+            self.entries[key] = (self.seq, post)
+            heapq.heappush(self.heap, (due or datetime.datetime.now(), self.seq, key))
+            self.cond.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+        # التحول إلى رسالة النهاية يتولاه مؤقت الانتهاء (بأولوية وبدقة الثانية)
+        if post.get('post_date') > datetime.datetime.now():
+            expiry_dispatcher.arm(key, post.get('post_date'), partial(expire_post, post))
+        else:
+            expiry_dispatcher.disarm(key)
+
+    def remove(self, post):
+        """إلغاء جدولة منشور (المدخل القديم في الكومة يُهمل عند سحبه)."""
+        with self.cond:
+            self.entries.pop(self.key(post), None)
+        expiry_dispatcher.disarm(self.key(post))
+
+    def reset(self, all_posts):
+        """جدولة كل المنشورات فورًا، الأقرب انتهاءً أولًا.
+
+        مثل add لكل منشور، لكن الكومة تُبنى دفعة واحدة ومؤقتات الانتهاء تُسلَّح تحت قفل واحد،
+        فلا تتأخر أول تمريرة عند الإقلاع بمئات آلاف الإضافات المنفردة.
+        """
+        now = datetime.datetime.now()
+        expiry_dispatcher.disarm_all(keep=(TIMER_EXPIRY, TIMER_REFRESH))
+        arm = COUNTDOWN_MODE != "sharded" or self.guard is not None
+        timers = []
+        with gc_paused():
+            with self.cond:
+                self.heap = []
+                self.entries = {}
+                for p in sorted(all_posts, key=lambda p: p.deadline):
+                    if not p.chat_id or not p.message_id or not p.post_date or p.post_quarantine:
+                        continue
+                    key = (p.chat_id, p.message_id)
+                    self.seq += 1
+                    self.entries[key] = (self.seq, p)
+                    # كلها مستحقة الآن بترتيب seq، فالقائمة مرتبة وهي كومة صالحة
+                    self.heap.append((now, self.seq, key))
+                    if arm and p.post_date > now:
+                        timers.append((key, p.post_date, partial(expire_post, p)))
+                self.cond.notify()
+            expiry_dispatcher.arm_many(timers)
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def discard_stale(self):
+        while self.heap and self.entries.get(self.heap[0][2], (None,))[0] != self.heap[0][1]:
+            heapq.heappop(self.heap)  # مدخل قديم أو محذوف
+
+    def seconds_until_next(self, now: datetime.datetime) -> float:
+        """الثواني حتى أقرب موعد (بحد أقصى MAX_SLEEP)."""
+        with self.cond:
+            self.discard_stale()
+            if not self.heap:
+                return self.MAX_SLEEP
+            return max(0.0, min(self.MAX_SLEEP, (self.heap[0][0] - now).total_seconds()))
+
+    def pop_ready(self, now: datetime.datetime, limit: int = None) -> list:
+        """سحب المنشورات التي حان موعدها دون انتظار (بحد أقصى limit إن حُدد)."""
+        due_items = []
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now and (limit is None or len(due_items) < limit):
+                due, seq, key = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if entry and entry[0] == seq:
+                    due_items.append((due, entry[1]))
+                    del self.entries[key]
+        return due_items
+
+    def pop_due(self):
+        """ينتظر حتى يحين أقرب موعد ثم يعيد المنشورات المستحقة (حتى COUNTDOWN_BATCH) مع مواعيدها."""
+        with self.cond:
+            while True:
+                now = datetime.datetime.now()
+                timeout = self.seconds_until_next(now)
+                if timeout <= 0:
+                    return self.pop_ready(now, COUNTDOWN_BATCH)
+                self.cond.wait(timeout)
+
+    def collect_jobs(self, due_items) -> list:
+        """رسم أزرار المنشورات المستحقة وإعادة جدولتها. يعيد مهام التعديل اللازمة فقط."""
+        jobs = []
+        for due, p in due_items:
+            post_date = p.get('post_date')
+            if not post_date:
+                continue
+            # نرسم الزر بعد حد الدقيقة مباشرة حتى لا يظهر الرقم القديم عند الاستيقاظ في اللحظة نفسها
+            now = max(datetime.datetime.now(), due + datetime.timedelta(milliseconds=1))
+            if now >= post_date:
+                text = custom_end_message
+                label = f"expired post {p.get('message_id')}"
+            else:
+                text = countdown_label(post_date, now, p.get('post_resolution'))
+                label = f"post {p.get('message_id')}"
+                due = next_label_change(post_date, now, p.get('post_resolution'))
+                if due < post_date:
+                    self.add(p, due)
+            url = effective_button_url(p.get('post_link'), p.get('chat_id'))
+            if self.guard is not None and not self.guard(p.get('chat_id')):
+                # المحادثة ليست ملكنا حاليًا (وضع العمال الموزعين)
                 continue
+            if not edit_health.allow(p.get('chat_id'), p.get('message_id')):
+                continue  # يعيده القاطع للجدول عند انتهاء مدة الفتح
+            if not render_unchanged(p.get('chat_id'), p.get('message_id'), text, url):
+                jobs.append((p.get('chat_id'), p.get('message_id'), text, url, label))
+        return jobs
+
+    @staticmethod
+    def log_stats(stats: PassStats, total: int):
+        logging.info(
+            f"countdown: {stats.edits}/{total} تعديل خلال {stats.duration:.2f}s "
+            f"({stats.throughput:.1f} تعديل/ث، أقصى تأخير {stats.max_lag:.2f}s، فشل {stats.failed})"
+        )
 
-            active_posts += 1
-            logging.debug(f"تحديث المنشور النشط رقم {idx} message_id={msg_id} date={post_date}")
+    def run_once(self, bot):
+        due_items = self.pop_due()
+        rendered_at = time.monotonic()
+        lag = (datetime.datetime.now() - due_items[0][0]).total_seconds() if due_items else 0.0
+        with tracer.span("job", "countdown_pass", lag):
+            jobs = self.collect_jobs(due_items)
+            if jobs:
+                self.log_stats(self.engine.run_pass(bot, jobs, rendered_at=rendered_at), len(jobs))
+        if not jobs:
+            report_first_update()  # كل الأزرار محدثة أصلًا
+
+    def run(self, bot):
+        while True:
+            try:
+                self.run_once(bot)
+            except Exception:
+                logging.exception("Error in countdown scheduler")
+                time.sleep(1)
+
+    def start(self, bot, all_posts):
+        """تحميل كل المنشورات (مستحقة فورًا لمزامنة الأزرار) وتشغيل العامل في الخلفية."""
+        self.bot = resolve_bot(bot)
+        with startup.phase("schedule_posts"):
+            self.reset(all_posts)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, args=(self.bot,), name="countdown", daemon=True)
+            self.thread.start()
+
+
+def report_first_update():
+    """طباعة ملخص أزمنة الإقلاع عند أول تعديل ناجح (أو أول تمريرة لا تحتاج تعديلًا)."""
+    if startup.mark("first_update"):
+        print(f"⏱️ أزمنة الإقلاع: {startup.summary()}")
+
+
+# --- إطلاق الانتهاء في موعده ---
+# لكل منشور (وللمؤقت العام) مؤقت انتهاء لمرة واحدة في خيط مستقل، فيتحول الزر إلى رسالة النهاية في ثانيته
+# ولا ينتظر انتهاء دورة تحديث طويلة. الانتظار بـ Condition.wait (ساعة monotonic) على شرائح لا تتجاوز
+# EXPIRY_RECHECK ثانية، ويُعاد حساب المتبقي من ساعة النظام عند كل استيقاظ لتدارك تعديلها (NTP).
+# تعديلات الانتهاء تُرسل بأولوية في RateLimiter فتسبق تحديثات العد الروتينية المنتظرة.
+EXPIRY_RECHECK = float(os.getenv("EXPIRY_RECHECK", "5"))
+EXPIRY_WORKERS = int(os.getenv("EXPIRY_WORKERS", "4"))
+TIMER_EXPIRY = "global-timer"
+TIMER_REFRESH = "global-timer-refresh"
+
+
+class ExpiryDispatcher:
+    """مؤقتات لمرة واحدة: key -> (موعد بساعة النظام، دالة تُستدعى عند حلوله)."""
+
+    def __init__(self, workers: int, name: str = "expiry"):
+        self.name = name
+        self.cond = threading.Condition()
+        self.heap = []  # (deadline, seq, key)
+        self.armed = {}  # key -> (seq, deadline, callback)
+        self.seq = 0
+        self.workers = workers
+        self.executor = None
+        self.thread = None
+
+    def arm(self, key, deadline: datetime.datetime, callback):
+        self.arm_many([(key, deadline, callback)])
+
+    def arm_many(self, timers):
+        """تسليح عدة مؤقتات (key, deadline, callback) تحت قفل واحد."""
+        if not timers:
+            return
+        with self.cond:
+            for key, deadline, callback in timers:
+                current = self.armed.get(key)
+                if current is not None and current[1] == deadline:
+                    self.armed[key] = (current[0], deadline, callback)
+                    continue
+                self.seq += 1
+                self.armed[key] = (self.seq, deadline, callback)
+                heapq.heappush(self.heap, (deadline, self.seq, key))
+            self.cond.notify()
+            if self.thread is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def disarm(self, key):
+        with self.cond:
+            self.armed.pop(key, None)
+
+    def disarm_all(self, keep=()):
+        with self.cond:
+            self.armed = {k: v for k, v in self.armed.items() if k in keep}
+
+    def pop_ready(self, now: datetime.datetime) -> list:
+        ready = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, seq, key = heapq.heappop(self.heap)
+            entry = self.armed.get(key)
+            if entry is not None and entry[0] == seq:
+                del self.armed[key]
+                ready.append((deadline, entry[2]))
+        return ready
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = datetime.datetime.now()
+                    ready = self.pop_ready(now)
+                    if ready:
+                        break
+                    while self.heap and self.heap[0][1] != self.armed.get(self.heap[0][2], (None,))[0]:
+                        heapq.heappop(self.heap)  # ملغى أو أعيد تسليحه
+                    timeout = (self.heap[0][0] - now).total_seconds() if self.heap else None
+                    self.cond.wait(EXPIRY_RECHECK if timeout is None else min(timeout, EXPIRY_RECHECK))
+            for deadline, callback in ready:
+                self.executor.submit(self.fire, deadline, callback)
+
+    def fire(self, deadline: datetime.datetime, callback):
+        lag = (datetime.datetime.now() - deadline).total_seconds()
+        metrics.observe(f"{self.name}_fire_lag_seconds", lag)
+        try:
+            with tracer.span("job", f"{self.name}:{callable_name(callback)}", lag):
+                callback()
+        except Exception:
+            logging.exception(f"{self.name}: خطأ أثناء تنفيذ المؤقت")
 
-            delta = post_date - now
-            days = delta.days
-            hours, rem = divmod(delta.seconds, 3600)
-            minutes, _ = divmod(rem, 60)
-            countdown_text = f"⏳ {days} يوم : {hours} ساعة : {minutes} دقيقة"
 
-            keyboard = [[InlineKeyboardButton(countdown_text, url=effective_button_url(post_link))]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+def expire_post(post):
+    """تحويل زر منشور إلى رسالة النهاية لحظة انتهائه."""
+    post_date = post.get('post_date')
+    chat_id, msg_id = post.get('chat_id'), post.get('message_id')
+    if not post_date or datetime.datetime.now() < post_date:
+        return  # تغيّر الموعد بعد التسليح
+    if countdown_scheduler.guard is not None and not countdown_scheduler.guard(chat_id):
+        return
+    if post.get('post_quarantine') or not edit_health.allow(chat_id, msg_id):
+        return
+    url = effective_button_url(post.get('post_link'), chat_id)
+    if render_unchanged(chat_id, msg_id, custom_end_message, url):
+        return
+    label = f"expired post {msg_id}"
+    if async_runtime is not None:
+        async_runtime.submit_edit((chat_id, msg_id, custom_end_message, url), label=label, attempts=3, priority=True)
+        return
+    bot = countdown_scheduler.bot or get_bot()
+    if edit_engine.edit(bot, chat_id, msg_id, custom_end_message, url, label, attempts=3, priority=True):
+        metrics.observe("expiry_edit_lag_seconds", (datetime.datetime.now() - post_date).total_seconds())
+        logging.info(f"تم تحديث المنشور المنتهي ({label}) برسالة النهاية")
 
-            # Try updating with retries per post
-            attempts = 2
-            for attempt in range(1, attempts + 1):
-                try:
-                    actual_bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg_id, reply_markup=reply_markup)
-                    break
-                except RetryAfter as e:
-                    wait = getattr(e, 'retry_after', 5)
-                    logging.warning(f"Rate limited updating post {idx}. Sleeping {wait}s")
-                    time.sleep(wait)
-                except NetworkError as e:
-                    logging.warning(f"Network error updating post {idx} (attempt {attempt}/{attempts}): {e}")
-                    if attempt < attempts:
-                        time.sleep(1)
-                        continue
-                    else:
-                        logging.error(f"Failed updating post {idx} after {attempts} attempts: {e}")
-                except Unauthorized as e:
-                    logging.error(f"Permission error updating post {idx} (message {msg_id}) in chat {chat_id}: {e}. Make sure the bot is admin and can edit messages in that chat.")
-                    break
-                except Exception as e:
-                    logging.exception(f"Unexpected error updating post {idx}: {e}")
-                    break
 
-        except Exception:
-            logging.exception(f"Error while processing post at index {idx}")
+def expire_timer():
+    """قلب رسالة المؤقت العام إلى رسالة النهاية في موعده، أو تحديث زرها عند تغيّر نصه."""
+    if async_runtime is not None:
+        # حالة المؤقت تُعدّل على خيط الحالة فقط في وضع asyncio
+        async_runtime.state_executor.submit(refresh_timer)
+    else:
+        refresh_timer()
 
-    if active_posts > 0:
-        logging.info(f"تم تحديث {active_posts} منشور نشط بنجاح")
+
+def refresh_timer():
+    """تحديث زر المؤقت العام ثم تسليح موعد تغيّره التالي."""
+    update_timer()
+    sync_timer_expiry()
+
+
+def sync_timer_expiry():
+    """تسليح مؤقتي المؤقت العام حسب حالته الحالية: التغيّر التالي لنص زره وموعد انتهائه (أو إلغاؤهما)."""
+    now = datetime.datetime.now()
+    if timer_active and target_date and timer_message_id and target_date > now:
+        timers = [(TIMER_EXPIRY, target_date, expire_timer)]
+        due = next_label_change(target_date, now)
+        if due < target_date:
+            # بعد حد التغيّر مباشرة حتى لا يظهر الرقم القديم (كما في جدول المنشورات)
+            timers.append((TIMER_REFRESH, max(due, now) + datetime.timedelta(milliseconds=1), expire_timer))
+        else:
+            expiry_dispatcher.disarm(TIMER_REFRESH)
+        expiry_dispatcher.arm_many(timers)
     else:
-        logging.info("لا توجد منشورات نشطة حاليًا")
+        expiry_dispatcher.disarm(TIMER_EXPIRY)
+        expiry_dispatcher.disarm(TIMER_REFRESH)
+
+
+expiry_dispatcher = ExpiryDispatcher(EXPIRY_WORKERS)
+
+
+# --- إعادة المحاولة المؤجلة ---
+# التعديل الذي يفشل بخطأ عابر (شبكة، 429، BadRequest غير دائم) لا يُعاد داخل الدورة ولا على خيط الجدولة، بل
+# يدخل طابورًا دائمًا مفتاحه (chat_id, message_id): فشل جديد للرسالة نفسها يحدّث مدخلها ولا يضيف آخر.
+# المحاولة رقم n تُؤجل RETRY_BASE_DELAY * 2^(n-1) ثانية (حتى RETRY_MAX_DELAY) مع تشويش عشوائي حتى النصف،
+# وينفذها RETRY_WORKERS عمال بموزع مؤقتات مستقل. عند التنفيذ يُحسب الزر المطلوب الآن (لا النص القديم المحفوظ).
+# بعد RETRY_MAX_ATTEMPTS محاولة فاشلة (منها الأولى) يُنقل المدخل إلى DEAD_LETTER_FILE (سطر JSON لكل مدخل) ليراجعه الأدمن من
+# اللوحة، ويُعزل منشوره إذا كان آخر خطأ رفضًا من Telegram (BadRequest). الطابور نفسه سجل إلحاقي في
+# RETRY_QUEUE_FILE يُضغط دوريًا ويُستعاد عند بدء التشغيل.
+RETRY_QUEUE_FILE = os.getenv("RETRY_QUEUE_FILE", "retry_queue.journal")
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "dead_letters.jsonl")
+RETRY_WORKERS = int(os.getenv("RETRY_WORKERS", "2"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "900"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "8"))
+
+
+def retry_delay(attempts: int) -> float:
+    """تأخير أسي مع تشويش حتى لا تعود إخفاقات انقطاع واحد كلها في اللحظة نفسها."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** min(attempts - 1, 30))
+    return random.uniform(delay / 2, delay)
+
+
+def current_render(chat_id, msg_id):
+    """(النص، الرابط) المطلوبان الآن لرسالة منشور أو رسالة المؤقت العام، أو None إذا لم تعد متتبعة."""
+    now = datetime.datetime.now()
+    post = lookup_post(chat_id, msg_id)
+    if post is not None:
+        post_date = post.get('post_date')
+        if post.get('post_quarantine') or not post_date:
+            return None
+        text = custom_end_message if now >= post_date else countdown_label(post_date, now, post.get('post_resolution'))
+        return text, effective_button_url(post.get('post_link'), chat_id)
+    if (chat_id, msg_id) == (timer_chat_id, timer_message_id) and target_date:
+        text = custom_end_message if now >= target_date else countdown_label(target_date, now)
+        return text, effective_button_url()
+    return None
+
+
+class RetryQueue:
+    """طابور دائم للتعديلات الفاشلة: (chat_id, message_id) -> آخر زر مطلوب وعدد المحاولات وموعد التالية."""
+
+    def __init__(self, path: str, dead_path: str, dispatcher: ExpiryDispatcher):
+        self.path = path
+        self.dead_path = dead_path
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()
+        self.dead_lock = threading.Lock()  # ملف الرسائل الميتة، حتى لا تُحجز عمليات الطابور أثناء الكتابة فيه
+        self.entries = {}
+        self.handle = None
+        self.journal_lines = 0
+        self.dead_count = 0
+
+    def pending(self, chat_id, msg_id) -> bool:
+        return (chat_id, msg_id) in self.entries
+
+    def push(self, chat_id, msg_id, text: str, url: str, label: str, error, delay: float = None):
+        """تسجيل فشل عابر: جدولة المحاولة التالية، أو النقل إلى ملف الرسائل الميتة بعد استنفاد المحاولات."""
+        key = (chat_id, msg_id)
+        with self.lock:
+            entry = dict(self.entries.get(key) or {"chat_id": chat_id, "message_id": msg_id, "attempts": 0,
+                                                     "first_failed": time.time()})
+            entry.update(text=text, url=url, label=label, error=str(error)[:300], attempts=entry["attempts"] + 1)
+            if entry["attempts"] >= RETRY_MAX_ATTEMPTS:
+                if self.entries.pop(key, None) is not None:
+                    self.log({"op": "done", "key": [chat_id, msg_id]})
+                exhausted = True
+            else:
+                if delay is None:
+                    delay = getattr(error, 'retry_after', None) if isinstance(error, RetryAfter) else retry_delay(entry["attempts"])
+                entry["due"] = time.time() + delay
+                self.entries[key] = entry
+                self.log({"op": "push", "entry": entry})
+                exhausted = False
+        if exhausted:
+            self.dispatcher.disarm(key)
+            self.dead_letter(entry, error)
+        else:
+            logging.info(f"إعادة محاولة {label} بعد {delay:.0f}s (المحاولة {entry['attempts']}/{RETRY_MAX_ATTEMPTS})")
+            self.arm(entry)
+
+    def done(self, chat_id, msg_id):
+        """إزالة الرسالة من الطابور (نجح تعديلها أو لم تعد متتبعة). فحص بلا قفل في المسار المعتاد."""
+        key = (chat_id, msg_id)
+        if key not in self.entries:
+            return
+        with self.lock:
+            if self.entries.pop(key, None) is None:
+                return
+            self.log({"op": "done", "key": [chat_id, msg_id]})
+        self.dispatcher.disarm(key)
+
+    def arm(self, entry: dict, delay: float = None):
+        due = time.time() + delay if delay is not None else entry["due"]
+        key = (entry["chat_id"], entry["message_id"])
+        self.dispatcher.arm(key, datetime.datetime.fromtimestamp(due), partial(self.retry, key))
+
+    def retry(self, key):
+        """ينفذه عامل إعادة المحاولة: يعيد حساب الزر المطلوب الآن ويحاول مرة واحدة."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        chat_id, msg_id = key
+        wait = edit_health.chats.remaining(chat_id)
+        if wait > 0:
+            # المحادثة موقوفة: ننتظر قاطعها دون احتساب محاولة
+            self.arm(entry, wait)
+            return
+        render = current_render(chat_id, msg_id)
+        if render is None or render_unchanged(chat_id, msg_id, *render):
+            self.done(chat_id, msg_id)
+            return
+        bot = countdown_scheduler.bot or get_bot()
+        ok = edit_engine.edit(bot, chat_id, msg_id, render[0], render[1], entry["label"], attempts=1)
+        metrics.inc("edit_retries_total", outcome="ok" if ok else "failed")
+        if not ok and key in self.entries and key not in self.dispatcher.armed:
+            # فشل لم يمر بالطابور (أُوقفت المحادثة أو خطأ غير متوقع): ننتظر القاطع، وإلا تُحتسب محاولة
+            wait = edit_health.chats.remaining(chat_id)
+            if wait > 0:
+                self.arm(entry, wait)
+            else:
+                self.push(chat_id, msg_id, render[0], render[1], entry["label"], "unexpected error")
+
+    def dead_letter(self, entry: dict, error):
+        record = dict(entry, dead_at=datetime.datetime.now().isoformat(timespec="seconds"))
+        with self.dead_lock:
+            with open(self.dead_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        with self.lock:
+            self.dead_count += 1
+        metrics.inc("edit_dead_letters_total")
+        logging.error(f"سقط تعديل {entry['label']} بعد {RETRY_MAX_ATTEMPTS} محاولات: {error}")
+        if isinstance(error, BadRequest):
+            quarantine_post(lookup_post(entry["chat_id"], entry["message_id"]),
+                            f"{RETRY_MAX_ATTEMPTS} محاولات فاشلة: {error}")
+
+    def dead_letters(self) -> list:
+        """مدخلات ملف الرسائل الميتة، آخر سجل لكل رسالة، الأحدث أولًا."""
+        latest = {}
+        try:
+            with open(self.dead_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        latest.pop((record["chat_id"], record["message_id"]), None)
+                        latest[(record["chat_id"], record["message_id"])] = record
+        except FileNotFoundError:
+            pass
+        return list(reversed(latest.values()))
+
+    def clear_dead_letters(self):
+        with self.dead_lock:
+            if os.path.exists(self.dead_path):
+                os.remove(self.dead_path)
+            with self.lock:
+                self.dead_count = 0
+
+    def requeue_dead_letters(self) -> int:
+        """إعادة الرسائل الميتة التي ما زالت متتبعة بعداد محاولات جديد، ثم تفريغ الملف.
+
+        المنشور الذي عُزل بسببها يُعاد تفعيله فيرجع للجدول مباشرة.
+        """
+        records = self.dead_letters()
+        self.clear_dead_letters()
+        count = 0
+        for record in records:
+            chat_id, msg_id = record["chat_id"], record["message_id"]
+            post = lookup_post(chat_id, msg_id)
+            if post is not None and post.get('post_quarantine'):
+                reactivate_post(post)
+                count += 1
+                continue
+            if current_render(chat_id, msg_id) is None:
+                continue
+            forget_render(chat_id, msg_id)
+            self.done(chat_id, msg_id)
+            self.push(chat_id, msg_id, record["text"], record["url"], record["label"], record.get("error", ""), delay=0)
+            count += 1
+        return count
+
+    def log(self, record: dict):
+        """سطر في سجل الطابور (تحت القفل)، مع ضغطه حين يكبر كثيرًا عن عدد المدخلات.
+
+        fsync لكل سطر: الفشل مسار نادر، والمدخل المسجل يجب أن يبقى بعد انقطاع الكهرباء.
+        """
+        if self.handle is None:
+            self.handle = open(self.path, "a", encoding="utf-8")
+        self.handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.journal_lines += 1
+        if self.journal_lines > max(100, 4 * len(self.entries)):
+            self.compact()
+
+    def compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps({"op": "push", "entry": entry}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self.handle is not None:
+            self.handle.close()
+        os.replace(tmp, self.path)
+        self.handle = open(self.path, "a", encoding="utf-8")
+        self.journal_lines = len(self.entries)
+
+    def load(self):
+        """استعادة الطابور من سجله وتسليح مواعيده (المتأخر منها يُنفذ فورًا)."""
+        entries = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # سطر أخير مبتور بعد توقف مفاجئ
+                    if record.get("op") == "push":
+                        entry = record["entry"]
+                        entries[(entry["chat_id"], entry["message_id"])] = entry
+                    elif record.get("op") == "done":
+                        entries.pop(tuple(record["key"]), None)
+        except FileNotFoundError:
+            pass
+        with self.dead_lock:
+            dead_count = len(self.dead_letters())
+        with self.lock:
+            self.dispatcher.disarm_all()
+            self.entries = entries
+            self.compact()
+            self.dead_count = dead_count
+        for entry in entries.values():
+            self.arm(entry)
+        if entries:
+            logging.info(f"استعادة {len(entries)} تعديل معلق في طابور إعادة المحاولة")
+
+
+retry_queue = RetryQueue(RETRY_QUEUE_FILE, DEAD_LETTER_FILE, ExpiryDispatcher(RETRY_WORKERS, name="retry"))
+
+
+# --- عمال العد التنازلي الموزعون ---
+# COUNTDOWN_MODE=sharded: العملية الرئيسية تبقي Updater لمعالجات الأدمن فقط، وتحديث الأزرار يتم في
+# عمليات منفصلة (python main.py worker). كل عامل يملك المحادثات التي تقع عليه في حلقة تجزئة متسقة
+# على chat_id، والتنسيق يتم عبر قاعدة SQLite المشتركة: نبضات العمال + عقود ملكية (lease) لكل محادثة،
+# فلا تُعدّل رسالة من عاملين في الوقت نفسه، وعند توقف عامل تنتقل محادثاته لغيره بعد انتهاء مدة عقده.
+COUNTDOWN_MODE = os.getenv("COUNTDOWN_MODE", "local").lower()
+WORKER_LEASE_TTL = float(os.getenv("WORKER_LEASE_TTL", "30"))
+SHARD_SYNC_INTERVAL = float(os.getenv("SHARD_SYNC_INTERVAL", "10"))
+# مدة حفظ سجل تغييرات القاعدة الذي يقرأ منه العمال (بالثواني)؛ العامل المتأخر أكثر منها يعيد التحميل كاملاً
+SHARD_CHANGES_TTL = float(os.getenv("SHARD_CHANGES_TTL", "600"))
+HASH_RING_VNODES = 64
+
+
+class HashRing:
+    """حلقة تجزئة متسقة مع عقد افتراضية، حتى لا تتحرك إلا محادثات العامل المضاف أو المتوقف."""
+
+    def __init__(self, nodes, vnodes: int = HASH_RING_VNODES):
+        self.ring = sorted(
+            (self.hash(f"{node}#{i}"), node)
+            for node in nodes
+            for i in range(vnodes)
+        )
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def hash(value) -> int:
+        return int.from_bytes(hashlib.md5(str(value).encode("utf-8")).digest()[:8], "big")
+
+    def owner(self, key):
+        if not self.ring:
+            return None
+        idx = bisect.bisect(self.points, self.hash(key)) % len(self.ring)
+        return self.ring[idx][1]
+
+
+class ShardWorker:
+    """عامل يحدّث أزرار المحادثات التي يملكها فقط."""
+
+    def __init__(self, store: "SqliteStorage", worker_id: str):
+        self.store = store
+        self.worker_id = worker_id
+        self.ring = HashRing([worker_id])
+        self.tracked = {}  # (chat_id, message_id) -> post
+        self.leases = {}  # chat_id -> وقت التجديد التالي
+        self.owned = set()
+        self.seq = None  # آخر تغيير قرأناه من سجل القاعدة
+
+    def holds(self, chat_id) -> bool:
+        """هل نملك المحادثة الآن؟ يجدد العقد عند الحاجة (نصف مدته) لتقليل الكتابة في القاعدة."""
+        if self.ring.owner(chat_id) != self.worker_id:
+            return False
+        now = time.time()
+        if self.leases.get(chat_id, 0) > now:
+            return True
+        if self.store.acquire_lease(chat_id, self.worker_id, now, WORKER_LEASE_TTL):
+            self.leases[chat_id] = now + WORKER_LEASE_TTL / 2
+            return True
+        self.leases.pop(chat_id, None)
+        return False
+
+    def sync(self):
+        """نبضة + إعادة بناء الحلقة + مزامنة منشورات الجزء الخاص بنا وإعداداته من القاعدة."""
+        global custom_end_message, button_link, channels
+        live = self.store.heartbeat(self.worker_id, time.time(), WORKER_LEASE_TTL)
+        if self.worker_id not in live:
+            live.append(self.worker_id)
+        self.ring = HashRing(live)
+        # حد Telegram العام لكل البوت، لذا يُقسم (المعدل والدفعة) على عدد العمال
+        edit_engine.limiter.global_bucket.resize(EDIT_RATE_GLOBAL / len(live), EDIT_RATE_GLOBAL / len(live))
+
+        settings_data = self.store.read_state().get("settings", {})
+        custom_end_message = settings_data.get("custom_end_message", "✅ تم الوصول إلى اليوم المحدد")
+        button_link = settings_data.get("button_link", "")
+        channels = parse_channels(settings_data.get("channels", []))
+
+        owned = {c for c in self.store.chat_ids() if self.ring.owner(c) == self.worker_id}
+        self.store.release_leases(self.worker_id, keep=owned)
+        for chat_id in list(self.leases):
+            if chat_id not in owned:
+                del self.leases[chat_id]
+
+        # القاعدة هي المرجع: قد يمسح الأدمن زرًا (مثل تعديل النص) من عملية أخرى. الاستثناء أزرارنا التي
+        # لم يكتبها write_behind بعد، فهي أحدث من القاعدة (ومسحها يعني إعادة تعديل رسائلها)
+        unflushed = write_behind.pending_keys()
+        self.forget(owned, unflushed)
+        changes = self.store.changes_since(self.seq) if self.seq is not None else None
+        if changes is None:
+            # أول مزامنة، أو حُذف من السجل ما لم نقرأه: تحميل كامل. الرقم يُقرأ قبل التحميل فلا يفوتنا تغيير
+            self.seq = self.store.change_seq()
+            self.load(owned, owned, unflushed)
+        else:
+            # تحميل كامل للمحادثات الجديدة علينا فقط، ثم المفاتيح التي تغيّرت (الغائب منها عن القاعدة حُذف)
+            self.seq, post_keys, render_keys = changes
+            gained = owned - self.owned
+            if gained:
+                self.load(gained, (), unflushed)
+            post_keys = [k for k in post_keys if k[0] in owned and k[0] not in gained]
+            current = self.store.posts_by_keys(post_keys)
+            for key in post_keys:
+                self.track(key, current.get(key))
+            render_keys = [k for k in render_keys if k[0] in owned and k[0] not in gained]
+            renders = self.store.renders_by_keys(render_keys)
+            self.apply_renders({k: renders.get(k) for k in render_keys}, unflushed)
+        self.owned = owned
+        logging.debug(f"worker {self.worker_id}: {len(owned)} محادثة، {len(self.tracked)} منشور، {len(live)} عامل حي")
+
+    def load(self, chat_ids, reload, unflushed):
+        """تحميل منشورات وأزرار المحادثات كاملة. منشورات المحادثات في reload الغائبة عن القاعدة تُحذف."""
+        current = {CountdownScheduler.key(p): p for p in self.store.posts_for_chats(chat_ids)}
+        for key in [k for k in self.tracked if k[0] in reload and k not in current]:
+            self.track(key, None)
+        for key, post in current.items():
+            self.track(key, post)
+        renders = self.store.renders_for_chats(chat_ids)
+        with render_cache_lock:
+            stale = [k for k in render_cache if k[0] in reload and k not in renders]
+        self.apply_renders({**dict.fromkeys(stale), **renders}, unflushed)
+
+    def forget(self, owned, unflushed):
+        """إسقاط منشورات وأزرار المحادثات التي لم نعد نملكها."""
+        for key in [k for k in self.tracked if k[0] not in owned]:
+            self.track(key, None)
+        with render_cache_lock:
+            stale = [k for k in render_cache if k[0] not in owned]
+        self.apply_renders(dict.fromkeys(stale), unflushed)
+
+    def track(self, key, post):
+        """تحديث منشور متتبع بنسخته من القاعدة (None: حُذف)."""
+        existing = self.tracked.get(key)
+        if post is None:
+            if existing is not None:
+                countdown_scheduler.remove(self.tracked.pop(key))
+        elif existing is None:
+            self.tracked[key] = post
+            countdown_scheduler.add(post)
+        elif serialize_post(existing) != serialize_post(post):
+            existing.update(post)
+            countdown_scheduler.add(existing)
+
+    @staticmethod
+    def apply_renders(renders: dict, unflushed):
+        """نسخ أزرار القاعدة إلى الذاكرة (None: غير موجود فيها)، عدا ما لم يكتبه write_behind بعد."""
+        with render_cache_lock:
+            for key, value in renders.items():
+                if ("render",) + key in unflushed:
+                    continue
+                if value is None:
+                    render_cache.pop(key, None)
+                else:
+                    render_cache[key] = value
+
+    def run(self):
+        countdown_scheduler.guard = self.holds
+        countdown_scheduler.start(get_bot(), [])
+        self.sync()
+        print(f"✅ العامل {self.worker_id} يعمل ({len(self.tracked)} منشور في جزئه).")
+        try:
+            while True:
+                time.sleep(SHARD_SYNC_INTERVAL)
+                try:
+                    self.sync()
+                except sqlite3.Error as e:
+                    logging.warning(f"worker {self.worker_id}: فشل المزامنة مع القاعدة: {e}")
+        finally:
+            self.store.remove_worker(self.worker_id)
+
+
+def run_countdown_worker(worker_id: str = None):
+    """نقطة دخول عملية العامل: python main.py worker [worker_id]"""
+    if not isinstance(storage, SqliteStorage):
+        print("❌ العمال الموزعون يحتاجون قاعدة مشتركة: STORAGE_BACKEND=sqlite")
+        return
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    # كل عامل عملية مستقلة بمقاييسه الخاصة: يُشغَّل بمنفذ METRICS_PORT مختلف لكل عامل
+    start_metrics_server()
+    # طابور إعادة محاولة مستقل لكل عامل (مفاتيح رسائله من نطاقه فقط)
+    retry_queue.path = f"{RETRY_QUEUE_FILE}.{worker_id}"
+    retry_queue.load()
+    try:
+        ShardWorker(storage, worker_id).run()
+    except KeyboardInterrupt:
+        print(f"تم إيقاف العامل {worker_id}.")
+
+
+countdown_scheduler = CountdownScheduler(edit_engine)
 
 # --- تعريف حالات المحادثة ---
-ADMIN_PANEL, AWAIT_DATE, AWAIT_MESSAGE, AWAIT_LINK, AWAIT_MEDIA, EDIT_TEXT, EDIT_DATE, EDIT_LINK = range(8)
+ADMIN_PANEL, AWAIT_DATE, AWAIT_MESSAGE, AWAIT_LINK, AWAIT_MEDIA, EDIT_TEXT, EDIT_DATE, EDIT_LINK, AWAIT_SEARCH, AWAIT_IMPORT, AWAIT_CHANNEL = range(11)
 
 def cleanup_posts_handler(update: Update, context: CallbackContext):
     """معالج تنظيف المنشورات المنتهية."""
@@ -524,27 +3604,376 @@ def admin_panel(update: Update, context: CallbackContext) -> int:
     """
     active_count = get_active_posts_count()
     keyboard = [
-        [InlineKeyboardButton("📝 إنشاء منشور جديد للقناة", callback_data='new_post')],
-        [InlineKeyboardButton(f"📋 منشوراتي ({active_count} نشط)", callback_data='my_posts')],
-        [InlineKeyboardButton("🧹 تنظيف المنشورات المنتهية", callback_data='cleanup_posts')],
-        [InlineKeyboardButton("❌ إغلاق", callback_data='close_panel')],
+        [InlineKeyboardButton("📝 إنشاء منشور جديد للقناة", callback_data=callback_for('new_post'))],
+        [InlineKeyboardButton(f"📋 منشوراتي ({active_count} نشط)", callback_data=callback_for('my_posts'))],
+        [InlineKeyboardButton("📥 استيراد منشورات (CSV/JSONL)", callback_data=callback_for('bulk_import'))],
+        [InlineKeyboardButton(f"📡 القنوات ({len(channel_registry())})", callback_data=callback_for('channels'))],
+        [InlineKeyboardButton("🧹 تنظيف المنشورات المنتهية", callback_data=callback_for('cleanup_posts'))],
+        [InlineKeyboardButton("🔬 تشخيص الأداء", callback_data=callback_for('profiling'))],
+        [InlineKeyboardButton("❌ إغلاق", callback_data=callback_for('close_panel'))],
     ]
+    if posts.quarantined:
+        keyboard.insert(2, [InlineKeyboardButton(f"⛔ منشورات معزولة ({len(posts.quarantined)})", callback_data=callback_for('posts_filter', 'quarantined'))])
+    if retry_queue.entries or retry_queue.dead_count:
+        keyboard.insert(2, [InlineKeyboardButton(
+            f"📮 تعديلات فاشلة ({len(retry_queue.entries)} قيد الإعادة، {retry_queue.dead_count} متوقفة)",
+            callback_data=callback_for('dead_letters'))])
     reply_markup = InlineKeyboardMarkup(keyboard)
+
+    # أقرب منشور سينتهي (استعلام مفهرس بدلاً من فحص كل المنشورات)
+    next_up = storage.next_expiring(datetime.datetime.now(), 1)
+    next_line = f"\n⏭️ أقرب انتهاء: {next_up[0]['post_date'].strftime('%d-%m-%Y %H:%M')}" if next_up else ""
     
     if update.callback_query:
         # إذا تم استدعاؤه من زر
         update.callback_query.answer()
         update.callback_query.edit_message_text(
-            text="لوحة تحكم الأدمن:", reply_markup=reply_markup
+            text=f"لوحة تحكم الأدمن:{next_line}", reply_markup=reply_markup
         )
     else:
         # إذا تم استدعاؤه من أمر /admin
         update.message.reply_text(
-            "أهلاً بك في لوحة تحكم الأدمن:", reply_markup=reply_markup
+            f"أهلاً بك في لوحة تحكم الأدمن:{next_line}", reply_markup=reply_markup
         )
         
     return ADMIN_PANEL
 
+def channels_text() -> str:
+    env_ids = {parse_chat_id(c) for c in CHANNEL_IDS.split(",") if c.strip()}
+    lines = []
+    for entry in channel_registry():
+        chat_id = entry["chat_id"]
+        note = " (الافتراضية)" if chat_id == CHANNEL_ID else " (من CHANNEL_IDS)" if chat_id in env_ids else ""
+        lines.append(f"• {channel_title(chat_id)}{note}: {effective_button_url(None, chat_id) or 'بلا رابط'}")
+    return "📡 قنوات النشر:\n" + "\n".join(lines)
+
+
+def channels_markup() -> InlineKeyboardMarkup:
+    keyboard = [
+        [InlineKeyboardButton(f"🗑 حذف {entry.get('title') or entry['chat_id']}", callback_data=callback_for('channel_remove', i))]
+        for i, entry in enumerate(channels)
+    ]
+    keyboard.append([InlineKeyboardButton("➕ إضافة قناة", callback_data=callback_for('channel_add'))])
+    keyboard.append([InlineKeyboardButton("❌ إغلاق", callback_data=callback_for('close_panel'))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def channels_menu(update: Update, context: CallbackContext, remove: int = None):
+    """عرض سجل القنوات، وحذف قناة مضافة من اللوحة (قنوات البيئة ثابتة)."""
+    query = update.callback_query
+    query.answer()
+    if remove is not None and remove < len(channels):
+        channels.pop(remove)
+        persist_state()
+    query.edit_message_text(channels_text(), reply_markup=channels_markup())
+
+
+def channel_add_start(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    query.edit_message_text(
+        "أرسل معرف القناة (@name أو -100...) ثم رابط الزر اختياريًا، مثل:\n@mychannel https://t.me/mychannel\n\n"
+        "يجب أن يكون البوت مشرفًا في القناة."
+    )
+    return AWAIT_CHANNEL
+
+
+def channel_add_receive(update: Update, context: CallbackContext) -> int:
+    parts = update.message.text.split()
+    chat_id = parse_chat_id(parts[0])
+    link = parts[1] if len(parts) > 1 else ""
+    if link and not link.startswith(("http://", "https://", "tg://")):
+        update.message.reply_text("❌ رابط غير صالح. أعد الإرسال.")
+        return AWAIT_CHANNEL
+    if any(entry["chat_id"] == chat_id for entry in channel_registry()):
+        update.message.reply_text("⚠️ القناة مسجلة بالفعل.")
+        return AWAIT_CHANNEL
+    try:
+        chat = context.bot.get_chat(chat_id)
+        member = context.bot.get_chat_member(chat.id, context.bot.id)
+    except (NetworkError, Unauthorized) as e:
+        update.message.reply_text(f"❌ تعذر الوصول إلى القناة: {e}")
+        return AWAIT_CHANNEL
+    if member.status not in ("administrator", "creator"):
+        update.message.reply_text("❌ البوت ليس مشرفًا في هذه القناة. أضفه كمشرف ثم أعد الإرسال.")
+        return AWAIT_CHANNEL
+    channels.append({
+        "chat_id": chat_id,
+        "title": chat.title or str(chat_id),
+        "link": link or (f"https://t.me/{chat.username}" if chat.username else ""),
+    })
+    persist_state()
+    update.message.reply_text(channels_text(), reply_markup=channels_markup())
+    return ADMIN_PANEL
+
+
+def dead_letters_text() -> str:
+    lines = [f"📮 التعديلات الفاشلة\n🔁 قيد الإعادة: {len(retry_queue.entries)} | ⛔ متوقفة: {retry_queue.dead_count}"]
+    for record in retry_queue.dead_letters()[:10]:
+        lines.append(
+            f"\n• {record.get('dead_at', '')} — {channel_title(record['chat_id'])} / الرسالة {record['message_id']}\n"
+            f"  {record.get('label', '')}: {record.get('attempts', 0)} محاولات، آخر خطأ: {record.get('error', '')[:120]}"
+        )
+    return "\n".join(lines)
+
+
+def dead_letters_menu(update: Update, context: CallbackContext, op: str = ""):
+    """مراجعة ملف الرسائل الميتة: إعادة إدخالها للطابور أو مسح السجل."""
+    query = update.callback_query
+    query.answer()
+    note = ""
+    if op == 'retry':
+        note = f"\n\n🔁 أعيد {retry_queue.requeue_dead_letters()} تعديل إلى الطابور."
+    elif op == 'clear':
+        retry_queue.clear_dead_letters()
+        note = "\n\n🗑 تم مسح السجل."
+    keyboard = []
+    if retry_queue.dead_count:
+        keyboard.append([
+            InlineKeyboardButton("🔁 إعادة المحاولة", callback_data=callback_for('dead_letters', 'retry')),
+            InlineKeyboardButton("🗑 مسح السجل", callback_data=callback_for('dead_letters', 'clear')),
+        ])
+    keyboard.append([InlineKeyboardButton("❌ إغلاق", callback_data=callback_for('close_panel'))])
+    query.edit_message_text(dead_letters_text() + note, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+# --- تشخيص الأداء أثناء التشغيل ---
+# أوامر الأدمن /profile و /memprofile و /profile_stop (أو زر التشخيص في اللوحة) تشغّل جلسة لنافذة محدودة:
+#   cpu    : عيّنات دورية لمكدسات كل الخيوط (sys._current_frames)، فتظهر update_all_posts و save_data
+#            والمعالجات معًا؛ cProfile يقيس الخيط الذي شُغّل فيه فقط.
+#   memory : tracemalloc طوال النافذة، ثم الفرق بين لقطتي البداية والنهاية حسب موضع التخصيص.
+# النتيجة تُكتب في PROFILE_DIR (مكدسات folded لأدوات flamegraph/speedscope، ولقطة tracemalloc)
+# ويُرسل ملخصها لمن بدأها. بلا جلسة لا يوجد خيط ولا hook، فلا كلفة.
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SECONDS = int(os.getenv("PROFILE_SECONDS", "60"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_TOP = 10
+
+# آخر إطار في مكدس خيط ينتظر (قفل، طابور، select) ولا يستهلك وقتًا
+PROFILE_IDLE_FRAMES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("queue.py", "get"),
+    ("selectors.py", "select"), ("thread.py", "_worker"),
+}
+# ملفات تشغيل الخيوط التي تظهر في جذر كل مكدس، فلا تُعرض في ترتيب الزمن الشامل
+PROFILE_THREAD_FILES = {"threading.py", "thread.py"}
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size:.0f}B"
+        size /= 1024
+    return f"{size:.1f}GiB"
+
+
+class ProfileSession:
+    """جلسة تشخيص واحدة تعمل في خيط خلفي حتى تنتهي نافذتها أو تُوقف، ثم تسلّم ملخصها لـ report."""
+
+    def __init__(self, kind: str, seconds: int, report):
+        self.kind = kind
+        self.seconds = seconds
+        self.report = report
+        self.stop_event = threading.Event()
+        self.started = time.monotonic()
+        self.path = os.path.join(PROFILE_DIR, f"{kind}-{datetime.datetime.now():%Y%m%d-%H%M%S}")
+
+    def remaining(self) -> float:
+        return max(0.0, self.started + self.seconds - time.monotonic())
+
+    def run(self):
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            text = self.sample_cpu() if self.kind == "cpu" else self.trace_memory()
+        except Exception as e:
+            logging.exception(f"profiling session {self.kind} failed")
+            text = f"❌ فشل التشخيص: {e}"
+        finally:
+            profiler.finished(self)
+        try:
+            self.report(text)
+        except Exception:
+            logging.exception("failed to send profiling summary")
+
+    def sample_cpu(self) -> str:
+        own = threading.get_ident()
+        stacks = {}  # (اسم الخيط، الإطارات من الجذر) -> عدد العينات
+        ticks = idle = 0
+        while not self.stop_event.wait(PROFILE_INTERVAL) and self.remaining() > 0:
+            ticks += 1
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in PROFILE_IDLE_FRAMES:
+                    idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                key = (names.get(ident, str(ident)), tuple(reversed(stack)))
+                stacks[key] = stacks.get(key, 0) + 1
+
+        path = self.path + ".folded"
+        with open(path, "w", encoding="utf-8") as f:
+            for (thread_name, frames), count in stacks.items():
+                f.write(";".join([thread_name] + [f"{name} ({file}:{line})" for file, line, name in frames]) + f" {count}\n")
+
+        busy = sum(stacks.values())
+        own_time, total_time, threads = {}, {}, {}
+        for (thread_name, frames), count in stacks.items():
+            own_time[frames[-1]] = own_time.get(frames[-1], 0) + count
+            for frame in set(frames):
+                if frame[0] not in PROFILE_THREAD_FILES:
+                    total_time[frame] = total_time.get(frame, 0) + count
+            threads[thread_name] = threads.get(thread_name, 0) + count
+
+        def top(counts):
+            ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]
+            return [f"  {count * 100 / busy:5.1f}% {name} ({file}:{line})" for (file, line, name), count in ranked]
+
+        lines = [f"🔬 تشخيص المعالج: {time.monotonic() - self.started:.0f}s، {ticks} عينة، "
+                 f"{busy} مكدس عامل و{idle} منتظر"]
+        if busy:
+            lines.append("أكثر الخيوط انشغالًا: " + "، ".join(
+                f"{name} {count * 100 / busy:.0f}%" for name, count in sorted(threads.items(), key=lambda item: item[1], reverse=True)[:3]))
+            lines += ["الزمن الذاتي:"] + top(own_time) + ["الزمن الشامل:"] + top(total_time)
+        lines.append(f"📁 {path}")
+        return "\n".join(lines)
+
+    def trace_memory(self) -> str:
+        # تتبع بدأ قبل الجلسة (PYTHONTRACEMALLOC) يبقى كما هو
+        already = tracemalloc.is_tracing()
+        if not already:
+            tracemalloc.start()
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        try:
+            before = tracemalloc.take_snapshot().filter_traces(ignore)
+            self.stop_event.wait(self.remaining())
+            after = tracemalloc.take_snapshot().filter_traces(ignore)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not already:
+                tracemalloc.stop()
+
+        path = self.path + ".snapshot"
+        after.dump(path)
+        lines = [f"🧠 تشخيص الذاكرة: {time.monotonic() - self.started:.0f}s، المتتبَّع {format_size(current)} (الذروة {format_size(peak)})",
+                 "أكبر زيادة حسب موضع التخصيص:"]
+        for stat in after.compare_to(before, "lineno")[:PROFILE_TOP]:
+            frame = stat.traceback[0]
+            size = ("+" if stat.size_diff >= 0 else "-") + format_size(abs(stat.size_diff))
+            lines.append(f"  {size:>10} ({stat.count_diff:+d}) {os.path.basename(frame.filename)}:{frame.lineno}")
+        lines.append(f"📁 {path}")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """الجلسات الجارية: جلسة واحدة على الأكثر لكل نوع."""
+
+    KINDS = {"cpu": "المعالج", "memory": "الذاكرة"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}  # kind -> ProfileSession
+
+    def start(self, kind: str, seconds: int, report) -> ProfileSession:
+        """بدء جلسة؛ يعيد None إذا كانت جلسة من النوع نفسه تعمل."""
+        with self.lock:
+            if kind in self.sessions:
+                return None
+            session = self.sessions[kind] = ProfileSession(kind, max(1, min(seconds, PROFILE_MAX_SECONDS)), report)
+        threading.Thread(target=session.run, name=f"profile-{kind}", daemon=True).start()
+        return session
+
+    def stop(self) -> list:
+        """إنهاء كل الجلسات الجارية مبكرًا (ترسل ملخصها كالمعتاد). يعيد أنواعها."""
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.stop_event.set()
+        return [session.kind for session in sessions]
+
+    def finished(self, session: ProfileSession):
+        with self.lock:
+            if self.sessions.get(session.kind) is session:
+                del self.sessions[session.kind]
+
+    def status_text(self) -> str:
+        with self.lock:
+            running = [f"• {self.KINDS[kind]}: متبقٍ {session.remaining():.0f}s" for kind, session in self.sessions.items()]
+        return "\n".join(running) if running else "لا توجد جلسة تشخيص جارية."
+
+
+profiler = Profiler()
+
+
+def start_profile(update: Update, context: CallbackContext, kind: str, seconds: int = None) -> str:
+    """بدء جلسة وإرسال ملخصها عند انتهائها إلى المحادثة نفسها. يعيد نص الرد الفوري."""
+    chat_id = update.effective_chat.id
+    bot = context.bot
+
+    def report(text):
+        bot.send_message(chat_id=chat_id, text=text[:4096])
+
+    session = profiler.start(kind, seconds or PROFILE_SECONDS, report)
+    if session is None:
+        return f"⚠️ تشخيص {Profiler.KINDS[kind]} يعمل بالفعل.\n{profiler.status_text()}"
+    return f"🔬 بدأ تشخيص {Profiler.KINDS[kind]} لمدة {session.seconds} ثانية، سيصلك الملخص عند الانتهاء."
+
+
+def profile_seconds(context: CallbackContext):
+    try:
+        return int(context.args[0]) if context.args else None
+    except ValueError:
+        return None
+
+
+@admin_only
+def profile_command(update: Update, context: CallbackContext):
+    """/profile [ثوانٍ]: تشخيص المعالج."""
+    update.message.reply_text(start_profile(update, context, "cpu", profile_seconds(context)))
+
+
+@admin_only
+def memprofile_command(update: Update, context: CallbackContext):
+    """/memprofile [ثوانٍ]: تشخيص الذاكرة."""
+    update.message.reply_text(start_profile(update, context, "memory", profile_seconds(context)))
+
+
+@admin_only
+def profile_stop_command(update: Update, context: CallbackContext):
+    stopped = profiler.stop()
+    update.message.reply_text("⏹ تم إيقاف التشخيص، سيصلك الملخص." if stopped else profiler.status_text())
+
+
+@admin_only
+def profiling_menu(update: Update, context: CallbackContext, op: str = ""):
+    """لوحة التشخيص: بدء جلسة معالج أو ذاكرة بالمدة الافتراضية، أو إيقاف الجارية."""
+    query = update.callback_query
+    query.answer()
+    note = ""
+    if op in Profiler.KINDS:
+        note = "\n\n" + start_profile(update, context, op)
+    elif op == 'stop':
+        note = "\n\n⏹ تم الإيقاف، سيصلك الملخص." if profiler.stop() else ""
+    keyboard = [
+        [
+            InlineKeyboardButton("🔬 المعالج", callback_data=callback_for('profiling', 'cpu')),
+            InlineKeyboardButton("🧠 الذاكرة", callback_data=callback_for('profiling', 'memory')),
+        ],
+        [InlineKeyboardButton("⏹ إيقاف", callback_data=callback_for('profiling', 'stop'))],
+        [InlineKeyboardButton("❌ إغلاق", callback_data=callback_for('close_panel'))],
+    ]
+    query.edit_message_text(
+        f"🔬 تشخيص الأداء ({PROFILE_SECONDS} ثانية، أو /profile و /memprofile بمدة أخرى)\n{profiler.status_text()}{note}",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
+
+
 # --- معاينة قبل الإرسال ---
 def start_preview(update: Update, context: CallbackContext):
     """يعرض معاينة للرسالة التي ستُرسل للقناة ويطلب التأكيد."""
@@ -563,13 +3992,33 @@ def start_preview(update: Update, context: CallbackContext):
 
     keyboard = [
         [InlineKeyboardButton("⏳ معاينة الزر (لينك)", url=effective_button_url())],
-        [InlineKeyboardButton("✅ تأكيد الإرسال للقناة", callback_data='confirm_send'), InlineKeyboardButton("❌ إلغاء", callback_data='cancel_send')]
+        [InlineKeyboardButton("✅ تأكيد الإرسال للقناة", callback_data=callback_for('confirm_send')), InlineKeyboardButton("❌ إلغاء", callback_data=callback_for('cancel_send'))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     query.edit_message_text(text=f"معاينة الرسالة التي سيتم إرسالها إلى {CHANNEL_ID}:\n\n{message_text}", reply_markup=reply_markup)
 
 
+def send_post_message(bot, chat_id, text: str, media, reply_markup):
+    """إرسال منشور إلى القناة كنص أو صورة أو ملف أو فيديو حسب الوسائط المرفقة."""
+    media_type = (media or {}).get('type')
+    if media_type == 'photo':
+        return bot.send_photo(chat_id=chat_id, photo=media.get('file_id'), caption=text, reply_markup=reply_markup)
+    if media_type == 'document':
+        return bot.send_document(chat_id=chat_id, document=media.get('file_id'), caption=text, reply_markup=reply_markup)
+    if media_type == 'video':
+        return bot.send_video(chat_id=chat_id, video=media.get('file_id'), caption=text, reply_markup=reply_markup)
+    return bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+
+def sent_media_file_id(message, media_type: str):
+    """file_id الوسائط في رسالة أُرسلت للتو (لإعادة استخدامه بدل رفعها مرة أخرى)."""
+    media = getattr(message, media_type, None)
+    if isinstance(media, (list, tuple)):
+        media = media[-1] if media else None  # الصور: أكبر مقاس
+    return getattr(media, 'file_id', None)
+
+
 def confirm_send(update: Update, context: CallbackContext):
     """يرسل الرسالة إلى القناة عند تأكيد الأدمن."""
     query = update.callback_query
@@ -590,24 +4039,19 @@ def confirm_send(update: Update, context: CallbackContext):
         post_date = context.user_data.get('post_date')
         post_link = context.user_data.get('post_link')
 
-        if post_text and post_date and post_link:
+        if post_text and post_date and post_link and draft_targets(context) != [CHANNEL_ID]:
+            # النشر في عدة قنوات يتم في الخلفية بمسارات متوازية، والمؤقت العام لا يتبع أيًا منها
+            start_fanout(update, context, draft_targets(context))
+            for key in ('post_text', 'post_date', 'post_link', 'post_media', 'post_channels', 'creating_post', 'processing_confirm'):
+                context.user_data.pop(key, None)
+        elif post_text and post_date and post_link:
             # إرسال المنشور المخصص مع دعم وسائط اختيارية
             message_text = f"{post_text}"
             keyboard = [[InlineKeyboardButton("⏳ جاري الحساب...", url=effective_button_url(post_link))]]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
-            sent_message = None
-            media = context.user_data.get('post_media')
             try:
-                if media:
-                    if media.get('type') == 'photo':
-                        sent_message = context.bot.send_photo(chat_id=CHANNEL_ID, photo=media.get('file_id'), caption=message_text, reply_markup=reply_markup)
-                    elif media.get('type') == 'document':
-                        sent_message = context.bot.send_document(chat_id=CHANNEL_ID, document=media.get('file_id'), caption=message_text, reply_markup=reply_markup)
-                    elif media.get('type') == 'video':
-                        sent_message = context.bot.send_video(chat_id=CHANNEL_ID, video=media.get('file_id'), caption=message_text, reply_markup=reply_markup)
-                else:
-                    sent_message = context.bot.send_message(chat_id=CHANNEL_ID, text=message_text, reply_markup=reply_markup)
+                sent_message = send_post_message(context.bot, CHANNEL_ID, message_text, context.user_data.get('post_media'), reply_markup)
             except Exception as e:
                 query.edit_message_text(f"❌ فشل إرسال المنشور: {e}")
                 context.user_data['processing_confirm'] = False  # إعادة تعيين الحالة
@@ -622,16 +4066,17 @@ def confirm_send(update: Update, context: CallbackContext):
             timer_active = True
 
             # حفظ المنشور في قائمة المنشورات
-            post_entry = {
-                'chat_id': CHANNEL_ID,
-                'message_id': sent_message.message_id,
-                'post_text': post_text,
-                'post_link': post_link,
-                'post_media': context.user_data.get('post_media'),
-                'post_date': post_date,
-            }
-            posts.append(post_entry)
-            save_data()
+            post_entry = posts.append(Post(
+                chat_id=CHANNEL_ID,
+                message_id=sent_message.message_id,
+                post_text=post_text,
+                post_link=post_link,
+                post_media=context.user_data.get('post_media'),
+                post_date=post_date,
+            ))
+            countdown_scheduler.add(post_entry)
+            persist_post_add(post_entry)
+            persist_state()
 
             query.edit_message_text("✅ تم إرسال المنشور إلى القناة بنجاح!")
             # تنظيف بيانات الجلسة
@@ -639,6 +4084,7 @@ def confirm_send(update: Update, context: CallbackContext):
             context.user_data.pop('post_date', None)
             context.user_data.pop('post_link', None)
             context.user_data.pop('post_media', None)
+            context.user_data.pop('post_channels', None)
             context.user_data.pop('creating_post', None)
             context.user_data.pop('processing_confirm', None)  # تنظيف حالة المعالجة
 
@@ -657,7 +4103,7 @@ def confirm_send(update: Update, context: CallbackContext):
             timer_message_id = sent_message.message_id
             timer_chat_id = CHANNEL_ID
             timer_active = True
-            save_data()
+            persist_state()
 
             query.edit_message_text("✅ تم إرسال الرسالة إلى القناة بنجاح.")
             context.user_data.pop('processing_confirm', None)  # تنظيف حالة المعالجة
@@ -665,7 +4111,7 @@ def confirm_send(update: Update, context: CallbackContext):
     except Exception as e:
         query.edit_message_text(f"❌ فشل الإرسال: {e}")
         timer_active = False
-        save_data()
+        persist_state()
         context.user_data.pop('processing_confirm', None)  # تنظيف حالة المعالجة
 
 
@@ -680,6 +4126,7 @@ def cancel_send(update: Update, context: CallbackContext):
     context.user_data.pop('post_date', None)
     context.user_data.pop('post_link', None)
     context.user_data.pop('post_media', None)
+    context.user_data.pop('post_channels', None)
     context.user_data.pop('processing_confirm', None)  # تنظيف حالة المعالجة
 
     # عد إلى لوحة الأدمن
@@ -687,11 +4134,15 @@ def cancel_send(update: Update, context: CallbackContext):
     return ADMIN_PANEL
 
 
+def editing_post(context: CallbackContext):
+    """المنشور الذي يحرره المستخدم حاليًا (None إذا لم يُحدد أو حُذف في الأثناء)."""
+    return posts.get(context.user_data.get('editing_post_id'))
+
+
 def edit_text_start(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
-    idx = context.user_data.get('editing_post_idx')
-    if idx is None:
+    if editing_post(context) is None:
         query.edit_message_text('لم يتم تحديد منشور للتحرير.')
         return
     query.edit_message_text('أرسل النص الجديد للمنشور:')
@@ -699,19 +4150,22 @@ def edit_text_start(update: Update, context: CallbackContext):
 
 
 def edit_text_receive(update: Update, context: CallbackContext):
-    idx = context.user_data.get('editing_post_idx')
-    if idx is None or idx<0 or idx>=len(posts):
+    post = editing_post(context)
+    if post is None:
         update.message.reply_text('منشور غير صالح.')
         return ConversationHandler.END
-    posts[idx]['post_text'] = update.message.text
+    post['post_text'] = update.message.text
     # تحديث الرسالة في القناة إن وُجد معرف الرسالة
     try:
-        chat_id = posts[idx].get('chat_id')
-        msg_id = posts[idx].get('message_id')
-        context.bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=posts[idx]['post_text'])
+        chat_id = post.get('chat_id')
+        msg_id = post.get('message_id')
+        context.bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=post['post_text'])
+        # تعديل النص بدون reply_markup يزيل الزر، لذا يجب إعادة رسمه فورًا
+        forget_render(chat_id, msg_id)
+        countdown_scheduler.add(post)
     except Exception:
         pass
-    save_data()
+    persist_post_update(post, 'post_text')
     update.message.reply_text('✅ تم تحديث نص المنشور.')
     return ConversationHandler.END
 
@@ -725,21 +4179,22 @@ def edit_date_start(update: Update, context: CallbackContext):
 
 
 def edit_date_receive(update: Update, context: CallbackContext):
-    idx = context.user_data.get('editing_post_idx')
-    if idx is None or idx<0 or idx>=len(posts):
+    post = editing_post(context)
+    if post is None:
         update.message.reply_text('منشور غير صالح.')
         return ConversationHandler.END
     try:
         parsed = datetime.datetime.strptime(update.message.text, '%d-%m-%Y %H:%M')
-        posts[idx]['post_date'] = parsed
-        save_data()
+        post['post_date'] = parsed
+        countdown_scheduler.add(post)
+        persist_post_update(post, 'post_date')
         update.message.reply_text('✅ تم تحديث التاريخ.')
         # إذا كان هذا المنشور هو المنشور الحالي الذي يعمل عليه المؤقت، حدّث target_date
         global target_date, timer_active
-        if posts[idx].get('message_id') == timer_message_id:
+        if post.get('message_id') == timer_message_id:
             target_date = parsed
             timer_active = True
-            save_data()
+            persist_state()
     except Exception:
         update.message.reply_text('❌ صيغة التاريخ خاطئة.')
     return ConversationHandler.END
@@ -753,12 +4208,13 @@ def edit_link_start(update: Update, context: CallbackContext):
 
 
 def edit_link_receive(update: Update, context: CallbackContext):
-    idx = context.user_data.get('editing_post_idx')
-    if idx is None or idx<0 or idx>=len(posts):
+    post = editing_post(context)
+    if post is None:
         update.message.reply_text('منشور غير صالح.')
         return ConversationHandler.END
-    posts[idx]['post_link'] = update.message.text
-    save_data()
+    post['post_link'] = update.message.text
+    countdown_scheduler.add(post)
+    persist_post_update(post, 'post_link')
     update.message.reply_text('✅ تم تحديث الرابط.')
     return ConversationHandler.END
 
@@ -767,13 +4223,12 @@ def stop_and_delete_post(update: Update, context: CallbackContext):
     """إيقاف المؤقت وحذف المنشور نهائيًا."""
     query = update.callback_query
     query.answer()
-    idx = context.user_data.get('editing_post_idx')
+    post = editing_post(context)
 
-    if idx is None or idx < 0 or idx >= len(posts):
+    if post is None:
         query.edit_message_text('منشور غير صالح.')
         return
 
-    post = posts[idx]
     global timer_active, timer_message_id, timer_chat_id
 
     # إذا كان هذا المنشور مرتبطًا بالمؤقت الحالي، أوقف المؤقت
@@ -781,33 +4236,31 @@ def stop_and_delete_post(update: Update, context: CallbackContext):
         post.get('message_id') == timer_message_id):
 
         timer_active = False
-        schedule.clear()
         query.edit_message_text('🛑 تم إيقاف المؤقت وحذف المنشور بنجاح!')
     else:
         query.edit_message_text('✅ تم حذف المنشور بنجاح!')
 
-    # حذف المنشور من القائمة
-    deleted_post = posts.pop(idx)
+    # حذف المنشور من الفهارس (المستخدمون الآخرون الذين يحررونه سيجدونه غير موجود)
+    context.user_data.pop('editing_post_id', None)
+    try:
+        posts.remove(post)
+    except ValueError:
+        return ConversationHandler.END  # حُذف بالفعل (ضغطتان متتاليتان أو تنظيف متزامن)
+    forget_render(post.get('chat_id'), post.get('message_id'))
+    countdown_scheduler.remove(post)
 
     # حذف الرسالة من القناة إن أمكن
     try:
         context.bot.delete_message(
-            chat_id=deleted_post.get('chat_id'),
-            message_id=deleted_post.get('message_id')
+            chat_id=post.get('chat_id'),
+            message_id=post.get('message_id')
         )
     except Exception as e:
         print(f"تعذر حذف الرسالة من القناة: {e}")
 
-    # حفظ التغييرات في ملف البيانات
-    save_data()
-
-    # إعادة تعيين فهرس المنشور المحدد للمستخدمين الآخرين
-    # إذا كان هناك مستخدم آخر يحرر منشورًا بنفس الفهرس أو أعلى
-    for user_data in context.dispatcher.user_data.values():
-        if user_data.get('editing_post_idx') is not None:
-            editing_idx = user_data.get('editing_post_idx')
-            if editing_idx > idx:
-                user_data['editing_post_idx'] = editing_idx - 1
+    # تسجيل التغييرات في سجل البيانات
+    persist_post_delete(post)
+    persist_state()
 
     return ConversationHandler.END
 
@@ -821,8 +4274,7 @@ def stop_timer_handler(update: Update, context: CallbackContext):
 
     if timer_active and timer_message_id:
         timer_active = False
-        schedule.clear()
-        save_data()
+        persist_state()
         query.edit_message_text('🛑 تم إيقاف المؤقت بنجاح من لوحة التحكم.')
     else:
         query.edit_message_text('لا يوجد مؤقت نشط حاليًا.')
@@ -850,7 +4302,7 @@ def receive_date(update: Update, context: CallbackContext) -> int:
             update.message.reply_text(f"✅ تم حفظ تاريخ المنشور: {parsed_date.strftime('%Y-%m-%d %H:%M')}")
         else:
             target_date = parsed_date
-            save_data()
+            persist_state()
             update.message.reply_text(f"✅ تم تحديد التاريخ بنجاح: {target_date.strftime('%Y-%m-%d %H:%M')}")
     except (ValueError, IndexError):
         update.message.reply_text("❌ صيغة خاطئة. يرجى المحاولة مرة أخرى.")
@@ -876,7 +4328,7 @@ def receive_message(update: Update, context: CallbackContext) -> int:
     """يستقبل رسالة النهاية ويحفظها."""
     global custom_end_message
     custom_end_message = update.message.text
-    save_data()
+    persist_state()
     update.message.reply_text(f"✅ تم تحديد رسالة النهاية: \"{custom_end_message}\"")
     admin_panel(update, context)
     return ConversationHandler.END
@@ -898,15 +4350,15 @@ def receive_link(update: Update, context: CallbackContext) -> int:
         update.message.reply_text(f"✅ تم حفظ رابط المنشور: {link}")
         # بعد حفظ الرابط، نسأل الأدمن إن كان يريد إرفاق وسائط (اختياري)
         keyboard = [
-            [InlineKeyboardButton("🖼️ إرفاق صورة/وسائط", callback_data='attach_media')],
-            [InlineKeyboardButton("🚫 بدون وسائط - عرض المعاينة", callback_data='no_media')]
+            [InlineKeyboardButton("🖼️ إرفاق صورة/وسائط", callback_data=callback_for('attach_media'))],
+            [InlineKeyboardButton("🚫 بدون وسائط - عرض المعاينة", callback_data=callback_for('no_media'))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         update.message.reply_text('هل تريد إرفاق صورة أو وسائط بالمنشور؟', reply_markup=reply_markup)
         return AWAIT_MEDIA
     else:
         button_link = link
-        save_data()
+        persist_state()
         update.message.reply_text(f"✅ تم تحديد الرابط: {button_link}")
         admin_panel(update, context)
         return ConversationHandler.END
@@ -935,6 +4387,51 @@ def start_attach_media(update: Update, context: CallbackContext):
     return AWAIT_MEDIA
 
 
+def draft_targets(context: CallbackContext) -> list:
+    """القنوات المحددة لنشر المسودة الحالية (القناة الافتراضية ما لم يختر الأدمن غيرها)."""
+    return context.user_data.setdefault('post_channels', [CHANNEL_ID])
+
+
+def draft_preview_markup(context: CallbackContext) -> InlineKeyboardMarkup:
+    targets = draft_targets(context)
+    keyboard = [[InlineKeyboardButton("⏳ معاينة الزر (لينك)", url=effective_button_url(context.user_data.get('post_link'), targets[0]))]]
+    if len(channel_registry()) > 1:
+        keyboard.append([InlineKeyboardButton(f"📡 النشر في: {len(targets)} قناة", callback_data=callback_for('draft_channels'))])
+    keyboard.append([InlineKeyboardButton("✅ تأكيد النشر", callback_data=callback_for('confirm_send')), InlineKeyboardButton("❌ إلغاء", callback_data=callback_for('cancel_send'))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def draft_channels_menu(update: Update, context: CallbackContext, toggle: int = None, select_all: bool = False):
+    """اختيار القنوات التي ستُنشر فيها المسودة (قناة واحدة على الأقل)."""
+    query = update.callback_query
+    query.answer()
+    registry = channel_registry()
+    selected = draft_targets(context)
+    if toggle is not None and toggle < len(registry):
+        chat_id = registry[toggle]["chat_id"]
+        if chat_id not in selected:
+            selected.append(chat_id)
+        elif len(selected) > 1:
+            selected.remove(chat_id)
+    elif select_all:
+        selected[:] = [entry["chat_id"] for entry in registry]
+    keyboard = [
+        [InlineKeyboardButton(f"{'✅' if entry['chat_id'] in selected else '⬜'} {channel_title(entry['chat_id'])}", callback_data=callback_for('draft_channel', i))]
+        for i, entry in enumerate(registry)
+    ]
+    keyboard.append([
+        InlineKeyboardButton('☑️ الكل', callback_data=callback_for('draft_channels_all')),
+        InlineKeyboardButton('⬅️ رجوع للمعاينة', callback_data=callback_for('draft_preview')),
+    ])
+    query.edit_message_text(f"اختر قنوات النشر ({len(selected)} محددة):", reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def draft_preview(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    query.edit_message_text(f"معاينة المنشور:\n\n{context.user_data.get('post_text')}", reply_markup=draft_preview_markup(context))
+
+
 def no_media_callback(update: Update, context: CallbackContext):
     """CallbackQuery: المستخدم اختار عدم إرفاق وسائط - عرض معاينة المنشور."""
     query = update.callback_query
@@ -948,11 +4445,7 @@ def no_media_callback(update: Update, context: CallbackContext):
     post_date = context.user_data.get('post_date')
     post_link = context.user_data.get('post_link')
     preview_text = f"معاينة المنشور:\n\n{post_text}"
-    keyboard = [
-        [InlineKeyboardButton("⏳ معاينة الزر (لينك)", url=effective_button_url(post_link))],
-        [InlineKeyboardButton("✅ تأكيد النشر", callback_data='confirm_send'), InlineKeyboardButton("❌ إلغاء", callback_data='cancel_send')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = draft_preview_markup(context)
     query.edit_message_text(preview_text, reply_markup=reply_markup)
     return ConversationHandler.END
 
@@ -995,11 +4488,7 @@ def receive_media(update: Update, context: CallbackContext) -> int:
 
     # إعادة عرض المعاينة بدون وسائط لتجنب الازدواجية
     preview_text = f"معاينة المنشور:\n\n{post_text}"
-    keyboard = [
-        [InlineKeyboardButton("⏳ معاينة الزر (لينك)", url=effective_button_url(post_link))],
-        [InlineKeyboardButton("✅ تأكيد النشر", callback_data='confirm_send'), InlineKeyboardButton("❌ إلغاء", callback_data='cancel_send')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = draft_preview_markup(context)
 
     # إرسال معاينة نصية فقط (بدون وسائط) لتجنب الازدواجية
     context.bot.send_message(chat_id=update.effective_chat.id, text=preview_text, reply_markup=reply_markup)
@@ -1007,46 +4496,203 @@ def receive_media(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 
-def list_my_posts(update: Update, context: CallbackContext):
-    """يعرض قائمة المنشورات التي أرسلها البوت (من posts)."""
+POSTS_PAGE_SIZE = 10
+POST_VIEWS = {"all": "الكل", "active": "النشطة", "soon": "تنتهي خلال 24 ساعة", "expired": "المنتهية", "quarantined": "المعزولة"}
+
+
+def posts_view(context: CallbackContext) -> dict:
+    """حالة قائمة المنشورات لهذا المستخدم: الفلتر، القناة، البحث، ومؤشرات الصفحات السابقة."""
+    return context.user_data.setdefault('posts_view', {"view": "all", "chat": None, "query": "", "after": None, "pages": []})
+
+
+def render_posts_page(context: CallbackContext):
+    """نص ولوحة صفحة واحدة من قائمة المنشورات (مرتبة بموعد الانتهاء)."""
+    state = posts_view(context)
+    now = datetime.datetime.now()
+    items, next_cursor = posts.page(
+        now, state["view"], state["chat"], sorted(search_tokens(state["query"])), state["after"], POSTS_PAGE_SIZE
+    )
+
+    keyboard = []
+    for p in items:
+        text = p.get('post_text') or ''
+        title = text[:40] + ('...' if len(text) > 40 else '')
+        icon = '⛔' if p.get('post_quarantine') else '⏳' if p.get('post_date') and now < p.get('post_date') else '✅'
+        keyboard.append([InlineKeyboardButton(f"{icon} {title}", callback_data=callback_for('edit_post', p.get('post_id')))])
+
+    nav = []
+    if state["pages"]:
+        nav.append(InlineKeyboardButton('⬅️ السابق', callback_data=callback_for('posts_prev')))
+    if next_cursor:
+        nav.append(InlineKeyboardButton('التالي ➡️', callback_data=callback_for('posts_page', repr(next_cursor[0]), next_cursor[1])))
+    if nav:
+        keyboard.append(nav)
+    if state["view"] == "quarantined" and items:
+        keyboard.append([InlineKeyboardButton('♻️ إعادة تفعيل الكل', callback_data=callback_for('reactivate_all'))])
+    keyboard.append([
+        InlineKeyboardButton(('• ' if name == state["view"] else '') + label, callback_data=callback_for('posts_filter', name))
+        for name, label in POST_VIEWS.items()
+    ])
+    search_row = [
+        InlineKeyboardButton(f"📡 القناة: {state['chat'] if state['chat'] is not None else 'الكل'}", callback_data=callback_for('posts_chat')),
+        InlineKeyboardButton('🔎 بحث', callback_data=callback_for('posts_search')),
+    ]
+    if state["query"]:
+        search_row.append(InlineKeyboardButton('✖️ مسح البحث', callback_data=callback_for('posts_search_clear')))
+    keyboard.append(search_row)
+    keyboard.append([InlineKeyboardButton('❌ إغلاق', callback_data=callback_for('close_panel'))])
+
+    header = f"قائمة منشوراتي ({POST_VIEWS[state['view']]}) - صفحة {len(state['pages']) + 1}"
+    if state["query"]:
+        header += f"\n🔎 بحث: {state['query']}"
+    if not items:
+        header += "\n\nلا توجد منشورات مطابقة."
+    return header, InlineKeyboardMarkup(keyboard)
+
+
+def show_posts_page(update: Update, context: CallbackContext, change=None, reset: bool = True):
+    """يطبّق change على حالة القائمة ثم يعرض الصفحة (الفلاتر تعيد القائمة إلى صفحتها الأولى)."""
     query = update.callback_query
     query.answer()
     if not posts:
         query.edit_message_text("لا توجد منشورات محفوظة بعد.")
         return
-    keyboard = []
-    for idx, p in enumerate(posts):
-        title = p.get('post_text')[:40] + ('...' if len(p.get('post_text'))>40 else '')
-        keyboard.append([InlineKeyboardButton(title, callback_data=f'edit_post:{idx}')])
-    keyboard.append([InlineKeyboardButton('❌ إغلاق', callback_data='close_panel')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text('قائمة منشوراتي:', reply_markup=reply_markup)
+    state = posts_view(context)
+    if change is not None:
+        change(state)
+    if reset:
+        state["after"] = None
+        state["pages"] = []
+    text, reply_markup = render_posts_page(context)
+    query.edit_message_text(text, reply_markup=reply_markup)
+
+
+def list_my_posts(update: Update, context: CallbackContext):
+    """يعرض قائمة المنشورات صفحة صفحة، مع فلاتر الحالة والقناة والبحث في النص."""
+    show_posts_page(update, context)
+
+
+def posts_next_page(update: Update, context: CallbackContext, deadline: float, post_id: int):
+    """المؤشر (deadline, post_id) لآخر منشور في الصفحة الحالية."""
+    def change(state):
+        state["pages"].append(state["after"])
+        state["after"] = (deadline, post_id)
+    show_posts_page(update, context, change, reset=False)
+
+
+def posts_prev_page(update: Update, context: CallbackContext):
+    def change(state):
+        state["after"] = state["pages"].pop() if state["pages"] else None
+    show_posts_page(update, context, change, reset=False)
+
+
+def posts_filter(update: Update, context: CallbackContext, view: str):
+    def change(state):
+        if view in POST_VIEWS:
+            state["view"] = view
+    show_posts_page(update, context, change)
 
 
-def edit_post_menu(update: Update, context: CallbackContext):
+def posts_next_chat(update: Update, context: CallbackContext):
+    """التنقل بين القنوات: الكل ← القناة 1 ← القناة 2 ← ... ← الكل"""
+    def change(state):
+        chats = [None] + posts.chats()
+        current = chats.index(state["chat"]) if state["chat"] in chats else 0
+        state["chat"] = chats[(current + 1) % len(chats)]
+    show_posts_page(update, context, change)
+
+
+def posts_search_clear(update: Update, context: CallbackContext):
+    show_posts_page(update, context, lambda state: state.update(query=""))
+
+
+def posts_search_start(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     query.answer()
-    data = query.data
-    if not data.startswith('edit_post:'):
-        query.edit_message_text('خطأ في تحديد المنشور.')
-        return
-    idx = int(data.split(':',1)[1])
-    if idx < 0 or idx >= len(posts):
+    query.edit_message_text('أرسل كلمة أو كلمات للبحث في نص المنشورات:')
+    return AWAIT_SEARCH
+
+
+def posts_search_receive(update: Update, context: CallbackContext) -> int:
+    state = posts_view(context)
+    state["query"] = update.message.text.strip()
+    state["after"] = None
+    state["pages"] = []
+    text, reply_markup = render_posts_page(context)
+    update.message.reply_text(text, reply_markup=reply_markup)
+    return ADMIN_PANEL
+
+
+def edit_post_menu(update: Update, context: CallbackContext, post_id: int):
+    query = update.callback_query
+    query.answer()
+    p = posts.get(post_id)
+    if p is None:
         query.edit_message_text('منشور غير صالح.')
         return
-    context.user_data['editing_post_idx'] = idx
-    p = posts[idx]
-    text = f"منشور رقم {idx}:\n{p.get('post_text')}\n\nتاريخ: {p.get('post_date').strftime('%d-%m-%Y %H:%M') if p.get('post_date') else 'غير محدد'}\nرابط: {p.get('post_link')}"
+    context.user_data['editing_post_id'] = post_id
+    show_post_menu(query, p)
+
+
+def show_post_menu(query, p):
+    text = f"منشور رقم {p.get('post_id')}:\n{p.get('post_text')}\n\nتاريخ: {p.get('post_date').strftime('%d-%m-%Y %H:%M') if p.get('post_date') else 'غير محدد'}\nرابط: {p.get('post_link')}"
+    resolution = countdown_resolution(p.get('post_resolution')).title
+    if not p.get('post_resolution'):
+        resolution += " (افتراضي)"
+    if p.get('post_quarantine'):
+        text += f"\n\n⛔ معزول (توقفت رسالته عن قبول التعديل): {p.get('post_quarantine')}"
     keyboard = [
-        [InlineKeyboardButton('✏️ تحديث النص', callback_data='edit_text')],
-        [InlineKeyboardButton('⏰ تغيير التاريخ/الوقت', callback_data='edit_date')],
-        [InlineKeyboardButton('🔗 تحديث الرابط', callback_data='edit_link')],
-        [InlineKeyboardButton('🛑 إيقاف وحذف المنشور', callback_data='stop_and_delete')],
-        [InlineKeyboardButton('❌ إغلاق', callback_data='close_panel')],
+        [InlineKeyboardButton('✏️ تحديث النص', callback_data=callback_for('edit_text'))],
+        [InlineKeyboardButton('⏰ تغيير التاريخ/الوقت', callback_data=callback_for('edit_date'))],
+        [InlineKeyboardButton('🔗 تحديث الرابط', callback_data=callback_for('edit_link'))],
+        [InlineKeyboardButton(f'🎯 دقة العد: {resolution}', callback_data=callback_for('edit_resolution'))],
+        [InlineKeyboardButton('🛑 إيقاف وحذف المنشور', callback_data=callback_for('stop_and_delete'))],
+        [InlineKeyboardButton('❌ إغلاق', callback_data=callback_for('close_panel'))],
     ]
+    if p.get('post_quarantine'):
+        keyboard.insert(0, [InlineKeyboardButton('♻️ إعادة التفعيل', callback_data=callback_for('reactivate_post'))])
     reply_markup = InlineKeyboardMarkup(keyboard)
     query.edit_message_text(text, reply_markup=reply_markup)
 
+
+def edit_resolution(update: Update, context: CallbackContext):
+    """التبديل بين الدقة الافتراضية ودقات العد المتاحة للمنشور الجاري تعديله."""
+    query = update.callback_query
+    query.answer()
+    post = editing_post(context)
+    if post is None:
+        query.edit_message_text('منشور غير صالح.')
+        return
+    choices = [None] + list(COUNTDOWN_RESOLUTIONS)
+    current = post.get('post_resolution')
+    post['post_resolution'] = choices[(choices.index(current) + 1) % len(choices) if current in choices else 0]
+    countdown_scheduler.add(post)
+    persist_post_update(post, 'post_resolution')
+    show_post_menu(query, post)
+
+
+def reactivate_post_handler(update: Update, context: CallbackContext):
+    """إعادة المنشور المعزول الجاري عرضه إلى دورات التحديث."""
+    query = update.callback_query
+    query.answer()
+    post = editing_post(context)
+    if post is None:
+        query.edit_message_text('منشور غير صالح.')
+        return
+    reactivate_post(post)
+    show_post_menu(query, post)
+
+
+def reactivate_all_handler(update: Update, context: CallbackContext):
+    """إعادة كل المنشورات المعزولة (مثلاً بعد إعادة صلاحيات البوت في القناة)."""
+    query = update.callback_query
+    query.answer()
+    quarantined = [posts.get(post_id) for post_id in list(posts.quarantined)]
+    for post in quarantined:
+        if post is not None:
+            reactivate_post(post)
+    query.edit_message_text(f"♻️ تمت إعادة تفعيل {len(quarantined)} منشور.")
+
 def start_timer_button(update: Update, context: CallbackContext):
     """يبدأ المؤقت عند الضغط على الزر."""
     query = update.callback_query
@@ -1070,13 +4716,13 @@ def start_timer_button(update: Update, context: CallbackContext):
     try:
         sent_message = context.bot.send_message(chat_id=timer_chat_id, text=message_text, reply_markup=reply_markup)
         timer_message_id = sent_message.message_id
-        save_data()
+        persist_state()
         query.edit_message_text("✅ تم بدء المؤقت في القناة.")
         update_timer(context.bot)
     except Exception as e:
         query.edit_message_text(f"❌ خطأ: {e}")
         timer_active = False
-        save_data()
+        persist_state()
 
 def close_panel(update: Update, context: CallbackContext):
     """يغلق لوحة التحكم."""
@@ -1113,6 +4759,994 @@ def cancel(update: Update, context: CallbackContext) -> int:
     # إنهاء أي محادثة جارية
     return ConversationHandler.END
 
+# --- الاستيراد والنشر الجماعي ---
+# ملف CSV (بسطر ترويسة) أو JSONL بالحقول: text, date, link, chat_id, media_type, media_file_id, resolution
+# (chat_id اختياري ويساوي CHANNEL_ID افتراضيًا، و resolution اختياري: adaptive أو minutes). كل الصفوف تُتحقق أولاً دفعة واحدة، ثم تُنشر عبر
+# مسارات لكل قناة بحدود المعدل نفسها المستخدمة في تحديث الأزرار.
+# سجل النشر (BULK_LEDGER_FILE) يُكتب قبل كل إرسال وبعده: عند إعادة تشغيل الاستيراد تُستأنف الصفوف
+# المعلقة فقط، والصف الذي انقطع أثناء إرساله (ربما نُشر فعلاً) لا يُعاد تلقائيًا حتى لا يتكرر في القناة.
+BULK_LEDGER_FILE = os.getenv("BULK_LEDGER_FILE", "bulk_import.journal")
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "5000"))
+BULK_DATE_FORMATS = ('%d-%m-%Y %H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+BULK_MEDIA_TYPES = ('photo', 'document', 'video')
+
+
+def parse_bulk_date(value) -> datetime.datetime:
+    value = str(value or "").strip()
+    for fmt in BULK_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return datetime.datetime.fromisoformat(value)
+
+
+def bulk_row_key(row: dict) -> str:
+    """هوية الصف حسب محتواه: نفس المنشور لا يُنشر مرتين حتى لو أُعيد رفعه في ملف آخر."""
+    # المعرف كنص كما كُتب في الملف، حتى تبقى هويات الصفوف المسجلة قبل توحيد المعرفات صالحة
+    payload = json.dumps([str(row["chat_id"]), row["post_text"], row["post_date"], row["post_link"], row["post_media"]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:20]
+
+
+def parse_bulk_rows(content: str, filename: str = ""):
+    """قراءة كل الصفوف والتحقق منها في مرور واحد. يعيد (الصفوف الصالحة، رسائل الأخطاء)."""
+    records = []
+    errors = []
+    if filename.lower().endswith((".jsonl", ".ndjson", ".json")) or content.lstrip().startswith("{"):
+        for line_no, line in enumerate(content.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                errors.append(f"سطر {line_no}: JSON غير صالح")
+                continue
+            if isinstance(record, dict):
+                records.append((line_no, record))
+            else:
+                errors.append(f"سطر {line_no}: يجب أن يكون كائن JSON")
+    else:
+        # السطر 1 هو الترويسة
+        for line_no, record in enumerate(csv.DictReader(io.StringIO(content)), 2):
+            records.append((line_no, {k.strip().lower(): v for k, v in record.items() if k}))
+
+    now = datetime.datetime.now()
+    rows = []
+    seen = set()
+    for line_no, record in records:
+        problems = []
+        text = str(record.get("text") or record.get("post_text") or "").strip()
+        link = str(record.get("link") or record.get("post_link") or "").strip() or None
+        chat_id = parse_chat_id(str(record.get("chat_id") or "").strip() or CHANNEL_ID)
+        media_type = str(record.get("media_type") or "").strip().lower() or None
+        file_id = str(record.get("media_file_id") or "").strip() or None
+        resolution = str(record.get("resolution") or "").strip().lower() or None
+
+        if not text:
+            problems.append("النص فارغ")
+        elif len(text) > (1024 if media_type else 4096):
+            problems.append("النص أطول من حد Telegram")
+        post_date = None
+        try:
+            post_date = parse_bulk_date(record.get("date") or record.get("post_date"))
+            if post_date <= now:
+                problems.append("التاريخ في الماضي")
+        except ValueError:
+            problems.append("صيغة التاريخ خاطئة (dd-mm-yyyy hh:mm)")
+        if link and not link.startswith(("http://", "https://", "tg://")):
+            problems.append("رابط غير صالح")
+        if media_type and media_type not in BULK_MEDIA_TYPES:
+            problems.append("نوع وسائط غير مدعوم")
+        elif media_type and not file_id:
+            problems.append("media_file_id مفقود")
+        if resolution and resolution not in COUNTDOWN_RESOLUTIONS:
+            problems.append("دقة عد غير معروفة")
+        if problems:
+            errors.append(f"سطر {line_no}: {'، '.join(problems)}")
+            continue
+
+        row = {
+            "line": line_no,
+            "chat_id": chat_id,
+            "post_text": text,
+            "post_link": link,
+            "post_media": {"type": media_type, "file_id": file_id} if media_type else None,
+            "post_date": post_date.isoformat(),
+            "post_resolution": resolution,
+        }
+        row["key"] = bulk_row_key(row)
+        if row["key"] in seen:
+            errors.append(f"سطر {line_no}: صف مكرر")
+            continue
+        seen.add(row["key"])
+        rows.append(row)
+
+    if len(rows) > BULK_MAX_ROWS:
+        errors.append(f"عدد الصفوف ({len(rows)}) أكبر من الحد المسموح ({BULK_MAX_ROWS})")
+    return rows, errors
+
+
+class BulkLedger:
+    """سجل إلحاقي لعمليات الاستيراد: begin (الصفوف كاملة) ثم sending / sent / failed / unknown لكل صف.
+
+    بعد انتهاء كل عملية يُضغط السجل: تبقى سجلات begin للعمليات غير المكتملة فقط، وآخر حالة لكل صف
+    (حتى لا يُنشر صف منشور سابقًا عند إعادة رفع ملفه)، ما عدا صفوف العمليات المنتهية التي تحمل هويتها
+    معرف العملية (import_id:...) لأنها لا تتكرر.
+    """
+
+    FINAL = ("sent", "failed", "unknown")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, record: dict):
+        # fsync قبل الإرسال: لا نرسل صفًا لم يُسجل أنه قيد الإرسال
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self):
+        """يعيد (العمليات: import_id -> صفوف، الحالة: row_key -> آخر سجل)."""
+        imports = {}
+        status = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # سطر أخير مقطوع
+                    if record.get("op") == "begin":
+                        for row in record["rows"]:
+                            row["chat_id"] = parse_chat_id(row["chat_id"])
+                        imports.setdefault(record["import"], record["rows"])
+                    elif status.get(record.get("key"), {}).get("op") != "sent":
+                        status[record.get("key")] = record
+        except FileNotFoundError:
+            pass
+        return imports, status
+
+    def unfinished(self, imports: dict, status: dict) -> dict:
+        return {
+            import_id: rows for import_id, rows in imports.items()
+            if any(status.get(r["key"], {}).get("op") not in self.FINAL for r in rows)
+        }
+
+    def pending_imports(self) -> dict:
+        """العمليات التي لم تنتهِ كل صفوفها (لاستئنافها عند بدء التشغيل)."""
+        return self.unfinished(*self.read())
+
+    def compact(self):
+        """إعادة كتابة السجل ذريًا بلا صفوف العمليات المنتهية وبلا الحالات القديمة لكل صف."""
+        with self.lock:
+            imports, status = self.read()
+            pending = self.unfinished(imports, status)
+            finished = tuple(f"{import_id}:" for import_id in imports if import_id not in pending)
+            records = [{"op": "begin", "import": import_id, "rows": rows} for import_id, rows in pending.items()]
+            records += [record for key, record in status.items() if not (key and key.startswith(finished))]
+            tmp_file = self.path + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+
+
+bulk_ledger = BulkLedger(BULK_LEDGER_FILE)
+
+
+class BulkPublisher:
+    """ينشر صفوف عملية استيراد بالتوازي (مسار متسلسل لكل قناة) مع حدود المعدل المشتركة.
+
+    الوسائط نفسها في عدة صفوف (مثل نشر مسودة في عدة قنوات) تُرسل أولاً مرة واحدة، وبقية الصفوف تنتظرها
+    ثم تستخدم file_id الذي أعاده Telegram، فلا تُرفع أو تُجلب من رابطها أكثر من مرة.
+    """
+
+    def __init__(self, bot, ledger: BulkLedger, limiter: RateLimiter, workers: int):
+        self.bot = bot
+        self.ledger = ledger
+        self.limiter = limiter
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.media_ready = {}  # file_id المصدر -> Event يُضبط بعد أول إرسال
+        self.media_sent = {}  # file_id المصدر -> file_id الناتج عن أول إرسال
+
+    def count(self, outcome: str, progress):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            snapshot = dict(self.counts)
+        if progress is not None:
+            progress(snapshot)
+
+    def claim_media(self, media):
+        """يعيد (الوسائط للإرسال، هل هذا أول إرسال لها). غير الأول ينتظر انتهاء الأول."""
+        source = (media or {}).get('file_id')
+        if not source:
+            return media, False
+        with self.lock:
+            ready = self.media_ready.get(source)
+            if ready is None:
+                self.media_ready[source] = threading.Event()
+                return media, True
+        ready.wait()
+        return {**media, "file_id": self.media_sent.get(source, source)}, False
+
+    def publish(self, row: dict, progress):
+        media, first = self.claim_media(row["post_media"])
+        sent = None
+        try:
+            sent = self.send(row, media, progress)
+        finally:
+            if first:
+                file_id = sent_media_file_id(sent, media["type"]) if sent is not None else None
+                if file_id:
+                    self.media_sent[media["file_id"]] = file_id
+                self.media_ready[media["file_id"]].set()
+
+    def send(self, row: dict, media, progress):
+        key = row["key"]
+        self.ledger.append({"op": "sending", "key": key})
+        url = effective_button_url(row["post_link"], row["chat_id"])
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⏳ جاري الحساب...", url=url)]])
+        while True:
+            self.limiter.acquire(row["chat_id"])
+            try:
+                sent = send_post_message(self.bot, row["chat_id"], row["post_text"], media, reply_markup)
+                break
+            except RetryAfter as e:
+                # الطلب رُفض قبل التنفيذ، إعادة المحاولة آمنة
+                self.limiter.pause(row["chat_id"], getattr(e, 'retry_after', 5))
+            except (BadRequest, Unauthorized) as e:
+                self.ledger.append({"op": "failed", "key": key, "error": str(e)})
+                self.count("failed", progress)
+                return None
+            except NetworkError as e:
+                # انقطاع أو مهلة: قد يكون المنشور وصل للقناة، فلا نعيد إرساله تلقائيًا
+                logging.warning(f"bulk import: نتيجة غير مؤكدة لسطر {row['line']}: {e}")
+                self.ledger.append({"op": "unknown", "key": key, "error": str(e)})
+                self.count("unknown", progress)
+                return None
+        self.ledger.append({"op": "sent", "key": key, "chat_id": row["chat_id"], "message_id": sent.message_id})
+        register_bulk_post(row, sent.message_id)
+        self.count("sent", progress)
+        return sent
+
+    def run_lane(self, rows, progress):
+        for row in rows:
+            try:
+                self.publish(row, progress)
+            except Exception as e:
+                logging.exception(f"bulk import: خطأ غير متوقع في سطر {row['line']}")
+                self.ledger.append({"op": "unknown", "key": row["key"], "error": str(e)})
+                self.count("unknown", progress)
+
+    def run(self, import_id: str, rows: list, progress=None, retry_unknown: bool = False) -> dict:
+        """نشر الصفوف غير المنشورة فقط. يعيد عدادات: sent / failed / unknown / skipped."""
+        imports, status = self.ledger.read()
+        if import_id not in imports:
+            self.ledger.append({"op": "begin", "import": import_id, "rows": rows})
+
+        pending = []
+        for row in rows:
+            last = status.get(row["key"], {})
+            if last.get("op") == "sent":
+                # منشور سابقًا؛ نتأكد فقط أنه مسجل لدينا (قد يكون التوقف حدث قبل حفظه)
+                register_bulk_post(row, last.get("message_id"))
+                self.count("skipped", None)
+            elif last.get("op") == "sending" or (last.get("op") == "unknown" and not retry_unknown):
+                if last.get("op") == "sending":
+                    self.ledger.append({"op": "unknown", "key": row["key"], "error": "interrupted while sending"})
+                self.count("unknown", None)
+            elif last.get("op") == "failed":
+                self.count("failed", None)
+            else:
+                pending.append(row)
+
+        lanes = {}
+        for row in pending:
+            lanes.setdefault(row["chat_id"], []).append(row)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bulk") as executor:
+            for future in [executor.submit(self.run_lane, lane, progress) for lane in lanes.values()]:
+                future.result()
+        self.ledger.compact()
+        report = {"total": len(rows), "sent": 0, "failed": 0, "unknown": 0, "skipped": 0}
+        report.update(self.counts)
+        return report
+
+
+def register_bulk_post(row: dict, message_id):
+    """إضافة منشور تم نشره إلى المنشورات المحفوظة وجدولة زره (مرة واحدة فقط)."""
+    if message_id is None or find_post(row["chat_id"], message_id) is not None:
+        return
+    post = posts.append(Post(
+        chat_id=row["chat_id"],
+        message_id=message_id,
+        post_text=row["post_text"],
+        post_link=row["post_link"],
+        post_media=row["post_media"],
+        post_date=datetime.datetime.fromisoformat(row["post_date"]),
+        post_resolution=row.get("post_resolution"),
+    ))
+    countdown_scheduler.add(post)
+    persist_post_add(post)
+
+
+def bulk_report_text(report: dict, title: str = "📥 نتيجة الاستيراد") -> str:
+    text = (
+        f"{title}: {report.get('sent', 0)} نُشر، {report.get('skipped', 0)} منشور سابقًا، "
+        f"{report.get('failed', 0)} فشل، {report.get('unknown', 0)} غير مؤكد (من {report.get('total', 0)})"
+    )
+    if report.get("unknown"):
+        text += "\n⚠️ الصفوف غير المؤكدة ربما نُشرت؛ تحقق من القناة قبل إعادة إرسالها."
+    return text
+
+
+def run_bulk_import(bot, import_id: str, rows: list, progress=None, retry_unknown: bool = False) -> dict:
+    publisher = BulkPublisher(bot, bulk_ledger, edit_engine.limiter, EDIT_WORKERS)
+    report = publisher.run(import_id, rows, progress, retry_unknown)
+    logging.info(bulk_report_text(report))
+    return report
+
+
+def fanout_rows(draft_id: str, draft: dict, chat_ids) -> list:
+    """صفوف نشر مسودة واحدة في عدة قنوات، بصيغة صفوف الاستيراد (فتُستأنف بعد التوقف بالسجل نفسه)."""
+    rows = []
+    for line, chat_id in enumerate(chat_ids, 1):
+        row = {
+            "line": line,
+            "chat_id": chat_id,
+            "post_text": draft["post_text"],
+            "post_link": draft.get("post_link"),
+            "post_media": draft.get("post_media"),
+            "post_date": draft["post_date"].isoformat(),
+            "post_resolution": None,
+        }
+        # المسودة نفسها قد تُنشر عمدًا مرة أخرى لاحقًا، فالهوية تشمل معرف عملية النشر
+        row["key"] = f"{draft_id}:{bulk_row_key(row)}"
+        rows.append(row)
+    return rows
+
+
+def start_fanout(update: Update, context: CallbackContext, chat_ids):
+    """نشر المسودة الحالية في عدة قنوات بالتوازي، مع رسالة تقدم تُحدَّث حتى الانتهاء."""
+    draft = {key: context.user_data.get(key) for key in ('post_text', 'post_date', 'post_link', 'post_media')}
+    draft_id = f"fanout-{uuid.uuid4().hex[:12]}"
+    rows = fanout_rows(draft_id, draft, chat_ids)
+    query = update.callback_query
+    query.edit_message_text(f"⏳ جاري النشر في {len(rows)} قناة...")
+
+    def worker():
+        report = run_bulk_import(get_bot(), draft_id, rows)
+        try:
+            query.edit_message_text(bulk_report_text(report, "📡 نتيجة النشر في القنوات"))
+        except Exception:
+            context.bot.send_message(chat_id=update.effective_chat.id, text=bulk_report_text(report, "📡 نتيجة النشر في القنوات"))
+
+    threading.Thread(target=worker, name=draft_id, daemon=True).start()
+
+
+def resume_bulk_imports(bot):
+    """استئناف عمليات الاستيراد التي توقفت قبل اكتمالها (عند بدء التشغيل) وإبلاغ الأدمن بالنتيجة."""
+    for import_id, rows in bulk_ledger.pending_imports().items():
+        print(f"جاري استئناف الاستيراد {import_id} ({len(rows)} صف)...")
+        report = run_bulk_import(bot, import_id, rows)
+        try:
+            bot.send_message(chat_id=ADMIN_ID, text=f"🔁 تم استئناف استيراد متوقف.\n{bulk_report_text(report)}")
+        except Exception as e:
+            logging.warning(f"تعذر إبلاغ الأدمن بنتيجة الاستيراد: {e}")
+
+
+def bulk_import_start(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    query.edit_message_text(
+        "📥 أرسل ملف CSV (بسطر ترويسة) أو JSONL يحتوي الحقول:\n"
+        "text, date (dd-mm-yyyy hh:mm), link, chat_id (اختياري), media_type, media_file_id, resolution (اختياري)\n\n"
+        "يمكن إعادة رفع الملف نفسه بأمان: الصفوف المنشورة سابقًا لا تُنشر مرة أخرى."
+    )
+    return AWAIT_IMPORT
+
+
+def bulk_import_receive(update: Update, context: CallbackContext) -> int:
+    document = update.message.document
+    try:
+        content = bytes(context.bot.get_file(document.file_id).download_as_bytearray()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        update.message.reply_text("❌ الملف يجب أن يكون نصًا بترميز UTF-8.")
+        return AWAIT_IMPORT
+
+    rows, errors = parse_bulk_rows(content, document.file_name or "")
+    if errors:
+        shown = "\n".join(errors[:20]) + (f"\n... و{len(errors) - 20} خطأ آخر" if len(errors) > 20 else "")
+        update.message.reply_text(f"❌ لم يُنشر أي شيء، صحح الأخطاء وأعد رفع الملف:\n{shown}")
+        return AWAIT_IMPORT
+    if not rows:
+        update.message.reply_text("❌ الملف لا يحتوي صفوفًا.")
+        return AWAIT_IMPORT
+
+    import_id = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+    status = update.message.reply_text(f"⏳ جاري نشر {len(rows)} منشور...")
+    last_edit = [0.0]
+
+    def progress(counts):
+        # تحديث رسالة التقدم كل 3 ثوانٍ على الأكثر
+        if time.monotonic() - last_edit[0] < 3:
+            return
+        last_edit[0] = time.monotonic()
+        done = sum(counts.values())
+        try:
+            status.edit_text(f"⏳ جاري النشر: {done}/{len(rows)} (نُشر {counts.get('sent', 0)}، فشل {counts.get('failed', 0)})")
+        except Exception:
+            pass
+
+    def worker():
+        report = run_bulk_import(get_bot(), import_id, rows, progress)
+        try:
+            status.edit_text(bulk_report_text(report))
+        except Exception:
+            context.bot.send_message(chat_id=update.effective_chat.id, text=bulk_report_text(report))
+
+    threading.Thread(target=worker, name=f"bulk-{import_id}", daemon=True).start()
+    return ConversationHandler.END
+
+
+def import_posts_cli(path: str, retry_unknown: bool = False):
+    """python main.py import-posts posts.csv [--retry-unknown]"""
+    with open(path, "r", encoding="utf-8-sig") as f:
+        content = f.read()
+    rows, errors = parse_bulk_rows(content, path)
+    if errors:
+        print("❌ لم يُنشر أي شيء، صحح الأخطاء التالية:")
+        for error in errors:
+            print(f"  {error}")
+        return
+    import_id = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+    print(f"جاري نشر {len(rows)} منشور (الاستيراد {import_id})...")
+
+    def progress(counts):
+        done = sum(counts.values())
+        if done % 10 == 0 or done == len(rows):
+            print(f"  {done}/{len(rows)}: {counts}")
+
+    report = run_bulk_import(get_bot(), import_id, rows, progress, retry_unknown)
+    print(bulk_report_text(report))
+
+
+# --- وضع التشغيل asyncio ---
+# RUNTIME=asyncio: استقبال التحديثات وتحديث الأزرار والحفظ الدوري على حلقة أحداث واحدة مع عميل HTTP غير متزامن.
+# معالجات python-telegram-bot 13 متزامنة، لذا تُنفَّذ مع مهام schedule على خيط حالة واحد بالتسلسل،
+# فلا تتزاحم على المتغيرات العامة (posts و timer_active و target_date).
+RUNTIME = os.getenv("RUNTIME", "threads").lower()
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", "100"))
+CHECKPOINT_INTERVAL = int(os.getenv("CHECKPOINT_INTERVAL", "300"))
+
+# اعتمادية اختيارية لوضع asyncio فقط، تُستورد عند الحاجة حتى لا تؤخر إقلاع الوضع العادي
+httpx = None
+async_runtime = None
+
+
+def load_httpx():
+    """استيراد httpx عند أول استخدام؛ None إذا لم يكن مثبتًا."""
+    global httpx
+    if httpx is None:
+        try:
+            import httpx
+        except ImportError:
+            return None
+    return httpx
+
+
+class AsyncTelegramClient:
+    """عميل Bot API غير متزامن مع تجمّع اتصالات دائمة (keep-alive)."""
+
+    def __init__(self, token: str, pool_size: int, base_url: str = "https://api.telegram.org/bot"):
+        load_httpx()
+        self.client = httpx.AsyncClient(
+            base_url=f"{base_url}{token}/",
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        )
+
+    async def call(self, method: str, **params):
+        """استدعاء طريقة من Bot API وتحويل الأخطاء إلى استثناءات telegram.error المعتادة."""
+        try:
+            response = await self.client.post(method, json={k: v for k, v in params.items() if v is not None})
+            data = response.json()
+        except httpx.HTTPError as e:
+            raise NetworkError(f"httpx error: {e}") from e
+        except ValueError:
+            raise NetworkError(f"Invalid server response ({response.status_code})")
+        if data.get("ok"):
+            return data.get("result")
+        description = data.get("description", "Unknown error")
+        retry_after = (data.get("parameters") or {}).get("retry_after")
+        if retry_after is not None:
+            raise RetryAfter(retry_after)
+        if data.get("error_code") in (401, 403):
+            raise Unauthorized(description)
+        if data.get("error_code") == 400:
+            raise BadRequest(description)
+        raise NetworkError(description)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class AsyncEditEngine:
+    """نسخة غير متزامنة من EditEngine: مسار لكل محادثة، وعدد محدود من الطلبات المتزامنة."""
+
+    def __init__(self, client: AsyncTelegramClient, limiter: RateLimiter, workers: int):
+        self.client = client
+        self.limiter = limiter
+        self.semaphore = asyncio.Semaphore(workers)
+
+    async def edit(self, chat_id, msg_id, text: str, url: str, label: str, attempts: int = 2, priority: bool = False) -> bool:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(text, url=url)]]).to_dict()
+        for attempt in range(1, attempts + 1):
+            await self.limiter.acquire_async(chat_id, priority)
+            started = time.monotonic()
+            try:
+                async with self.semaphore:
+                    started = time.monotonic()
+                    await self.client.call("editMessageReplyMarkup", chat_id=chat_id, message_id=msg_id, reply_markup=reply_markup)
+                error = None
+            except Exception as e:
+                error = e
+            result = settle_edit_attempt(self.limiter, chat_id, msg_id, text, url, label, started, error, attempt, attempts)
+            if isinstance(result, bool):
+                return result
+            await asyncio.sleep(result)
+        return False
+
+    async def run_lane(self, jobs, stats: PassStats):
+        for chat_id, msg_id, text, url, label in jobs:
+            if not edit_health.allow(chat_id, msg_id):
+                continue
+            stats.record(await self.edit(chat_id, msg_id, text, url, label, attempts=1))
+
+    async def run_pass(self, jobs, rendered_at: float = None) -> PassStats:
+        stats = PassStats(rendered_at if rendered_at is not None else time.monotonic())
+        lanes = {}
+        for job in jobs:
+            lanes.setdefault(job[0], []).append(job)
+        await asyncio.gather(*(self.run_lane(lane, stats) for lane in lanes.values()))
+        stats.finish(len(jobs))
+        return stats
+
+
+class AsyncRuntime:
+    """تشغيل البوت بالكامل على حلقة asyncio واحدة."""
+
+    def __init__(self, updater: Updater):
+        self.updater = updater
+        self.dispatcher = updater.dispatcher
+        self.state_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self.loop = None
+        self.client = None
+        self.engine = None
+        self.stop_event = None
+        self.wake_event = None
+
+    async def in_state(self, func, *args):
+        """تنفيذ دالة متزامنة على خيط الحالة (بالتسلسل مع المعالجات ومهام schedule)."""
+        return await self.loop.run_in_executor(self.state_executor, func, *args)
+
+    def submit_edit(self, job, label: str, attempts: int = 2, priority: bool = False):
+        """جدولة تعديل زر على الحلقة من أي خيط."""
+        asyncio.run_coroutine_threadsafe(self.engine.edit(*job, label=label, attempts=attempts, priority=priority), self.loop)
+
+    async def poll_updates(self):
+        """استقبال التحديثات عبر getUpdates طويل الانتظار وتمريرها إلى dispatcher."""
+        await self.client.call("deleteWebhook", drop_pending_updates=not UPDATES_CATCH_UP)
+        startup.mark("receiving_updates")
+        offset = None
+        while True:
+            try:
+                updates = await self.client.call("getUpdates", offset=offset, timeout=30)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Unauthorized as e:
+                # توكن ملغى أو غير صالح: لا فائدة من الاستمرار، فنوقف البوت بدل أن يبقى حيًا بلا تحديثات
+                logging.error(f"Unauthorized while polling updates, stopping: {e}")
+                self.stop_event.set()
+                return
+            except NetworkError as e:
+                logging.warning(f"Network error while polling updates: {e}")
+                await asyncio.sleep(3)
+                continue
+            except Exception:
+                logging.exception("Error while polling updates")
+                await asyncio.sleep(3)
+                continue
+            for data in updates:
+                offset = data["update_id"] + 1
+                update = Update.de_json(data, self.updater.bot)
+                tracer.update_received(update)
+                self.loop.run_in_executor(self.state_executor, self.dispatcher.process_update, update)
+
+    async def refresh_posts(self):
+        """نسخة غير متزامنة من CountdownScheduler.run: النوم حتى أقرب موعد ثم تحديث المستحق."""
+        countdown_scheduler.wakeup = lambda: self.loop.call_soon_threadsafe(self.wake_event.set)
+        await self.in_state(countdown_scheduler.reset, posts)
+        while True:
+            self.wake_event.clear()
+            timeout = countdown_scheduler.seconds_until_next(datetime.datetime.now())
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wake_event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                rendered_at = time.monotonic()
+                due_items = countdown_scheduler.pop_ready(datetime.datetime.now(), COUNTDOWN_BATCH)
+                jobs = await self.in_state(countdown_scheduler.collect_jobs, due_items)
+                if jobs:
+                    countdown_scheduler.log_stats(await self.engine.run_pass(jobs, rendered_at), len(jobs))
+                else:
+                    report_first_update()
+            except Exception:
+                logging.exception("Error in countdown scheduler")
+                await asyncio.sleep(1)
+
+    async def run_jobs(self):
+        await self.in_state(register_schedule_jobs)
+        while True:
+            await self.in_state(run_pending_jobs)
+            await asyncio.sleep(1)
+
+    async def checkpoint_periodically(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            await self.in_state(save_data)
+
+    def task_done(self, task):
+        """مهمة خرجت بخطأ غير معالج: نوقف البوت بدل أن يبقى حيًا وقد توقف جزء منه بصمت."""
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Async task {task.get_coro().__qualname__} failed, stopping", exc_info=task.exception())
+            self.stop_event.set()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.client = AsyncTelegramClient(BOT_TOKEN, ASYNC_POOL_SIZE)
+        self.engine = AsyncEditEngine(self.client, edit_engine.limiter, EDIT_WORKERS)
+        self.stop_event = asyncio.Event()
+        self.wake_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop_event.set)
+            except NotImplementedError:
+                pass
+
+        coros = [self.run_jobs(), self.checkpoint_periodically()]
+        webhook = None
+        if UPDATE_MODE == "webhook":
+            # المعالجات تبقى على خيط الحالة؛ مسار العامل ينتظر انتهاء تحديثه قبل التالي
+            webhook = start_webhook_server(
+                self.updater.bot, lambda update: self.state_executor.submit(self.dispatcher.process_update, update).result()
+            )
+            if WEBHOOK_URL:
+                await self.client.call("setWebhook", **webhook_params())
+        else:
+            coros.append(self.poll_updates())
+        if COUNTDOWN_MODE != "sharded":
+            coros.append(self.refresh_posts())
+        tasks = [asyncio.create_task(coro) for coro in coros]
+        for task in tasks:
+            task.add_done_callback(self.task_done)
+        await self.stop_event.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if webhook is not None:
+            webhook.stop()
+
+        # ضغط السجل في لقطة نهائية عند الإيقاف
+        await self.in_state(save_data)
+        await self.client.close()
+        self.state_executor.shutdown()
+
+
+# --- استقبال التحديثات عبر webhook ---
+# UPDATE_MODE=webhook: خادم HTTP مضمّن يستقبل التحديثات من Telegram مباشرة بدل getUpdates طويل الانتظار.
+# كل طلب يُتحقق منه ويُحوَّل إلى Update ويوضع في مسار عامل حسب المستخدم ثم يُرد 200 فورًا:
+# تحديثات المستخدم الواحد تبقى بالترتيب، ومستخدمون مختلفون لا ينتظر أحدهم الآخر.
+# امتلاء المسار يعيد 503 فيعيد Telegram إرسال التحديث لاحقًا بدل ضياعه.
+# UPDATES_CATCH_UP=1 يعالج التحديثات المتراكمة أثناء التوقف بدل حذفها (في وضعي polling و webhook).
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").lower()
+UPDATES_CATCH_UP = os.getenv("UPDATES_CATCH_UP", "0") == "1"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # العنوان العام الذي يرسل إليه Telegram (خلف وكيل TLS)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "") or urlparse(WEBHOOK_URL).path or "/"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # اتصالات دائمة مع Telegram
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        status = None
+        if self.path.split("?")[0] != webhook.path:
+            status = 404
+        else:
+            try:
+                length = int(self.headers.get("Content-Length", ""))
+            except ValueError:
+                status = 411
+            else:
+                if length > webhook.max_body:
+                    status = 413
+                else:
+                    status = webhook.accept(self.headers, self.rfile.read(length))
+        if status in (404, 411, 413):
+            # الجسم لم يُقرأ، فلا يمكن إعادة استخدام الاتصال
+            self.close_connection = True
+        metrics.inc("webhook_requests_total", status=str(status))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookServer:
+    """خادم webhook: يتحقق من الطلبات ويوزع التحديثات على مسارات عمال تستدعي dispatch(update)."""
+
+    def __init__(self, bot, dispatch, listen: str, port: int, path: str, secret: str = "",
+                 workers: int = 4, max_body: int = 1024 * 1024, queue_size: int = 1000):
+        self.bot = bot
+        self.dispatch = dispatch
+        self.path = path if path.startswith("/") else "/" + path
+        self.secret = secret
+        self.max_body = max_body
+        self.lanes = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        # Telegram يعيد إرسال التحديث إذا انقطع الاتصال قبل الرد؛ نتجاهل المعرفات المكررة الحديثة
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=4096)
+        self.recent_ids = set()
+        self.httpd = ThreadingHTTPServer((listen, port), WebhookHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        for i, lane in enumerate(self.lanes):
+            threading.Thread(target=self.run_lane, args=(lane,), name=f"webhook-{i}", daemon=True).start()
+        threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for lane in self.lanes:
+            lane.put(None)
+
+    def run_lane(self, lane: queue.Queue):
+        while True:
+            item = lane.get()
+            if item is None:
+                return
+            received, update = item
+            metrics.observe("webhook_queue_seconds", time.monotonic() - received)
+            tracer.update_received(update, received)
+            try:
+                self.dispatch(update)
+            except Exception:
+                logging.exception(f"webhook: فشل معالجة التحديث {update.update_id}")
+
+    def lane_for(self, update: Update) -> queue.Queue:
+        owner = update.effective_user or update.effective_chat
+        return self.lanes[(owner.id if owner else update.update_id) % len(self.lanes)]
+
+    def accept(self, headers, body: bytes) -> int:
+        """التحقق من طلب واحد ووضعه في مساره. يعيد رمز حالة HTTP."""
+        if self.secret and not hmac.compare_digest(headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret):
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400
+        if update is None:
+            return 400
+
+        with self.lock:
+            if update.update_id in self.recent_ids:
+                return 200
+            if len(self.recent) == self.recent.maxlen:
+                self.recent_ids.discard(self.recent[0])
+            self.recent.append(update.update_id)
+            self.recent_ids.add(update.update_id)
+        try:
+            self.lane_for(update).put_nowait((time.monotonic(), update))
+        except queue.Full:
+            with self.lock:
+                self.recent_ids.discard(update.update_id)
+            return 503
+        return 200
+
+
+def webhook_params() -> dict:
+    """معاملات setWebhook حسب الإعدادات."""
+    params = {
+        "url": WEBHOOK_URL,
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        "drop_pending_updates": not UPDATES_CATCH_UP,
+    }
+    if WEBHOOK_SECRET:
+        params["secret_token"] = WEBHOOK_SECRET
+    return params
+
+
+def start_webhook_server(bot, dispatch) -> WebhookServer:
+    server = WebhookServer(
+        bot, dispatch, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+        WEBHOOK_WORKERS, WEBHOOK_MAX_BODY, WEBHOOK_QUEUE_SIZE,
+    )
+    server.start()
+    print(f"✅ webhook يستمع على {WEBHOOK_LISTEN}:{server.port}{server.path} ({WEBHOOK_WORKERS} مسار)")
+    return server
+
+
+def run_webhook(updater: Updater):
+    """تشغيل وضع webhook في وضع threads حتى SIGINT/SIGTERM."""
+    server = start_webhook_server(updater.bot, updater.dispatcher.process_update)
+    startup.mark("receiving_updates")
+    if WEBHOOK_URL:
+        updater.bot.set_webhook(**webhook_params())
+        print(f"✅ تم تسجيل webhook: {WEBHOOK_URL}")
+    else:
+        print("⚠️ WEBHOOK_URL غير محدد، لن يُسجَّل webhook لدى Telegram (يجب تسجيله يدويًا).")
+
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *args: stop_event.set())
+    while not stop_event.wait(1):
+        pass
+    server.stop()
+
+
+# --- توجيه أزرار الاستجابة ---
+# بيانات كل زر "رمز:وسيط:وسيط" برمز قصير للإجراء ووسائط ذات أنواع، وتُفك بخطوة واحدة من جدول (بحث قاموس)
+# بدل تجربة نمط regex لكل معالج بالتسلسل؛ فزمن الضغطة لا يزيد بإضافة إجراءات جديدة. الأسماء الكاملة القديمة
+# (edit_post:12، posts_filter:active...) تبقى مقبولة حتى تعمل أزرار رسائل اللوحة المرسلة قبل التحديث.
+class CallbackRouter:
+    """جدول التوجيه: رمز الإجراء (أو اسمه الكامل) -> (المعالج، أنواع الوسائط)."""
+
+    def __init__(self):
+        self.routes = {}
+        self.codes = {}  # الاسم الكامل -> الرمز القصير
+
+    def add(self, action: str, code: str, handler, *arg_types):
+        """تسجيل إجراء. الوسائط الناقصة في البيانات تأخذ القيم الافتراضية للمعالج."""
+        if action in self.routes or code in self.routes:
+            raise ValueError(f"مسار زر مكرر: {action} ({code})")
+        self.routes[action] = self.routes[code] = (handler, arg_types)
+        self.codes[action] = code
+
+    def data(self, action: str, *args) -> str:
+        data = ":".join([self.codes[action], *map(str, args)])
+        if len(data.encode()) > 64:
+            raise ValueError(f"callback_data أطول من 64 بايت: {data}")
+        return data
+
+    def decode(self, data: str):
+        """(المعالج، الوسائط محولة لأنواعها)، أو None لبيانات غير معروفة أو وسائط غير صالحة."""
+        code, _, rest = data.partition(":")
+        route = self.routes.get(code)
+        if route is None:
+            return None
+        handler, arg_types = route
+        if not rest:
+            return handler, ()
+        if not arg_types:
+            return None
+        # الوسيط الأخير يأخذ باقي النص (قد يحتوي ":")
+        values = rest.split(":", len(arg_types) - 1)
+        try:
+            return handler, tuple(kind(value) for kind, value in zip(arg_types, values))
+        except ValueError:
+            return None
+
+    def dispatch(self, update: Update, context: CallbackContext):
+        """تنفيذ زر مباشرة دون المرور بسلسلة معالجات dispatcher."""
+        route = self.decode(update.callback_query.data or "")
+        if route is None:
+            update.callback_query.answer()
+            return None
+        handler, args = route
+        return self.call(update, context, handler, args)
+
+    def call(self, update: Update, context: CallbackContext, handler, args):
+        """كل الأزرار إجراءات لوحة التحكم: تُنفذ للأدمن فقط (مثل admin_only)."""
+        user = update.effective_user
+        if user is None or user.id != ADMIN_ID:
+            tracer.fail("forbidden")
+            update.callback_query.answer("❌ ليس لديك صلاحية استخدام هذا الأمر.")
+            return None
+        return handler(update, context, *args)
+
+
+class CallbackRouteHandler(CallbackQueryHandler):
+    """CallbackQueryHandler واحد لكل الأزرار: المطابقة فك واحد من جدول التوجيه."""
+
+    def __init__(self, router: CallbackRouter):
+        super().__init__(router.dispatch)
+        self.router = router
+
+    def check_update(self, update):
+        if isinstance(update, Update) and update.callback_query and isinstance(update.callback_query.data, str):
+            return self.router.decode(update.callback_query.data)
+        return None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        handler, args = check_result
+        tracer.name(callable_name(handler))
+        return self.router.call(update, context, handler, args)
+
+
+callback_router = CallbackRouter()
+
+
+def callback_for(action: str, *args) -> str:
+    """callback_data لزر الإجراء action بوسائطه."""
+    return callback_router.data(action, *args)
+
+
+callback_router.add('new_post', 'np', start_new_post)
+callback_router.add('my_posts', 'mp', list_my_posts)
+callback_router.add('posts_page', 'pg', posts_next_page, float, int)
+callback_router.add('posts_prev', 'pv', posts_prev_page)
+callback_router.add('posts_filter', 'pf', posts_filter, str)
+callback_router.add('posts_chat', 'pc', posts_next_chat)
+callback_router.add('posts_search', 'ps', posts_search_start)
+callback_router.add('posts_search_clear', 'px', posts_search_clear)
+callback_router.add('edit_post', 'ep', edit_post_menu, int)
+callback_router.add('edit_text', 'et', edit_text_start)
+callback_router.add('edit_date', 'ed', edit_date_start)
+callback_router.add('edit_link', 'el', edit_link_start)
+callback_router.add('edit_resolution', 'er', edit_resolution)
+callback_router.add('stop_and_delete', 'sd', stop_and_delete_post)
+callback_router.add('reactivate_post', 'rp', reactivate_post_handler)
+callback_router.add('reactivate_all', 'ra', reactivate_all_handler)
+callback_router.add('bulk_import', 'bi', bulk_import_start)
+callback_router.add('channels', 'ch', channels_menu)
+callback_router.add('channel_remove', 'cr', channels_menu, int)
+callback_router.add('channel_add', 'ca', channel_add_start)
+callback_router.add('dead_letters', 'dl', dead_letters_menu, str)
+callback_router.add('cleanup_posts', 'cp', cleanup_posts_handler)
+callback_router.add('profiling', 'pr', profiling_menu, str)
+callback_router.add('attach_media', 'am', start_attach_media)
+callback_router.add('no_media', 'nm', no_media_callback)
+callback_router.add('draft_channels', 'dc', draft_channels_menu)
+callback_router.add('draft_channel', 'dt', draft_channels_menu, int)
+callback_router.add('draft_channels_all', 'da', partial(draft_channels_menu, select_all=True))
+callback_router.add('draft_preview', 'dp', draft_preview)
+callback_router.add('confirm_send', 'ok', confirm_send)
+callback_router.add('cancel_send', 'no', cancel_send)
+callback_router.add('close_panel', 'x', close_panel)
+# إجراءات لوحة المؤقت العام (لا تُنشأ أزرارها حاليًا، وتبقى لرسائل قديمة)
+callback_router.add('set_date', 'sdt', ask_for_date)
+callback_router.add('set_message', 'smg', ask_for_message)
+callback_router.add('set_link', 'slk', ask_for_link)
+callback_router.add('start_preview', 'spv', start_preview)
+callback_router.add('stop_timer', 'stt', stop_timer_handler)
+
+
 # --- الدالة الرئيسية ---
 # إعداد التسجيل
 logging.basicConfig(
@@ -1134,7 +5768,9 @@ def error_handler(update, context):
         logger.error('خطأ في الشبكة. جاري المحاولة مرة أخرى...')
     except RetryAfter as e:
         logger.error(f'تم تجاوز حد الطلبات. الانتظار {e.retry_after} ثوانٍ')
-        time.sleep(e.retry_after)
+        # في وضع asyncio تعمل كل المعالجات والمهام على خيط حالة واحد، فالنوم هنا يوقفها كلها
+        if async_runtime is None:
+            time.sleep(e.retry_after)
     except Exception as e:
         logger.error(f'حدث خطأ غير متوقع: {str(e)}')
 
@@ -1152,45 +5788,43 @@ def main():
     """
     الدالة الرئيسية لتشغيل البوت.
     """
+    startup.record("imports", time.monotonic() - startup.started)
     try:
-        print('جاري تحميل البيانات...')
-        load_data()
-        
+        start_metrics_server()
+
+        # التحقق من التوكن (رحلة شبكة كاملة) يجري في خيط بالتوازي مع تحميل البيانات
         print('جاري الاتصال بـ Telegram...')
-        defaults = Defaults(timeout=30)
-        updater = Updater(BOT_TOKEN, use_context=True, defaults=defaults)
-        dispatcher = updater.dispatcher
+        with startup.phase("updater"):
+            updater = create_updater(get_bot())
+            dispatcher = updater.dispatcher
+        handshake = ThreadPoolExecutor(max_workers=1, thread_name_prefix="handshake").submit(updater.bot.get_me)
+
+        print('جاري تحميل البيانات...')
+        with startup.phase("load_data"):
+            load_data()
+        with startup.phase("retry_queue"):
+            retry_queue.load()
 
         # --- إعداد محادثة لوحة الأدمن ---
+        # كل الأزرار تمر بمعالج واحد (جدول التوجيه) كنقطة دخول: مع allow_reentry يُفحص قبل معالجات الحالة،
+        # فيعمل الزر في أي حالة، والمعالج الذي يعيد حالة (مثل edit_text) ينقل المحادثة إليها.
         conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('admin', admin_panel)],
+            entry_points=[
+                CommandHandler('admin', admin_panel),
+                CallbackRouteHandler(callback_router),
+            ],
             states={
-                ADMIN_PANEL: [
-                    CallbackQueryHandler(ask_for_date, pattern='^set_date$'),
-                    CallbackQueryHandler(ask_for_message, pattern='^set_message$'),
-                    CallbackQueryHandler(ask_for_link, pattern='^set_link$'),
-                    CallbackQueryHandler(start_preview, pattern='^start_preview$'),
-                    CallbackQueryHandler(start_new_post, pattern='^new_post$'),
-                    CallbackQueryHandler(list_my_posts, pattern='^my_posts$'),
-                    CallbackQueryHandler(cleanup_posts_handler, pattern='^cleanup_posts$'),
-                    CallbackQueryHandler(stop_timer_handler, pattern='^stop_timer$'),
-                    CallbackQueryHandler(stop_and_delete_post, pattern='^stop_and_delete$'),
-                    CallbackQueryHandler(edit_post_menu, pattern='^edit_post:\d+$'),
-                    CallbackQueryHandler(confirm_send, pattern='^confirm_send$'),
-                    CallbackQueryHandler(cancel_send, pattern='^cancel_send$'),
-                    CallbackQueryHandler(close_panel, pattern='^close_panel$'),
-                ],
+                ADMIN_PANEL: [],
                 AWAIT_DATE: [MessageHandler(Filters.text & ~Filters.command, receive_date)],
                 AWAIT_MESSAGE: [MessageHandler(Filters.text & ~Filters.command, receive_post_text), MessageHandler(Filters.text & ~Filters.command, receive_message)],
                 AWAIT_LINK: [MessageHandler(Filters.text & ~Filters.command, receive_link)],
-                AWAIT_MEDIA: [
-                    MessageHandler(Filters.photo | Filters.video | Filters.document, receive_media),
-                    CallbackQueryHandler(start_attach_media, pattern='^attach_media$'),
-                    CallbackQueryHandler(no_media_callback, pattern='^no_media$'),
-                ],
+                AWAIT_MEDIA: [MessageHandler(Filters.photo | Filters.video | Filters.document, receive_media)],
                 EDIT_TEXT: [MessageHandler(Filters.text & ~Filters.command, edit_text_receive)],
                 EDIT_DATE: [MessageHandler(Filters.text & ~Filters.command, edit_date_receive)],
                 EDIT_LINK: [MessageHandler(Filters.text & ~Filters.command, edit_link_receive)],
+                AWAIT_SEARCH: [MessageHandler(Filters.text & ~Filters.command, posts_search_receive)],
+                AWAIT_IMPORT: [MessageHandler(Filters.document, bulk_import_receive)],
+                AWAIT_CHANNEL: [MessageHandler(Filters.text & ~Filters.command, channel_add_receive)],
             },
             fallbacks=[CommandHandler('cancel', cancel), CommandHandler('admin', admin_panel)],
             allow_reentry=True
@@ -1201,28 +5835,38 @@ def main():
         # إضافة معالج أمر /cancel العام (يعمل في جميع الأوقات)
         dispatcher.add_handler(CommandHandler("cancel", cancel))
 
-        # تسجيل معالجات الاستجابة للأزرار العامة (حتى تعمل بعد انتهاء الـ Conversation)
-        dispatcher.add_handler(CallbackQueryHandler(confirm_send, pattern='^confirm_send$'))
-        dispatcher.add_handler(CallbackQueryHandler(cancel_send, pattern='^cancel_send$'))
-        dispatcher.add_handler(CallbackQueryHandler(list_my_posts, pattern='^my_posts$'))
-        dispatcher.add_handler(CallbackQueryHandler(stop_timer_handler, pattern='^stop_timer$'))
-        dispatcher.add_handler(CallbackQueryHandler(stop_and_delete_post, pattern='^stop_and_delete$'))
-        dispatcher.add_handler(CallbackQueryHandler(edit_post_menu, pattern='^edit_post:\d+$'))
-        dispatcher.add_handler(CallbackQueryHandler(edit_text_start, pattern='^edit_text$'))
-        dispatcher.add_handler(CallbackQueryHandler(edit_date_start, pattern='^edit_date$'))
-        dispatcher.add_handler(CallbackQueryHandler(edit_link_start, pattern='^edit_link$'))
-        # handlers for media attach flow
-        dispatcher.add_handler(CallbackQueryHandler(start_attach_media, pattern='^attach_media$'))
-        dispatcher.add_handler(CallbackQueryHandler(no_media_callback, pattern='^no_media$'))
-
         # إضافة معالج الأخطاء
         dispatcher.add_error_handler(error_handler)
 
         # إضافة معالج أمر /start
         dispatcher.add_handler(CommandHandler("start", start))
 
+        # تشخيص الأداء للأدمن
+        dispatcher.add_handler(CommandHandler("profile", profile_command))
+        dispatcher.add_handler(CommandHandler("memprofile", memprofile_command))
+        dispatcher.add_handler(CommandHandler("profile_stop", profile_stop_command))
+
         # (تم نقل الأوامر القديمة إلى لوحة التحكم)
 
+        trace_dispatcher(updater)
+
+        if RUNTIME == "asyncio":
+            if load_httpx() is None:
+                print("❌ وضع asyncio يتطلب تثبيت httpx: pip install httpx")
+                return
+            print("جاري التحقق من صحة توكن البوت...")
+            with startup.phase("handshake"):
+                me = handshake.result()
+            print(f"✅ تم الاتصال بنجاح! معرف البوت: @{me.username}")
+
+            threading.Thread(target=resume_bulk_imports, args=(updater.bot,), daemon=True).start()
+
+            global async_runtime
+            print("البوت قيد التشغيل (asyncio)...")
+            async_runtime = AsyncRuntime(updater)
+            asyncio.run(async_runtime.run())
+            return
+
         # بدء خيط الجدولة في الخلفية
         scheduler_thread = threading.Thread(target=run_schedule, args=(updater,))
         scheduler_thread.daemon = True
@@ -1230,13 +5874,28 @@ def main():
 
         # بدء تشغيل البوت
         print("جاري التحقق من صحة توكن البوت...")
-        me = updater.bot.get_me()
+        with startup.phase("handshake"):
+            me = handshake.result()
         print(f"✅ تم الاتصال بنجاح! معرف البوت: @{me.username}")
+
+        # استئناف أي استيراد جماعي توقف قبل اكتماله
+        threading.Thread(target=resume_bulk_imports, args=(updater.bot,), daemon=True).start()
         
+        if UPDATE_MODE == "webhook":
+            print("البوت قيد التشغيل (webhook)...")
+            run_webhook(updater)
+            save_data()
+            return
+
         print("البوت قيد التشغيل...")
-        updater.start_polling(drop_pending_updates=True)
+        with startup.phase("start_polling"):
+            updater.start_polling(drop_pending_updates=not UPDATES_CATCH_UP)
+        startup.mark("receiving_updates")
         updater.idle()
 
+        # ضغط السجل في لقطة نهائية عند الإيقاف
+        save_data()
+
     except Unauthorized:
         print("❌ خطأ: توكن البوت غير صالح! تأكد من التوكن في ملف .env")
     except NetworkError:
@@ -1245,4 +5904,20 @@ def main():
         print(f"❌ حدث خطأ غير متوقع: {str(e)}")
 
 if __name__ == "__main__":
-    main()
+    # أوامر التصدير والاستيراد: python main.py export-json data.json | python main.py import-json data.json
+    if len(sys.argv) == 3 and sys.argv[1] == "export-json":
+        load_data()
+        export_json(sys.argv[2])
+    elif len(sys.argv) == 3 and sys.argv[1] == "import-json":
+        import_json(sys.argv[2])
+        save_data()
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "import-posts":
+        # نشر جماعي من CSV/JSONL: python main.py import-posts posts.csv [--retry-unknown]
+        load_data()
+        import_posts_cli(sys.argv[2], retry_unknown="--retry-unknown" in sys.argv[3:])
+        save_data()
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "worker":
+        # عامل عد تنازلي منفصل (COUNTDOWN_MODE=sharded مع STORAGE_BACKEND=sqlite)
+        run_countdown_worker(sys.argv[2] if len(sys.argv) == 3 else None)
+    else:
+        main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# main.py يقرأ هذه القيم عند الاستيراد
+os.environ.setdefault("BOT_TOKEN", "123:abc")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("CHANNEL_ID", "@chan")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
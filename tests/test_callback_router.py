@@ -0,0 +1,103 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import CallbackRouteHandler, CallbackRouter
+
+
+def page(update, context, after=None, page_no=0):
+    pass
+
+
+def menu(update, context):
+    pass
+
+
+def search(update, context, query=""):
+    pass
+
+
+@pytest.fixture
+def router():
+    router = CallbackRouter()
+    router.add("posts_page", "pg", page, float, int)
+    router.add("menu", "m", menu)
+    router.add("search", "s", search, str)
+    return router
+
+
+def test_data_round_trips_through_decode(router):
+    data = router.data("posts_page", 1760000000.25, 7)
+    assert data == "pg:1760000000.25:7"
+    assert router.decode(data) == (page, (1760000000.25, 7))
+    assert router.decode(router.data("menu")) == (menu, ())
+
+
+def test_full_action_name_also_decodes(router):
+    assert router.decode("posts_page:1.5:2") == (page, (1.5, 2))
+    assert router.decode("menu") == (menu, ())
+
+
+def test_missing_args_fall_back_to_handler_defaults(router):
+    assert router.decode("pg") == (page, ())
+    assert router.decode("pg:3.0") == (page, (3.0,))
+
+
+def test_last_str_arg_keeps_colons(router):
+    assert router.decode("s:a:b:c") == (search, ("a:b:c",))
+
+
+@pytest.mark.parametrize("data", ["", "zz", "zz:1", "m:1", "pg:abc:1", "pg:1.0:x", "x"])
+def test_unknown_or_invalid_data_decodes_to_none(router, data):
+    assert router.decode(data) is None
+
+
+def test_duplicate_action_or_code_is_rejected(router):
+    with pytest.raises(ValueError):
+        router.add("menu", "m2", menu)
+    with pytest.raises(ValueError):
+        router.add("other", "m", menu)
+
+
+def test_data_longer_than_64_bytes_is_rejected(router):
+    router.data("search", "ب" * 30)
+    with pytest.raises(ValueError):
+        router.data("search", "ب" * 32)
+
+
+def test_every_registered_action_decodes_to_its_handler():
+    router = main.callback_router
+    for action, code in router.codes.items():
+        handler, arg_types = router.routes[action]
+        assert router.decode(code) == (handler, ())
+        args = tuple(kind(1) for kind in arg_types)
+        assert router.decode(router.data(action, *args)) == (handler, args)
+
+
+def press(user_id, data):
+    answers = []
+    query = SimpleNamespace(data=data, answer=lambda *args, **kwargs: answers.append(args))
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), callback_query=query), answers
+
+
+@pytest.mark.parametrize("via_handler", [False, True])
+def test_non_admin_press_is_not_dispatched(via_handler):
+    calls = []
+    router = CallbackRouter()
+    router.add("bulk_import", "bi", lambda update, context, *args: calls.append(args) or "state", int)
+    handler = CallbackRouteHandler(router)
+
+    def run(update):
+        if via_handler:
+            return handler.handle_update(update, None, router.decode(update.callback_query.data), None)
+        return router.dispatch(update, None)
+
+    update, answers = press(main.ADMIN_ID + 1, "bi:5")
+    assert run(update) is None
+    assert calls == []
+    assert answers == [("❌ ليس لديك صلاحية استخدام هذا الأمر.",)]
+
+    update, answers = press(main.ADMIN_ID, "bi:5")
+    assert run(update) == "state"
+    assert calls == [(5,)]
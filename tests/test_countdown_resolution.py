@@ -0,0 +1,64 @@
+import datetime
+import random
+
+import pytest
+
+from main import CountdownResolution, next_label_change
+
+EPS = 1e-6
+# مستويات ثابتة حتى لا تعتمد الاختبارات على متغيرات البيئة
+ADAPTIVE = CountdownResolution("t", "t", [(48 * 3600, 86400), (3600, 3600), (60, 60), (0, 10)])
+MINUTES = CountdownResolution("m", "m", [(0, 60)], full=True)
+
+
+@pytest.mark.parametrize("remaining, label", [
+    (5 * 86400 - 1, "⏳ 4 يوم"),
+    (48 * 3600, "⏳ 2 يوم"),
+    (48 * 3600 - 1, "⏳ 1 يوم : 23 ساعة"),
+    (3600, "⏳ 1 ساعة"),
+    (3599, "⏳ 59 دقيقة"),
+    (60, "⏳ 1 دقيقة"),
+    (59, "⏳ 50 ثانية"),
+    (5, "⏳ 0 ثانية"),
+])
+def test_label_at_level_boundaries(remaining, label):
+    assert ADAPTIVE.label(remaining) == label
+
+
+def test_full_label_shows_days_hours_minutes():
+    assert MINUTES.label(90061) == "⏳ 1 يوم : 1 ساعة : 1 دقيقة"
+    assert MINUTES.label(59) == "⏳ 0 يوم : 0 ساعة : 0 دقيقة"
+
+
+@pytest.mark.parametrize("policy", [ADAPTIVE, MINUTES])
+def test_next_change_is_last_moment_of_current_label(policy):
+    rng = random.Random(16)
+    samples = [rng.uniform(0.5, 5 * 86400) for _ in range(2000)]
+    samples += [48 * 3600 + 0.5, 3600.5, 60.5, 120, 3600, 48 * 3600]
+    for remaining in samples:
+        label = policy.label(remaining)
+        at = policy.next_change(remaining)
+        assert 0 <= at <= remaining
+        assert policy.label(at) == label
+        if at > 0:
+            # العد يُرسم بعد الموعد مباشرة (due + 1ms) فيظهر النص الجديد
+            assert policy.label(at - EPS) != label
+
+
+@pytest.mark.parametrize("policy", [ADAPTIVE, MINUTES])
+def test_bucket_end_is_exclusive_upper_bound(policy):
+    rng = random.Random(17)
+    for remaining in [rng.uniform(0.5, 5 * 86400) for _ in range(2000)] + [3599.5, 47 * 3600 + 1]:
+        label = policy.label(remaining)
+        end = policy.bucket_end(remaining)
+        assert end > remaining
+        assert policy.label(end - EPS) == label
+        assert policy.label(end) != label
+
+
+def test_next_label_change_is_none_once_expired():
+    now = datetime.datetime(2030, 1, 1)
+    assert next_label_change(now, now, "minutes") is None
+    assert next_label_change(now - datetime.timedelta(seconds=1), now, "minutes") is None
+    due = next_label_change(now + datetime.timedelta(seconds=125), now, "minutes")
+    assert due == now + datetime.timedelta(seconds=5)
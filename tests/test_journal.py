@@ -0,0 +1,116 @@
+import datetime
+import shutil
+
+import pytest
+
+import main
+from main import JsonStorage, Post
+
+NOW = datetime.datetime(2030, 1, 1, 12, 0, 0)
+STATE = ("target_date", "timer_message_id", "timer_chat_id", "timer_active", "custom_end_message", "button_link",
+         "channels", "posts")
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    # apply_snapshot و JsonStorage.apply يعيدان ربط متغيرات الوحدة؛ monkeypatch يعيدها بعد الاختبار
+    for name in STATE:
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main, "render_cache", {})
+    store = JsonStorage(str(tmp_path / "data.json"), str(tmp_path / "data.journal"), 1000)
+    monkeypatch.setattr(main, "storage", store)
+    main.apply_snapshot({})
+    yield store
+    if store.handle is not None:
+        store.handle.close()
+
+
+def state() -> dict:
+    data = main.build_snapshot()
+    del data["metadata"]["created_at"]
+    return data
+
+
+def reload(storage) -> JsonStorage:
+    """تحميل من القرص كما يحدث عند إعادة تشغيل البوت."""
+    if storage.handle is not None:
+        storage.handle.close()
+    main.apply_snapshot({})
+    fresh = JsonStorage(storage.data_file, storage.journal_file, storage.compact_every)
+    main.storage = fresh
+    fresh.load()
+    if fresh.startup_thread is not None:
+        fresh.startup_thread.join()
+    return fresh
+
+
+def make_changes(storage):
+    for i in range(1, 4):
+        post = Post(chat_id="-100", message_id=i, post_text=f"p{i}", post_date=NOW + datetime.timedelta(days=i))
+        main.posts.append(post)
+        storage.post_added(post)
+    second = main.find_post(-100, 2)
+    second["post_text"] = "edited"
+    storage.post_updated(second, "post_text")
+    first = main.find_post(-100, 1)
+    main.posts.remove(first)
+    storage.post_deleted(first)
+    main.render_cache[(-100, 3)] = ("⏳ 3 يوم", None)
+    storage.render_changed(-100, 3, "⏳ 3 يوم", None)
+    main.timer_chat_id, main.timer_message_id, main.timer_active = -100, 9, True
+    main.channels = [{"chat_id": -100, "title": "c", "link": ""}, {"chat_id": "@chan", "title": "chan", "link": ""}]
+    storage.state_changed()
+
+
+def test_replay_rebuilds_state_without_snapshot(storage):
+    make_changes(storage)
+    expected = state()
+    reload(storage)
+    assert state() == expected
+    assert main.find_post("-100", 2)["post_text"] == "edited"
+
+
+def test_replay_after_checkpoint_is_idempotent(storage, tmp_path):
+    make_changes(storage)
+    expected = state()
+    # تعطل بعد كتابة اللقطة وقبل تفريغ السجل: اللقطة تحتوي كل عمليات السجل
+    shutil.copy(storage.journal_file, tmp_path / "saved.journal")
+    storage.checkpoint()
+    shutil.copy(tmp_path / "saved.journal", storage.journal_file)
+    fresh = reload(storage)
+    assert state() == expected
+    # الإقلاع ضغط السجل في لقطة جديدة
+    with open(fresh.journal_file, encoding="utf-8") as f:
+        assert f.read() == ""
+    assert fresh.replay() == 0
+
+
+def test_replaying_journal_twice_matches_once(storage):
+    make_changes(storage)
+    storage.handle.close()
+    storage.handle = None
+    main.apply_snapshot({})
+    assert storage.replay() > 0
+    once = state()
+    storage.replay()
+    assert state() == once
+
+
+def test_truncated_last_line_is_ignored(storage):
+    make_changes(storage)
+    expected = state()
+    storage.handle.write('{"op": "post_delete", "key": [-10')
+    storage.handle.flush()
+    reload(storage)
+    assert state() == expected
+
+
+def test_post_date_update_replays_into_deadline_index(storage):
+    post = Post(chat_id="@a", message_id=1, post_date=NOW + datetime.timedelta(days=2))
+    main.posts.append(post)
+    storage.post_added(post)
+    post["post_date"] = NOW - datetime.timedelta(days=1)
+    storage.post_updated(post, "post_date")
+    reload(storage)
+    assert main.posts.active_count(NOW) == 0
+    assert main.find_post("@a", 1)["post_date"] == NOW - datetime.timedelta(days=1)
@@ -0,0 +1,139 @@
+import datetime
+import random
+
+import pytest
+
+import main
+from main import Post, PostStore
+
+NOW = datetime.datetime(2030, 1, 1, 12, 0, 0)
+
+
+def make_post(i, hours, chat_id="@a", text="x", **fields):
+    return Post(chat_id=chat_id, message_id=i, post_text=text, post_date=NOW + datetime.timedelta(hours=hours), **fields)
+
+
+def assert_indexed(store: PostStore):
+    """كل الفهارس متسقة مع by_id."""
+    assert store.keys == sorted(store.keys)
+    assert store.keys == [(p.deadline, p.post_id) for p in store.by_deadline]
+    assert sorted(p.post_id for p in store.by_deadline) == sorted(store.by_id)
+    assert store.by_key == {(p.chat_id, p.message_id): p for p in store.by_id.values()}
+    by_chat = {}
+    for p in store.by_id.values():
+        by_chat.setdefault(p.chat_id, set()).add(p.post_id)
+    assert store.by_chat == by_chat
+    assert store.quarantined == {p.post_id for p in store.by_id.values() if p.post_quarantine}
+    assert all(p.store is store for p in store.by_id.values())
+
+
+def test_cutoff_counts_post_due_exactly_now_as_expired():
+    store = PostStore([make_post(1, -1), make_post(2, 0), make_post(3, 1)])
+    assert store.active_count(NOW) == 1
+    assert [p.message_id for p in store.expired(NOW)] == [1, 2]
+    assert [p.message_id for p in store.active(NOW)] == [3]
+    assert store.active_count(NOW - datetime.timedelta(microseconds=1)) == 2
+
+
+def test_posts_without_date_sort_first_and_count_as_expired():
+    store = PostStore([make_post(1, 2), Post(chat_id="@a", message_id=2, post_date=None)])
+    assert store.by_deadline[0].message_id == 2
+    assert store.active_count(NOW) == 1
+
+
+def test_next_expiring_skips_expired_and_respects_limit():
+    store = PostStore(make_post(i, h) for i, h in enumerate([5, -2, 3, 1, -1, 4], 1))
+    assert [p.message_id for p in store.next_expiring(NOW, 2)] == [4, 3]
+
+
+def test_bulk_extend_matches_incremental_appends():
+    rng = random.Random(7)
+    hours = [rng.uniform(-50, 50) for _ in range(300)]
+    bulk = PostStore(make_post(i, h) for i, h in enumerate(hours[:200], 1))
+    bulk.extend(make_post(i, h) for i, h in enumerate(hours[200:], 201))
+    single = PostStore()
+    for i, h in enumerate(hours, 1):
+        single.append(make_post(i, h))
+    assert bulk.keys == single.keys
+    assert_indexed(bulk)
+    assert_indexed(single)
+
+
+def test_changing_post_date_moves_post_in_deadline_index():
+    store = PostStore(make_post(i, i) for i in range(1, 6))
+    post = store.find("@a", 5)
+    post["post_date"] = NOW - datetime.timedelta(hours=1)
+    assert store.by_deadline[0] is post
+    assert store.active_count(NOW) == 4
+    assert_indexed(store)
+
+
+def test_changing_chat_id_moves_key_and_chat_indexes():
+    store = PostStore([make_post(1, 1), make_post(2, 1)])
+    post = store.find("@a", 1)
+    post["chat_id"] = "@b"
+    assert store.find("@a", 1) is None
+    assert store.find("@b", 1) is post
+    assert store.chats() == ["@a", "@b"]
+    assert_indexed(store)
+
+
+def test_quarantine_flag_keeps_set_in_sync():
+    store = PostStore([make_post(1, 1)])
+    post = store.find("@a", 1)
+    post["post_quarantine"] = "gone"
+    assert store.quarantined == {post.post_id}
+    post["post_quarantine"] = None
+    assert store.quarantined == set()
+
+
+def test_remove_and_remove_expired_unlink_every_index():
+    store = PostStore(make_post(i, h, chat_id=f"@c{i % 2}") for i, h in enumerate([-3, -2, 1, 2], 1))
+    store.remove(store.find("@c1", 3))
+    expired = store.remove_expired(NOW)
+    assert sorted(p.message_id for p in expired) == [1, 2]
+    assert all(p.store is None for p in expired)
+    assert [p.message_id for p in store] == [4]
+    assert_indexed(store)
+    with pytest.raises(ValueError):
+        store.remove(expired[0])
+
+
+def test_duplicate_or_missing_ids_get_fresh_ids_and_next_id_advances():
+    store = PostStore([make_post(1, 1, post_id=5), make_post(2, 1, post_id=5), make_post(3, 1)])
+    assert sorted(store.by_id) == [5, 6, 7]
+    assert store.ids_assigned == 2
+    assert store.next_id == 8
+
+
+def test_numeric_chat_id_strings_are_parsed_once():
+    store = PostStore([make_post(1, 1, chat_id="-100123")])
+    assert store.find(-100123, 1) is store.find("-100123", 1) is not None
+    assert store.chat_ids_parsed == 1
+
+
+def test_page_walks_all_matches_in_deadline_order():
+    rng = random.Random(3)
+    store = PostStore(
+        make_post(i, rng.uniform(-10, 100), chat_id=f"@c{i % 3}", text=f"sale item{i % 4}") for i in range(1, 121)
+    )
+    for view, chat_id, words in (("all", None, ()), ("active", "@c1", ()), ("all", None, ("item2",)),
+                                 ("active", "@c2", ("sale", "item1"))):
+        seen, after = [], None
+        while True:
+            items, after = store.page(NOW, view, chat_id, words, after, limit=7)
+            seen.extend(items)
+            if after is None:
+                break
+        expected = [p for p in (store.active(NOW) if view == "active" else store.by_deadline)
+                    if (chat_id is None or p.chat_id == chat_id)
+                    and all(w in main.search_tokens(p.post_text) for w in words)]
+        assert seen == expected
+
+
+def test_search_index_follows_text_changes():
+    store = PostStore([make_post(1, 1, text="old offer")])
+    store.page(NOW, words=("old",))  # يبني فهرس الكلمات
+    store.find("@a", 1)["post_text"] = "new offer"
+    assert store.page(NOW, words=("old",))[0] == []
+    assert [p.message_id for p in store.page(NOW, words=("new",))[0]] == [1]
@@ -0,0 +1,80 @@
+import datetime
+
+import pytest
+
+import main
+from main import Post, ShardWorker, SqliteStorage
+
+LATER = datetime.datetime.now() + datetime.timedelta(days=3)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    for name in ("custom_end_message", "button_link", "channels"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main, "render_cache", {})
+    monkeypatch.setattr(main, "countdown_scheduler", main.CountdownScheduler(main.edit_engine))
+    store = SqliteStorage(str(tmp_path / "data.db"))
+    monkeypatch.setattr(main, "storage", store)
+    for i in range(1, 7):
+        store.post_added(Post(chat_id=-100 - i % 2, message_id=i, post_text=f"p{i}", post_date=LATER))
+    store.render_changed(-100, 2, "⏳ 3 يوم", None)
+    yield store
+    store.conn.close()
+
+
+@pytest.fixture
+def worker(store, monkeypatch):
+    worker = ShardWorker(store, "w1")
+    loads = []
+    full_load = store.posts_for_chats
+    monkeypatch.setattr(store, "posts_for_chats", lambda chat_ids: loads.append(set(chat_ids)) or full_load(chat_ids))
+    worker.loads = loads
+    worker.sync()
+    return worker
+
+
+def test_first_sync_loads_owned_chats(worker):
+    assert worker.loads == [{-100, -101}]
+    assert sorted(worker.tracked) == sorted((-100 - i % 2, i) for i in range(1, 7))
+    assert main.render_cache == {(-100, 2): ("⏳ 3 يوم", None)}
+
+
+def test_later_syncs_read_only_changed_rows(store, worker):
+    edited = Post(chat_id=-100, message_id=2, post_text="new", post_date=LATER)
+    store.post_updated(edited, "post_text")
+    store.post_deleted(Post(chat_id=-101, message_id=1))
+    store.post_added(Post(chat_id=-101, message_id=9, post_date=LATER))
+    store.render_forgotten(-100, 2)
+    store.render_changed(-101, 3, "⏳ 2 يوم", None)
+    worker.sync()
+    assert worker.loads == [{-100, -101}]
+    assert worker.tracked[(-100, 2)]["post_text"] == "new"
+    assert (-101, 1) not in worker.tracked and (-101, 9) in worker.tracked
+    assert main.render_cache == {(-101, 3): ("⏳ 2 يوم", None)}
+    worker.sync()
+    assert worker.loads == [{-100, -101}]
+
+
+def test_new_chat_is_loaded_in_full(store, worker):
+    store.post_added(Post(chat_id="@new", message_id=1, post_date=LATER))
+    worker.sync()
+    assert worker.loads[1:] == [{"@new"}]
+    assert ("@new", 1) in worker.tracked
+
+
+def test_pruned_change_log_falls_back_to_full_reload(store, worker):
+    store.post_updated(Post(chat_id=-100, message_id=2, post_text="new", post_date=LATER), "post_text")
+    store.prune_changes(now=main.time.time() + main.SHARD_CHANGES_TTL + 1)
+    assert store.execute("SELECT COUNT(*) FROM changes").fetchone()[0] == 0
+    worker.sync()
+    assert worker.loads == [{-100, -101}, {-100, -101}]
+    assert worker.tracked[(-100, 2)]["post_text"] == "new"
+
+
+def test_sync_normalizes_channel_ids(store, worker):
+    main.channels = [{"chat_id": "-100", "title": "c", "link": ""}]
+    store.state_changed()
+    main.channels = []
+    worker.sync()
+    assert main.channels == [{"chat_id": -100, "title": "c", "link": ""}]
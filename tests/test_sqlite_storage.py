@@ -0,0 +1,47 @@
+import datetime
+import random
+
+import pytest
+
+import main
+from main import Post, PostStore, SqliteStorage
+
+NOW = datetime.datetime(2030, 1, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    store = SqliteStorage(str(tmp_path / "data.db"))
+    monkeypatch.setattr(main, "storage", store)
+    yield store
+    store.conn.close()
+
+
+def test_range_queries_match_post_store(storage):
+    rng = random.Random(5)
+    memory = PostStore()
+    for i in range(1, 200):
+        # ثوانٍ كاملة وأجزاء منها: isoformat يحذف الأجزاء الصفرية
+        seconds = rng.choice([rng.randint(-3600, 3600), rng.uniform(-3600, 3600)])
+        post = Post(chat_id=f"@c{i % 3}", message_id=i, post_date=NOW + datetime.timedelta(seconds=seconds))
+        memory.append(post)
+        storage.post_added(post)
+    storage.post_added(Post(chat_id="@c0", message_id=500, post_date=None))
+    for now in (NOW, NOW + datetime.timedelta(microseconds=1), NOW - datetime.timedelta(minutes=30)):
+        assert storage.active_count(now) == memory.active_count(now)
+        got = storage.next_expiring(now, 10)
+        assert [(p.chat_id, p.message_id, p.post_date) for p in got] == \
+               [(p.chat_id, p.message_id, p.post_date) for p in memory.next_expiring(now, 10)]
+
+
+def test_post_due_exactly_now_is_not_active(storage):
+    for i, seconds in enumerate([0, 1], 1):
+        storage.post_added(Post(chat_id="@a", message_id=i, post_date=NOW + datetime.timedelta(seconds=seconds)))
+    assert storage.active_count(NOW) == 1
+    assert [p.message_id for p in storage.next_expiring(NOW, 5)] == [2]
+
+
+def test_range_queries_use_date_index(storage):
+    plan = storage.execute("EXPLAIN QUERY PLAN SELECT post_id FROM posts WHERE post_date > ? ORDER BY post_date LIMIT 1",
+                           (NOW.isoformat(),)).fetchall()
+    assert any("posts_by_date" in row[-1] for row in plan)
@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+import main
+
+
+class RecordingDispatcher:
+    def __init__(self):
+        self.armed = {}
+
+    def arm_many(self, timers):
+        for key, deadline, callback in timers:
+            self.armed[key] = (deadline, callback)
+
+    def disarm(self, key):
+        self.armed.pop(key, None)
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    for name in ("timer_active", "target_date", "timer_message_id"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    dispatcher = RecordingDispatcher()
+    monkeypatch.setattr(main, "expiry_dispatcher", dispatcher)
+    return dispatcher
+
+
+def start_timer(remaining: datetime.timedelta):
+    main.timer_active, main.timer_message_id = True, 7
+    main.target_date = datetime.datetime.now() + remaining
+
+
+def test_refresh_is_armed_just_after_next_label_change(dispatcher):
+    start_timer(datetime.timedelta(days=3, minutes=30))
+    before = datetime.datetime.now()
+    main.sync_timer_expiry()
+    assert dispatcher.armed[main.TIMER_EXPIRY][0] == main.target_date
+    due = dispatcher.armed[main.TIMER_REFRESH][0]
+    assert due < main.target_date
+    # عند الموعد يظهر النص الجديد، وقبله بقليل النص الحالي
+    assert main.countdown_label(main.target_date, due) != main.countdown_label(main.target_date, before)
+    assert main.countdown_label(main.target_date, due - datetime.timedelta(milliseconds=2)) == \
+           main.countdown_label(main.target_date, before)
+
+
+def test_refresh_rearms_after_each_change(dispatcher, monkeypatch):
+    updates = []
+    monkeypatch.setattr(main, "update_timer", lambda: updates.append(1))
+    start_timer(datetime.timedelta(hours=5))
+    main.sync_timer_expiry()
+    first = dispatcher.armed[main.TIMER_REFRESH][0]
+    main.target_date -= first - datetime.datetime.now()  # كأن الوقت وصل إلى الموعد
+    main.refresh_timer()
+    assert updates == [1]
+    assert dispatcher.armed[main.TIMER_REFRESH][0] > datetime.datetime.now()
+
+
+def test_stopped_or_expired_timer_disarms_both(dispatcher):
+    start_timer(datetime.timedelta(hours=5))
+    main.sync_timer_expiry()
+    main.timer_active = False
+    main.sync_timer_expiry()
+    assert dispatcher.armed == {}
+    start_timer(datetime.timedelta(seconds=-1))
+    main.sync_timer_expiry()
+    assert dispatcher.armed == {}